@@ -0,0 +1,444 @@
+#!/usr/bin/python3
+
+"""
+An offline benchmark for the spcharms.repo, spcharms.txn, and
+spcharms.config modules: run install_packages(), unrecord_packages(),
+LXD.copy_package_trees(), and get_dict() against the fake apt-cache,
+apt-get, dpkg, dpkg-query, txn, lxc, and storpool_confshow tools from
+the fake_tools.py file, simulating a node with thousands of packages,
+deep dependency trees, and many LXD containers.
+
+Run it from the top-level directory of the layer:
+
+    python3 benchmarks/bench_offline.py -o results.json
+    python3 benchmarks/bench_offline.py -c results.json
+
+Nothing outside of a temporary directory is modified.  Each operation is
+run as a separate simulated hook; the wall time and the number of
+external commands spawned are reported for each of them.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import mock
+
+from charmhelpers.core import unitdata
+
+top_path = os.path.realpath('.')
+lib_path = os.path.realpath('lib')
+if lib_path not in sys.path:
+    sys.path.insert(0, lib_path)
+
+r_kv = unitdata.Storage(':memory:')
+unitdata.kv = lambda: r_kv
+
+from spcharms import config as spconfig
+from spcharms import hookexit
+from spcharms import kvcache
+from spcharms import memo
+from spcharms import repo as sprepo
+from spcharms import trace
+from spcharms import txn
+
+RESULTS_FORMAT = 1
+
+FAKE_TOOLS = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                          'fake_tools.py')
+TOOLS = ['apt-cache', 'apt-get', 'dpkg', 'dpkg-query', 'txn', 'lxc',
+         'storpool_confshow']
+
+CHARM_NAME = 'storpool-bench'
+LAYER_NAME = 'storpool-bench-layer'
+
+
+def pkg_name(idx):
+    return 'sp-bench-{idx:05}'.format(idx=idx)
+
+
+class World(object):
+    """
+    The simulated node: the fake tools, the packages, the containers,
+    and the StorPool configuration.
+    """
+    def __init__(self, tempd, args):
+        self.tempd = tempd
+        self.args = args
+        self.bindir = os.path.join(tempd, 'bin')
+        self.rootdir = os.path.join(tempd, 'root')
+        self.world_file = os.path.join(tempd, 'world.json')
+        self.log_file = os.path.join(tempd, 'spawned.log')
+        self.list_file = os.path.join(tempd, 'install-charms.json')
+        self.config_file = os.path.join(tempd, 'storpool.conf')
+
+        os.mkdir(self.bindir)
+        with open(FAKE_TOOLS, mode='r') as f:
+            source = f.read()
+        for tool in TOOLS:
+            path = os.path.join(self.bindir, tool)
+            with open(path, mode='w') as f:
+                f.write('#!{python} -S\n'.format(python=sys.executable))
+                f.write(source)
+            os.chmod(path, 0o755)
+
+    def create(self, packages):
+        """
+        Build a node with the specified number of packages arranged in
+        a binary dependency tree, and a few more that are not installed.
+        The leaves of the tree are also installed in the containers.
+        """
+        shutil.rmtree(self.rootdir, ignore_errors=True)
+        for name in os.listdir(self.tempd):
+            if name.startswith('containers'):
+                shutil.rmtree(os.path.join(self.tempd, name))
+        pkgs = {}
+        for idx in range(packages):
+            name = pkg_name(idx)
+            pkgdir = os.path.join(self.rootdir, 'usr', 'share', name)
+            files = [pkgdir]
+            for fidx in range(self.args.files):
+                files.append(os.path.join(pkgdir, 'file-{idx}'.format(
+                    idx=fidx)))
+            pkgs[name] = {
+                'version': '1.0.{idx}'.format(idx=idx),
+                'depends': [pkg_name(dep) for dep in (2 * idx + 1,
+                                                      2 * idx + 2)
+                            if dep < packages],
+                'files': files,
+            }
+        installed = dict([(name, data['version'])
+                          for (name, data) in pkgs.items()])
+        for name in self.requested():
+            pkgs[name] = {'version': '2.0', 'depends': [], 'files': []}
+        world = {
+            'packages': pkgs,
+            'installed': installed,
+            'containers': ['bench-{idx:03}'.format(idx=idx)
+                           for idx in range(self.args.containers)],
+            # The base packages are already installed in the containers.
+            'container_installed': dict([
+                (name, data['version']) for (name, data) in pkgs.items()
+                if not data['depends']]),
+            'config': {
+                '': dict([('SP_BENCH_VAR_{idx}'.format(idx=idx),
+                           'value-{idx}'.format(idx=idx))
+                          for idx in range(self.args.variables)]),
+            },
+        }
+        with open(self.world_file, mode='w') as f:
+            json.dump(world, f)
+        self.packages = pkgs
+        self.spawned_reset()
+
+    def create_files(self):
+        """
+        Create the files of the packages so that they may be copied into
+        the containers.
+        """
+        for data in self.packages.values():
+            if not data['files']:
+                continue
+            os.makedirs(data['files'][0], exist_ok=True)
+            for fname in data['files'][1:]:
+                with open(fname, mode='w') as f:
+                    f.write(fname)
+
+    def requested(self):
+        return ['sp-bench-new-{idx:03}'.format(idx=idx)
+                for idx in range(self.args.requested)]
+
+    def tree_root(self, packages):
+        """
+        Find the package with a dependency tree of the requested depth.
+        """
+        height = 0
+        while 2 ** (height + 1) - 1 <= packages:
+            height += 1
+        depth = min(self.args.depth, height)
+        return pkg_name(2 ** (height - depth) - 1)
+
+    def spawned_reset(self):
+        with open(self.log_file, mode='w'):
+            pass
+
+    def spawned(self):
+        with open(self.log_file, mode='r') as f:
+            tools = f.read().split()
+        return dict([(tool, tools.count(tool)) for tool in sorted(set(tools))])
+
+    def environ(self):
+        return {
+            'PATH': self.bindir + os.pathsep + os.environ.get('PATH', ''),
+            'FAKE_WORLD': self.world_file,
+            'FAKE_LOG': self.log_file,
+            'CHARM_DIR': top_path,
+        }
+
+
+class BenchLXD(txn.LXD):
+    """
+    Keep the container filesystems within the temporary directory.
+    """
+    tempd = None
+
+    def __init__(self, name):
+        super(BenchLXD, self).__init__(name)
+        if name != '':
+            self.prefix = os.path.join(self.tempd, 'containers', name,
+                                       'rootfs')
+            self.txn = txn.Txn(prefix=self.prefix)
+
+
+class Hook(object):
+    """
+    Measure a single simulated hook.
+    """
+    def __init__(self, world):
+        self.world = world
+
+    def __enter__(self):
+        kvcache.reset()
+        hookexit.reset()
+        memo.reset()
+        trace.reset()
+        self.world.spawned_reset()
+        self.patchers = [
+            mock.patch.dict('os.environ', self.world.environ()),
+            mock.patch('charmhelpers.core.hookenv.config',
+                       return_value={'handle_lxc': True}),
+            mock.patch('spcharms.repo.charm_install_list_file',
+                       return_value=self.world.list_file),
+            mock.patch('spcharms.config.CONFSHOW',
+                       new=os.path.join(self.world.bindir,
+                                        'storpool_confshow')),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.exec_counts = dict(trace.exec_counts)
+        hookexit.run()
+        self.wall = time.time() - self.start
+        for patcher in reversed(self.patchers):
+            patcher.stop()
+
+    def result(self, op, packages):
+        spawned = self.world.spawned()
+        return {
+            'op': op,
+            'packages': packages,
+            'wall_s': self.wall,
+            'spawned': sum(spawned.values()),
+            'spawned_by_tool': spawned,
+            'exec_counts': self.exec_counts,
+        }
+
+
+def bench_install_packages(world, packages):
+    """
+    Install a set of packages that are not installed yet.
+    """
+    world.create(packages)
+    with Hook(world) as hook:
+        (err, _) = sprepo.install_packages(
+            dict([(name, '*') for name in world.requested()]))
+        assert err is None, err
+    return hook.result('install_packages', packages)
+
+
+def bench_install_packages_noop(world, packages):
+    """
+    Make sure that a set of already installed packages are still there.
+    """
+    world.create(packages)
+    requested = dict([(pkg_name(idx), '*')
+                      for idx in range(packages - world.args.requested,
+                                       packages)])
+    with Hook(world) as hook:
+        (err, _) = sprepo.install_packages(requested)
+        assert err is None, err
+    return hook.result('install_packages_noop', packages)
+
+
+def bench_unrecord_packages(world, packages):
+    """
+    Remove a layer's packages, half of them still needed by another one.
+    """
+    world.create(packages)
+    ours = [pkg_name(idx) for idx in range(packages - world.args.requested,
+                                           packages)]
+    data = {
+        'charms': {
+            CHARM_NAME: {'layers': {LAYER_NAME: {'packages': ours}}},
+            'storpool-other': {'layers': {'storpool-other-layer': {
+                'packages': ours[:len(ours) // 2]}}},
+        },
+        'packages': {'remove': []},
+    }
+    with open(world.list_file, mode='w') as f:
+        print(json.dumps(data), file=f)
+    with Hook(world) as hook:
+        sprepo.unrecord_packages(LAYER_NAME, charm_name=CHARM_NAME)
+    return hook.result('unrecord_packages', packages)
+
+
+def bench_copy_package_trees(world, packages):
+    """
+    Copy a package and its dependencies into all the containers.
+    """
+    world.create(packages)
+    world.create_files()
+    BenchLXD.tempd = world.tempd
+    root = world.tree_root(packages)
+    with Hook(world) as hook:
+        for lxd in BenchLXD.construct_all():
+            lxd.copy_package_trees(root)
+    return hook.result('copy_package_trees', packages)
+
+
+def bench_get_dict_confshow(world, packages):
+    """
+    Fetch the StorPool configuration using storpool_confshow.
+    """
+    world.create(packages)
+    missing = os.path.join(world.tempd, 'no-such-file')
+    with mock.patch('spcharms.config.CONFIG_FILE', new=missing), \
+            mock.patch('spcharms.config.CONFIG_DIR', new=missing), \
+            Hook(world) as hook:
+        spconfig.drop_cache()
+        spconfig.get_dict()
+        spconfig.get_dict()
+    return hook.result('get_dict_confshow', packages)
+
+
+def bench_get_dict_files(world, packages):
+    """
+    Parse a StorPool configuration file with many host sections.
+    """
+    world.create(packages)
+    with open(world.config_file, mode='w') as f:
+        print('SP_OURID=1', file=f)
+        for idx in range(world.args.hosts):
+            print('\n[bench-host-{idx:04}]'.format(idx=idx), file=f)
+            print('SP_OURID={id}'.format(id=idx + 1), file=f)
+            for vidx in range(world.args.variables // 10):
+                print('SP_BENCH_VAR_{idx}=value-{idx}'.format(idx=vidx),
+                      file=f)
+    missing = os.path.join(world.tempd, 'no-such-dir')
+    with mock.patch('spcharms.config.CONFIG_FILE', new=world.config_file), \
+            mock.patch('spcharms.config.CONFIG_DIR', new=missing), \
+            Hook(world) as hook:
+        spconfig.drop_cache()
+        spconfig.get_dict()
+        spconfig.get_dict()
+    return hook.result('get_dict_files', packages)
+
+
+BENCHMARKS = [
+    bench_install_packages,
+    bench_install_packages_noop,
+    bench_unrecord_packages,
+    bench_copy_package_trees,
+    bench_get_dict_confshow,
+    bench_get_dict_files,
+]
+
+
+def run(args):
+    """
+    Run all the benchmarks for all the node sizes, keep the fastest
+    of the repeated runs.
+    """
+    results = []
+    with tempfile.TemporaryDirectory(prefix='bench-offline.') as tempd:
+        world = World(tempd, args)
+        for packages in [int(s) for s in args.packages.split(',')]:
+            for bench in BENCHMARKS:
+                runs = [bench(world, packages) for _ in range(args.repeat)]
+                results.append(min(runs, key=lambda r: r['wall_s']))
+                print('{op:22} {packages:6} {wall:10.6f}s {spawned:6} spawned'
+                      .format(op=results[-1]['op'], packages=packages,
+                              wall=results[-1]['wall_s'],
+                              spawned=results[-1]['spawned']),
+                      file=sys.stderr)
+    return {
+        'format': RESULTS_FORMAT,
+        'python': platform.python_version(),
+        'timestamp': int(time.time()),
+        'params': {
+            'depth': args.depth,
+            'containers': args.containers,
+            'files': args.files,
+            'hosts': args.hosts,
+            'requested': args.requested,
+            'variables': args.variables,
+        },
+        'results': results,
+    }
+
+
+def compare(old, new):
+    """
+    Display the differences between two sets of results.
+    """
+    old_res = dict([((r['op'], r['packages']), r) for r in old['results']])
+    for res in new['results']:
+        prev = old_res.get((res['op'], res['packages']))
+        if prev is None:
+            continue
+        ratio = res['wall_s'] / prev['wall_s'] \
+            if prev['wall_s'] else float('inf')
+        print('{op:22} {packages:6} time x{ratio:.2f} spawned {os} -> {ns}'
+              .format(op=res['op'], packages=res['packages'], ratio=ratio,
+                      os=prev['spawned'], ns=res['spawned']))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the spcharms.repo, spcharms.txn, and '
+                    'spcharms.config modules using fake tools')
+    parser.add_argument('-c', '--compare', metavar='FILE',
+                        help='compare the results to a previous run')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='write the results to the specified file')
+    parser.add_argument('-p', '--packages', default='1000,4000',
+                        help='the comma-separated numbers of packages '
+                             'on the node')
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='the number of times to run each benchmark')
+    parser.add_argument('--containers', type=int, default=4,
+                        help='the number of LXD containers')
+    parser.add_argument('--depth', type=int, default=5,
+                        help='the depth of the copied dependency tree')
+    parser.add_argument('--files', type=int, default=4,
+                        help='the number of files in each package')
+    parser.add_argument('--hosts', type=int, default=500,
+                        help='the number of hosts in the configuration file')
+    parser.add_argument('--requested', type=int, default=20,
+                        help='the number of packages to install or remove')
+    parser.add_argument('--variables', type=int, default=200,
+                        help='the number of configuration variables')
+    args = parser.parse_args()
+
+    res = run(args)
+    if args.output is not None:
+        with open(args.output, mode='w') as f:
+            json.dump(res, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(res, indent=2, sort_keys=True))
+
+    if args.compare is not None:
+        with open(args.compare, mode='r') as f:
+            compare(json.load(f), res)
+
+
+if __name__ == '__main__':
+    main()
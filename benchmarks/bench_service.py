@@ -0,0 +1,300 @@
+#!/usr/bin/python3
+
+"""
+A scale benchmark for the spcharms.service_hook module: generate synthetic
+clusters of peers and measure handle(), add_present_node(), and
+get_present_nodes().
+
+Run it from the top-level directory of the layer:
+
+    python3 benchmarks/bench_service.py -o results.json
+    python3 benchmarks/bench_service.py -c results.json
+
+Each operation is run as a separate simulated hook: the spcharms.kvcache
+cache starts empty and is flushed to the (mock) unit database at the end.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import mock
+
+from charmhelpers.core import unitdata
+
+top_path = os.path.realpath('.')
+if top_path not in sys.path:
+    sys.path.insert(0, top_path)
+lib_path = os.path.realpath('lib')
+if lib_path not in sys.path:
+    sys.path.insert(0, lib_path)
+
+
+# Reuse the mock reactive states and database from the unit tests, but
+# count the data written to the database; make sure the unit tests'
+# check for an already mocked database does not create a real one.
+os.environ['UNIT_STATE_DB'] = ':memory:'
+from unit_tests import test_service as ts
+
+
+class CountingMockDB(ts.MockDB):
+    """
+    A mock unit database that keeps track of the number of writes and
+    the size of the serialized values.
+    """
+    def __init__(self, **data):
+        super(CountingMockDB, self).__init__(**data)
+        self.r_reset_counters()
+
+    def r_reset_counters(self):
+        self.writes = 0
+        self.bytes_written = 0
+
+    def set(self, name, value):
+        self.writes += 1
+        self.bytes_written += len(json.dumps(value))
+        super(CountingMockDB, self).set(name, value)
+
+    def unset(self, name):
+        self.writes += 1
+        super(CountingMockDB, self).unset(name)
+
+
+r_kv = CountingMockDB()
+unitdata.kv = lambda: r_kv
+
+from spcharms import hookexit
+from spcharms import kvcache
+from spcharms import memo
+from spcharms import service_hook as testee
+
+RESULTS_FORMAT = 1
+
+REL_NAME = 'storpool-presence'
+
+CONV_PREFIX = 'reactive.conversations.{rel}:0.'.format(rel=REL_NAME)
+
+
+def node_name(idx):
+    return 'storpool-node-{idx:04}'.format(idx=idx)
+
+
+def conv_key(idx):
+    return '{prefix}peer/{idx}'.format(prefix=CONV_PREFIX, idx=idx)
+
+
+def populate(peers):
+    """
+    Create a cluster where each of the peers reports all the nodes.
+    """
+    r_kv.r_clear()
+    kvcache.reset()
+    hookexit.reset()
+    testee.pending_broadcasts.clear()
+    ts.r_state.r_clear_states()
+
+    nodes = dict([(node_name(idx), True) for idx in range(peers)])
+    db = kvcache.kv()
+    testee.set_row(db, '-local', {node_name(0): True})
+    for idx in range(1, peers):
+        testee.set_row(db, conv_key(idx), nodes)
+    kvcache.flush()
+    return nodes
+
+
+class Hook(object):
+    """
+    Measure a single simulated hook.
+    """
+    def __init__(self):
+        self.rel_set = mock.Mock()
+        self.rel_ids = mock.Mock(
+            return_value=['{rel}:{idx}'.format(rel=REL_NAME, idx=idx)
+                          for idx in range(3)])
+
+    def __enter__(self):
+        kvcache.reset()
+        hookexit.reset()
+        memo.reset()
+        r_kv.r_reset_counters()
+        self.patchers = [
+            mock.patch('charmhelpers.core.hookenv.relation_set',
+                       new=self.rel_set),
+            mock.patch('charmhelpers.core.hookenv.relation_ids',
+                       new=self.rel_ids),
+            mock.patch('charms.reactive.set_state',
+                       new=ts.r_state.set_state),
+            mock.patch('charms.reactive.remove_state',
+                       new=ts.r_state.remove_state),
+            mock.patch('charms.reactive.helpers.is_state',
+                       new=ts.r_state.is_state),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        hookexit.run()
+        self.wall = time.time() - self.start
+        for patcher in reversed(self.patchers):
+            patcher.stop()
+
+    def result(self, op, peers, calls=1):
+        return {
+            'op': op,
+            'peers': peers,
+            'calls': calls,
+            'wall_s': self.wall,
+            'wall_per_call_s': self.wall / calls,
+            'kv_writes': r_kv.writes,
+            'kv_bytes': r_kv.bytes_written,
+            'relation_set': self.rel_set.call_count,
+            'relation_ids': self.rel_ids.call_count,
+        }
+
+
+def bench_handle(peers):
+    """
+    A single peer reports a change in the state of one node.
+    """
+    nodes = populate(peers)
+    nodes[node_name(peers - 1)] = False
+    hk = mock.Mock(relation_name=REL_NAME)
+    hk.conversation.return_value.key = conv_key(1)
+    with Hook() as hook:
+        testee.handle(hk, True, nodes)
+    return hook.result('handle', peers)
+
+
+def bench_handle_new(peers):
+    """
+    A new peer reports the state of all the nodes.
+    """
+    nodes = populate(peers)
+    hk = mock.Mock(relation_name=REL_NAME)
+    hk.conversation.return_value.key = conv_key(peers)
+    with Hook() as hook:
+        testee.handle(hk, True, nodes)
+    return hook.result('handle_new', peers)
+
+
+def bench_handle_detach(peers):
+    """
+    A peer goes away.
+    """
+    populate(peers)
+    hk = mock.Mock(relation_name=REL_NAME)
+    hk.conversation.return_value.key = conv_key(1)
+    with Hook() as hook:
+        testee.handle(hk, False, None)
+    return hook.result('handle_detach', peers)
+
+
+def bench_add_present_node(peers):
+    """
+    Several local nodes (e.g. containers) come up during a single hook.
+    """
+    populate(peers)
+    calls = 10
+    with Hook() as hook:
+        for idx in range(calls):
+            testee.add_present_node('container-{idx}'.format(idx=idx), True,
+                                    REL_NAME)
+    return hook.result('add_present_node', peers, calls)
+
+
+def bench_get_present_nodes(peers):
+    """
+    Several handlers query the present nodes during a single hook.
+    """
+    populate(peers)
+    calls = 10
+    with Hook() as hook:
+        for _ in range(calls):
+            testee.get_present_nodes()
+    return hook.result('get_present_nodes', peers, calls)
+
+
+BENCHMARKS = [
+    bench_handle,
+    bench_handle_new,
+    bench_handle_detach,
+    bench_add_present_node,
+    bench_get_present_nodes,
+]
+
+
+def run(sizes, repeat):
+    """
+    Run all the benchmarks for all the cluster sizes, keep the fastest
+    of the repeated runs.
+    """
+    results = []
+    for peers in sizes:
+        for bench in BENCHMARKS:
+            runs = [bench(peers) for _ in range(repeat)]
+            results.append(min(runs, key=lambda r: r['wall_s']))
+            print('{op:20} {peers:6} {wall:10.6f}s {kv:10} bytes '
+                  '{rel:4} relation-set'
+                  .format(op=results[-1]['op'], peers=peers,
+                          wall=results[-1]['wall_per_call_s'],
+                          kv=results[-1]['kv_bytes'],
+                          rel=results[-1]['relation_set']),
+                  file=sys.stderr)
+    return {
+        'format': RESULTS_FORMAT,
+        'python': platform.python_version(),
+        'timestamp': int(time.time()),
+        'results': results,
+    }
+
+
+def compare(old, new):
+    """
+    Display the differences between two sets of results.
+    """
+    old_res = dict([((r['op'], r['peers']), r) for r in old['results']])
+    for res in new['results']:
+        prev = old_res.get((res['op'], res['peers']))
+        if prev is None:
+            continue
+        ratio = res['wall_per_call_s'] / prev['wall_per_call_s'] \
+            if prev['wall_per_call_s'] else float('inf')
+        print('{op:20} {peers:6} time x{ratio:.2f} kv bytes {ob} -> {nb} '
+              'relation-set {orel} -> {nrel}'
+              .format(op=res['op'], peers=res['peers'], ratio=ratio,
+                      ob=prev['kv_bytes'], nb=res['kv_bytes'],
+                      orel=prev['relation_set'], nrel=res['relation_set']))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the spcharms.service_hook module')
+    parser.add_argument('-c', '--compare', metavar='FILE',
+                        help='compare the results to a previous run')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='write the results to the specified file')
+    parser.add_argument('-p', '--peers', default='10,100,1000',
+                        help='the comma-separated cluster sizes to test')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='the number of times to run each benchmark')
+    args = parser.parse_args()
+
+    res = run([int(s) for s in args.peers.split(',')], args.repeat)
+    if args.output is not None:
+        with open(args.output, mode='w') as f:
+            json.dump(res, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(res, indent=2, sort_keys=True))
+
+    if args.compare is not None:
+        with open(args.compare, mode='r') as f:
+            compare(json.load(f), res)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""
+Scriptable fake versions of the apt-cache, apt-get, dpkg, dpkg-query,
+txn, lxc, and storpool_confshow tools for the offline benchmarks.
+
+The tool to emulate is determined by the name that this file is invoked
+as.  The simulated system is described by a JSON file named in
+the FAKE_WORLD environment variable:
+
+    {
+      "packages": {"name": {"version": "1.0", "depends": [...],
+                            "files": [...]}},
+      "installed": {"name": "1.0"},
+      "containers": ["name", ...],
+      "container_installed": {"name": "1.0"},
+      "config": {"hostname": {"SP_VAR": "value"}}
+    }
+
+The "installed" member is updated by apt-get install and dpkg --purge.
+Each invocation is recorded as a line in the file named in the FAKE_LOG
+environment variable.
+"""
+import json
+import os
+import sys
+
+
+def load_world():
+    with open(os.environ['FAKE_WORLD'], mode='r') as f:
+        return json.load(f)
+
+
+def save_world(world):
+    tmp = os.environ['FAKE_WORLD'] + '.tmp'
+    with open(tmp, mode='w') as f:
+        json.dump(world, f)
+    os.rename(tmp, os.environ['FAKE_WORLD'])
+
+
+def args_after_dashes(args):
+    return args[args.index('--') + 1:] if '--' in args else args
+
+
+def apt_cache(args):
+    world = load_world()
+    if args[:1] != ['policy']:
+        return 1
+    for name in args_after_dashes(args[1:]):
+        pkg = world['packages'].get(name)
+        if pkg is None:
+            continue
+        print('{name}:'.format(name=name))
+        print('  Installed: {ver}'.format(
+            ver=world['installed'].get(name, '(none)')))
+        print('  Candidate: {ver}'.format(ver=pkg['version']))
+        print('  Version table:')
+    return 0
+
+
+def apt_get(args):
+    world = load_world()
+    if args[:1] != ['install']:
+        return 1
+    names = args_after_dashes(args[1:])
+    if [name for name in names if name not in world['packages']]:
+        return 100
+    for name in names:
+        world['installed'][name] = world['packages'][name]['version']
+    save_world(world)
+    return 0
+
+
+def dpkg(args):
+    world = load_world()
+    names = args_after_dashes(args)
+    if args[:1] == ['-L']:
+        if not names or names[0] not in world['installed']:
+            return 1
+        print('\n'.join(world['packages'][names[0]]['files']))
+        return 0
+    elif args[:2] == ['-r', '--dry-run']:
+        return 0 if all([name in world['installed'] for name in names]) \
+            else 1
+    elif args[:1] == ['--purge']:
+        for name in names:
+            world['installed'].pop(name, None)
+        save_world(world)
+        return 0
+    return 1
+
+
+def dpkg_query(args):
+    world = load_world()
+    fmt = None
+    for opt in ('--showformat', '-f'):
+        if opt in args:
+            fmt = args[args.index(opt) + 1]
+    names = args_after_dashes(args) if '--' in args \
+        else sorted(world['installed'].keys())
+    if not names:
+        return 1
+    for name in names:
+        if name not in world['installed']:
+            return 1
+        pkg = world['packages'][name]
+        sys.stdout.write(
+            fmt.replace('${Package}', name)
+               .replace('${Version}', world['installed'][name])
+               .replace('${Status}', 'install ok installed')
+               .replace('${Depends}', ', '.join(
+                   ['{dep} (>= 0)'.format(dep=dep)
+                    for dep in pkg['depends']]))
+               .replace('\\t', '\t').replace('\\n', '\n'))
+    return 0
+
+
+def txn(args):
+    if args[:1] == ['list-modules']:
+        return 0
+    return 0 if args[:1] in (['install'], ['install-exact'],
+                             ['rollback']) else 1
+
+
+def lxc(args):
+    world = load_world()
+    if args[:1] == ['list']:
+        print(json.dumps([{'name': name} for name in world['containers']]))
+        return 0
+    elif args[:1] == ['exec']:
+        # Only check whether a package is installed in the container.
+        cmd = args_after_dashes(args)
+        if cmd[:1] != ['dpkg-query'] or \
+                cmd[-1] not in world['container_installed']:
+            return 1
+        sys.stdout.write(world['container_installed'][cmd[-1]])
+        return 0
+    return 1
+
+
+def storpool_confshow(args):
+    world = load_world()
+    host = args[1] if args[:1] == ['-n'] else os.uname()[1]
+    cfg = world['config'].get(host, world['config'].get('', {}))
+    for (name, value) in sorted(cfg.items()):
+        print('{name}={value}'.format(name=name, value=value))
+    return 0
+
+
+TOOLS = {
+    'apt-cache': apt_cache,
+    'apt-get': apt_get,
+    'dpkg': dpkg,
+    'dpkg-query': dpkg_query,
+    'txn': txn,
+    'lxc': lxc,
+    'storpool_confshow': storpool_confshow,
+}
+
+
+def main():
+    tool = os.path.basename(sys.argv[0])
+    fd = os.open(os.environ['FAKE_LOG'],
+                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    os.write(fd, (tool + '\n').encode())
+    os.close(fd)
+    sys.exit(TOOLS[tool](sys.argv[1:]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+A StorPool Juju charm helper module: validate the cgroups that
+the StorPool services are configured to run in.
+
+The mounted cgroup hierarchies, both the legacy per-controller (v1) and
+the unified (v2) ones, are determined by parsing /proc/self/mountinfo
+once; all the SP_<SERVICE>_CGROUPS settings are then checked in a single
+pass.  The successful results are only reused within the same process,
+and only if neither the relevant StorPool configuration settings nor
+the cgroup mounts have changed: the cgroups themselves may be removed at
+any time and they do not survive a reboot.
+"""
+import hashlib
+import json
+import os
+import re
+
+from spcharms import config as spconfig
+
+MOUNTINFO = '/proc/self/mountinfo'
+
+RE_CGROUPS_VAR = re.compile(r'^SP_(?P<svc>[A-Z0-9_]+)_CGROUPS$')
+RE_MOUNTINFO_ESCAPE = re.compile(r'\\([0-7]{3})')
+
+cached_results = None
+cached_key = None
+
+
+def read_mountinfo():
+    """
+    Read the current process's mount table.
+    """
+    with open(MOUNTINFO, mode='r') as f:
+        return f.read()
+
+
+def unescape(path):
+    """
+    Decode the octal escape sequences in a mountinfo path.
+    """
+    return RE_MOUNTINFO_ESCAPE.sub(lambda m: chr(int(m.group(1), 8)), path)
+
+
+def parse_mountinfo(data):
+    """
+    Find the mounted cgroup hierarchies: return a dictionary mapping each
+    v1 controller (or "name=..." hierarchy) to its mount point and a list
+    of the mount points of the v2 unified hierarchy.
+    """
+    res = {'v1': {}, 'v2': []}
+    for line in data.splitlines():
+        fields = line.split(' ')
+        if '-' not in fields:
+            continue
+        sep = fields.index('-')
+        if len(fields) < sep + 4 or sep < 5:
+            continue
+        (fstype, superopts) = (fields[sep + 1], fields[sep + 3])
+        mountpoint = unescape(fields[4])
+        if fstype == 'cgroup':
+            for opt in superopts.split(','):
+                if opt not in ('rw', 'ro'):
+                    res['v1'].setdefault(opt, mountpoint)
+        elif fstype == 'cgroup2':
+            res['v2'].append(mountpoint)
+    return res
+
+
+def v2_controllers(mountpoint):
+    """
+    Get the controllers available in a v2 cgroup hierarchy.
+    """
+    try:
+        with open(os.path.join(mountpoint, 'cgroup.controllers'),
+                  mode='r') as f:
+            return f.read().split()
+    except OSError:
+        return []
+
+
+def get_specs(cfg):
+    """
+    Get the cgroup specifications for all the services from
+    the StorPool configuration as a service: (variable, value) dictionary.
+    """
+    res = {}
+    for (var, value) in cfg.items():
+        m = RE_CGROUPS_VAR.match(var)
+        if m is None or var == 'SP_USE_CGROUPS':
+            continue
+        res[m.group('svc').lower()] = (var, value)
+    return res
+
+
+def check_specs(specs, mounts):
+    """
+    Check whether the cgroups specified for all the services exist in
+    the mounted hierarchies; return a service: error message dictionary,
+    with a value of None for the services that are set up correctly.
+    """
+    isdir = {}
+    v2 = [(mountpoint, v2_controllers(mountpoint))
+          for mountpoint in mounts['v2']]
+
+    def find(controller, path):
+        """
+        Look for a cgroup in the v1 hierarchy of its controller or,
+        failing that, in a v2 hierarchy that supports the controller.
+        """
+        if controller in mounts['v1']:
+            candidates = [mounts['v1'][controller]]
+        else:
+            candidates = [mountpoint for (mountpoint, ctrls) in v2
+                          if controller in ctrls]
+        for mountpoint in candidates:
+            full = os.path.join(mountpoint, path.lstrip('/'))
+            if full not in isdir:
+                isdir[full] = os.path.isdir(full)
+            if isdir[full]:
+                return True
+        return False
+
+    res = {}
+    for svc in sorted(specs.keys()):
+        (var, value) = specs[svc]
+        res[svc] = None
+        for cgdef in filter(lambda s: s != '-g', value.strip().split()):
+            comp = cgdef.split(':')
+            if len(comp) != 2:
+                res[svc] = 'Unexpected component in {var}: {comp}' \
+                    .format(var=var, comp=cgdef)
+                break
+            if not find(comp[0], comp[1]):
+                res[svc] = 'No {comp} group for the {svc}' \
+                    .format(comp=cgdef, svc=svc)
+                break
+    return res
+
+
+def check_all(cfg=None):
+    """
+    Check the cgroups of all the services defined in the StorPool
+    configuration; reuse the results of a previous check in this process
+    if neither the configuration nor the mounted cgroup hierarchies have
+    changed and all the services were set up correctly back then.
+    """
+    global cached_results
+    global cached_key
+    if cfg is None:
+        cfg = spconfig.get_dict()
+    specs = get_specs(cfg)
+    mountinfo = read_mountinfo()
+    mounts = parse_mountinfo(mountinfo)
+    key = hashlib.sha256(json.dumps({
+        'specs': specs,
+        'mounts': mounts,
+    }, sort_keys=True).encode()).hexdigest()
+
+    if cached_results is not None and cached_key == key:
+        return cached_results
+
+    results = check_specs(specs, mounts)
+    if [res for res in results.values() if res is not None]:
+        drop_cache()
+    else:
+        cached_results = results
+        cached_key = key
+    return results
+
+
+def drop_cache():
+    """
+    Forget about the results of the previous checks in this process.
+    """
+    global cached_results
+    global cached_key
+    cached_results = None
+    cached_key = None
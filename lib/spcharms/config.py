@@ -1,17 +1,42 @@
 """
 A StorPool Juju charm helper module for accessing the StorPool configuration.
 """
+import fnmatch
+import hashlib
+import json
+import os
+import platform
 import subprocess
 
 from charms import reactive
-from charmhelpers.core import hookenv, unitdata
 
+from spcharms import hookexit
+from spcharms import kvcache
 from spcharms import kvdata
+from spcharms import memo
+from spcharms import trace
+
+CONFIG_FILE = '/etc/storpool.conf'
+CONFIG_DIR = '/etc/storpool.conf.d'
+CONFSHOW = '/usr/sbin/storpool_confshow'
 
 cached_config = None
+cached_fingerprint = None
+cached_index = None
+cached_index_entries = None
+cached_index_fingerprint = None
+config_changes = None
 cached_meta = None
+meta_save_registered = False
 initializing_config = None
 
+# The StorPool configuration variables that the reactive states set by
+# check_config_changes() refer to; more may be added by register_group().
+DEFAULT_GROUPS = {
+    'cgroups': ['SP_USE_CGROUPS', 'SP_*_CGROUPS'],
+    'network': ['SP_IFACE*', 'SP_API_HTTP_*', 'SP_BEACON_*'],
+}
+
 
 class QuasiConfig(object):
     def r_clear_config(self):
@@ -36,6 +61,10 @@ class QuasiConfig(object):
     def changed(self, key):
         return self.changed_attrs.get(key, False)
 
+    def changed_keys(self):
+        return set([key for (key, changed) in self.changed_attrs.items()
+                    if changed])
+
     def __getitem__(self, name):
         # Make sure a KeyError is actually thrown if needed.
         if name in self.override:
@@ -54,59 +83,422 @@ class QuasiConfig(object):
                              '"{name}" attribute'.format(name=name))
 
 
-def get_cached_dict():
+def get_hostname():
     """
-    Get the StorPool configuration, cache it the first time.
+    Get the name of the current node as used for the StorPool configuration
+    file sections.
     """
-    global cached_config
-    if cached_config is not None:
-        return cached_config
+    return platform.node()
+
+
+def config_files():
+    """
+    List the StorPool configuration files in the order that they should be
+    processed: the main one, then the ones in the storpool.conf.d/ directory.
+    """
+    try:
+        names = sorted(filter(lambda s: s.endswith('.conf'),
+                              os.listdir(CONFIG_DIR)))
+    except OSError:
+        names = []
+    return [CONFIG_FILE] + \
+        [os.path.join(CONFIG_DIR, name) for name in names]
+
+
+def get_fingerprint(files=None):
+    """
+    Identify the current version of the StorPool configuration by the inode
+    numbers, sizes, and modification times of the files it is read from and
+    of the storpool_confshow tool that may be used instead.
+    """
+    if files is None:
+        files = config_files()
+    stats = []
+    for fname in files + [CONFSHOW]:
+        try:
+            st = os.stat(fname)
+            stats.append([fname, st.st_ino, st.st_size, st.st_mtime_ns])
+        except OSError:
+            stats.append([fname, None, None, None])
+    return {'hostname': get_hostname(), 'files': stats}
+
+
+def read_entries(files):
+    """
+    Parse the StorPool configuration files into a list of
+    (section, name, value) tuples in the order that they were encountered;
+    the section is None for variables defined outside of a [hostname] one.
+    Raises OSError if any of the files cannot be read.
+    """
+    entries = []
+    for fname in files:
+        section = None
+        with open(fname, mode='r') as f:
+            for line in f.readlines():
+                line = line.strip()
+                if line == '' or line.startswith('#'):
+                    continue
+                if line.startswith('[') and line.endswith(']'):
+                    section = line[1:-1].strip()
+                    continue
+                fields = line.split('=', 1)
+                if len(fields) < 2:
+                    continue
+                entries.append((section, fields[0].strip(), fields[1].strip()))
+    return entries
+
+
+def section_matches(section, hostname):
+    """
+    Check whether the variables in the specified section apply to
+    the specified host, the same way storpool_confshow does it: the global
+    section always does, a [hostname] one only for that host.
+    """
+    return section is None or section == hostname or \
+        section == hostname.split('.', 1)[0]
+
 
+def effective_config(entries, hostname):
+    """
+    Build the configuration dictionary for the specified host from
+    the parsed entries; later definitions override earlier ones.
+    """
     res = {}
-    lines_b = subprocess.check_output(['/usr/sbin/storpool_confshow'])
+    for (section, name, value) in entries:
+        if section_matches(section, hostname):
+            res[name] = value
+    return res
+
+
+def confshow_dict(hostname=None):
+    """
+    Run storpool_confshow and parse its output.
+    """
+    cmd = [CONFSHOW]
+    if hostname is not None:
+        cmd.extend(['-n', hostname])
+    res = {}
+    lines_b = trace.run(subprocess.check_output, cmd)
     for line in lines_b.decode().split('\n'):
         fields = line.split('=', 1)
         if len(fields) < 2:
             continue
         res[fields[0]] = fields[1]
-    cached_config = res
-    return cached_config
+    return res
+
+
+def get_defaults(cfg, fingerprint):
+    """
+    Get the values that storpool_confshow reports for the variables not
+    set in the configuration files, i.e. StorPool's built-in defaults.
+    Run storpool_confshow only once and reuse its output until the tool
+    itself changes or a variable that was set in the files at the time
+    (so its default is not known) is no longer set.
+    """
+    tool = fingerprint['files'][-1]
+    if tool[1] is None:
+        return {}
+    db = kvcache.kv()
+    stored = db.get(kvdata.KEY_CONFIG_DEFAULTS, None)
+    if stored is not None and stored.get('confshow') == tool and \
+       stored.get('hostname') == fingerprint['hostname'] and \
+       set(stored['shadowed']).issubset(cfg.keys()):
+        return stored['defaults']
+
+    shown = confshow_dict()
+    defaults = dict([(name, value) for (name, value) in shown.items()
+                     if name not in cfg])
+    db.set(kvdata.KEY_CONFIG_DEFAULTS, {
+        'hostname': fingerprint['hostname'],
+        'confshow': tool,
+        'defaults': defaults,
+        'shadowed': sorted(set(shown.keys()).intersection(cfg.keys())),
+    })
+    return defaults
+
+
+def load_dict(files, fingerprint):
+    """
+    Parse the StorPool configuration files directly if possible, fall back
+    to running storpool_confshow if they cannot be read.
+    """
+    try:
+        entries = read_entries(files)
+    except OSError:
+        return confshow_dict()
+    cfg = effective_config(entries, fingerprint['hostname'])
+    res = get_defaults(cfg, fingerprint)
+    res.update(cfg)
+    return res
+
+
+def get_cached_dict():
+    """
+    Get a copy of the StorPool configuration, cache it until
+    the configuration files change.
+    """
+    global cached_config
+    global cached_fingerprint
+    files = config_files()
+    fingerprint = get_fingerprint(files)
+    if cached_config is not None and fingerprint == cached_fingerprint:
+        return dict(cached_config)
+
+    cached_config = load_dict(files, fingerprint)
+    cached_fingerprint = fingerprint
+    return dict(cached_config)
 
 
 def get_dict():
     """
-    Get the StorPool configuration.
+    Get a copy of the StorPool configuration; reuse the one stored in
+    the unit's database by a previous hook if the configuration files have
+    not changed since then.
     """
-    return get_cached_dict()
+    global cached_config
+    global cached_fingerprint
+    files = config_files()
+    fingerprint = get_fingerprint(files)
+    if cached_config is not None and fingerprint == cached_fingerprint:
+        return dict(cached_config)
+
+    db = kvcache.kv()
+    stored = db.get(kvdata.KEY_CONFIG_CACHE, None)
+    if stored is not None and stored.get('fingerprint') == fingerprint:
+        cached_config = stored['config']
+    else:
+        cached_config = load_dict(files, fingerprint)
+        db.set(kvdata.KEY_CONFIG_CACHE, {
+            'fingerprint': fingerprint,
+            'config': cached_config,
+        })
+    cached_fingerprint = fingerprint
+    return dict(cached_config)
 
 
 def drop_cache():
     """
-    Drop the StorPool configuration cache.
+    Drop the StorPool configuration cache, both the in-memory one and
+    the one stored in the unit's database.  The storpool_confshow defaults
+    are kept, get_defaults() checks whether they are still valid.
     """
     global cached_config
+    global cached_fingerprint
+    global cached_index
     cached_config = None
+    cached_fingerprint = None
+    cached_index = None
+    kvcache.kv().unset(kvdata.KEY_CONFIG_CACHE)
+
+
+def build_index(hosts):
+    """
+    Build the cluster index from the per-host configuration dictionaries.
+    If several host names (e.g. a short and a fully-qualified one) have
+    the same SP_OURID value, the first one in sorted order is used.
+    """
+    ids = {}
+    for hostname in sorted(hosts.keys()):
+        ourid = hosts[hostname].get('SP_OURID', None)
+        if ourid is not None and ourid not in ids:
+            ids[ourid] = hostname
+    return {'hosts': hosts, 'ids': ids}
+
+
+def cluster_index(hostnames=None):
+    """
+    Get the cached cluster index, build or extend it if needed; the result
+    is shared with the cache and must not be modified.
+    """
+    global cached_index
+    global cached_index_entries
+    global cached_index_fingerprint
+    files = config_files()
+    fingerprint = get_fingerprint(files)
+    if cached_index is None or fingerprint != cached_index_fingerprint:
+        try:
+            entries = read_entries(files)
+            names = set([section for (section, _, _) in entries
+                         if section is not None])
+        except OSError:
+            entries = None
+            names = set()
+        cached_index = build_index(dict([
+            (name, effective_config(entries, name)) for name in names
+        ]))
+        cached_index_entries = entries
+        cached_index_fingerprint = fingerprint
+
+    missing = set(hostnames if hostnames is not None else []) \
+        .difference(cached_index['hosts'].keys())
+    if missing:
+        hosts = dict(cached_index['hosts'])
+        for name in missing:
+            if cached_index_entries is not None:
+                hosts[name] = effective_config(cached_index_entries, name)
+            else:
+                hosts[name] = confshow_dict(name)
+        cached_index = build_index(hosts)
+    return cached_index
+
+
+def get_cluster_index(hostnames=None):
+    """
+    Get a copy of the effective StorPool configuration of all the hosts in
+    the cluster as a dictionary: "hosts" maps each host name to its
+    configuration dictionary, "ids" maps each SP_OURID value to a host name.
+    The hosts are the ones that have [hostname] sections in
+    the configuration files and any additional ones specified.
+    The files are parsed only once and the index is cached until they
+    change; if they cannot be read, storpool_confshow is run once for each
+    of the specified hosts instead.
+    """
+    idx = cluster_index(hostnames)
+    return {
+        'hosts': dict([(name, dict(cfg))
+                       for (name, cfg) in idx['hosts'].items()]),
+        'ids': dict(idx['ids']),
+    }
+
+
+def get_host_config(hostname):
+    """
+    Get a copy of the effective StorPool configuration of the specified host.
+    """
+    return dict(cluster_index([hostname])['hosts'][hostname])
+
+
+def get_host_by_id(ourid):
+    """
+    Get the name of the host with the specified SP_OURID value, or None.
+    """
+    return cluster_index()['ids'].get(str(ourid), None)
+
+
+def get_groups():
+    """
+    Fetch the table of configuration variable groups to report changes for.
+    """
+    groups = dict(DEFAULT_GROUPS)
+    groups.update(kvcache.kv().get(kvdata.KEY_CONFIG_GROUPS, {}))
+    return groups
+
+
+def register_group(name, patterns):
+    """
+    Register a group of StorPool configuration variables, specified as
+    a list of shell-style patterns; check_config_changes() will set
+    the "storpool-config.changed.<name>" state whenever any of them change.
+    Overrides any previously defined group with the same name.
+    """
+    db = kvcache.kv()
+    data = db.get(kvdata.KEY_CONFIG_GROUPS, {})
+    data[name] = list(patterns)
+    db.set(kvdata.KEY_CONFIG_GROUPS, data)
+
+
+def unregister_group(name):
+    """
+    Unregister a group of StorPool configuration variables.
+    """
+    db = kvcache.kv()
+    data = db.get(kvdata.KEY_CONFIG_GROUPS, {})
+    if name in data:
+        del data[name]
+        db.set(kvdata.KEY_CONFIG_GROUPS, data)
+
+
+def config_diff(old, new):
+    """
+    Get the set of the variables that differ between two configuration
+    dictionaries, including the ones only defined in one of them.
+    """
+    return set([key for key in set(old.keys()).union(new.keys())
+                if old.get(key) != new.get(key)])
+
+
+def check_config_changes():
+    """
+    Compare the StorPool configuration to the one seen the last time and
+    set the "storpool-config.changed" state if anything changed, as well as
+    a "storpool-config.changed.<name>" one for each registered group of
+    variables that changed.  Everything is reported as changed the first
+    time.  Return the set of all the variables changed during this hook;
+    the states are never reset, the handlers must do that.
+    """
+    global config_changes
+    cfg = get_dict()
+    db = kvcache.kv()
+    prev = db.get(kvdata.KEY_CONFIG_SNAPSHOT, None)
+    changed = config_diff(prev if prev is not None else {}, cfg)
+    if prev != cfg:
+        db.set(kvdata.KEY_CONFIG_SNAPSHOT, cfg)
+
+    if config_changes is None:
+        config_changes = set()
+    config_changes.update(changed)
+    if not changed:
+        return config_changes
+
+    reactive.set_state('storpool-config.changed')
+    for (name, patterns) in get_groups().items():
+        if any([fnmatch.fnmatchcase(key, pat)
+                for key in changed for pat in patterns]):
+            reactive.set_state('storpool-config.changed.' + name)
+    return config_changes
+
+
+def changed_config_keys():
+    """
+    Get the set of the StorPool configuration variables that have changed
+    since the last hook that checked.
+    """
+    if config_changes is None:
+        return check_config_changes()
+    return config_changes
 
 
 def get_our_id():
     """
     Fetch the cached SP_OURID value from the unit's database.
     """
-    return unitdata.kv().get(kvdata.KEY_OURID, None)
+    return kvcache.kv().get(kvdata.KEY_OURID, None)
 
 
 def set_our_id(value):
     """
     Store the SP_OURID value into the unit's database.
     """
-    unitdata.kv().set(kvdata.KEY_OURID, value)
+    kvcache.kv().set(kvdata.KEY_OURID, value)
 
 
 def unset_our_id():
     """
     Store the SP_OURID value into the unit's database.
     """
-    unitdata.kv().unset(kvdata.KEY_OURID)
+    kvcache.kv().unset(kvdata.KEY_OURID)
+
+
+def value_hash(value):
+    """
+    Compute a hash of a JSON-serializable value for change detection.
+    """
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode()) \
+        .hexdigest()
+
+
+def save_meta_hashes():
+    """
+    Store the hashes of the current meta-config values so that the next
+    hook can tell which ones have changed; invoked at hook exit.
+    """
+    mm = kvcache.kv().get(kvdata.KEY_META_CONFIG, None)
+    if mm is None or mm == 'None':
+        hashes = {}
+    else:
+        hashes = dict([(key, value_hash(value))
+                       for (key, value) in mm.items()])
+    kvcache.kv().set(kvdata.KEY_META_CONFIG_HASHES, hashes)
 
 
 def m():
@@ -115,35 +507,61 @@ def m():
     or the data hash specified using set_meta_config().
     """
     global cached_meta
+    global meta_save_registered
     if cached_meta is None:
-        mm = unitdata.kv().get(kvdata.KEY_META_CONFIG, None)
+        db = kvcache.kv()
+        mm = db.get(kvdata.KEY_META_CONFIG, None)
         if mm is None:
             raise Exception('spcharms.config.m() invoked too early!')
         elif mm == 'None':
             cached_meta = mm
         else:
+            # Compare the values to the ones seen at the end of
+            # the previous hook; everything is new the first time.
+            prev = db.get(kvdata.KEY_META_CONFIG_HASHES, None)
             cfg = QuasiConfig()
             for (key, value) in mm.items():
-                cfg.r_set(key, value, True)
+                cfg.r_set(key, value,
+                          prev is None or prev.get(key) != value_hash(value))
+            if prev is not None:
+                for key in set(prev.keys()).difference(mm.keys()):
+                    cfg.changed_attrs[key] = True
             cached_meta = cfg
 
+        if not meta_save_registered:
+            hookexit.register('config.meta-hashes', save_meta_hashes)
+            meta_save_registered = True
+
     if cached_meta == 'None':
-        return hookenv.config()
+        return memo.config()
     return cached_meta
 
 
+def changed_keys():
+    """
+    Get the set of the StorPool-related charm configuration variables that
+    have changed since the previous hook.
+    """
+    cfg = m()
+    if isinstance(cfg, QuasiConfig):
+        return cfg.changed_keys()
+    return set(filter(cfg.changed, cfg.keys()))
+
+
 def set_meta_config(data):
     """
     Specify the config dictionary that will provide the StorPool-related
     charm configuration variables.
     If specified as None, m() will use hookenv.config().
+    The changed() method of the object returned by m() compares
+    the values to the ones seen at the end of the previous hook.
     """
     # Store the new data into the unit's database.
     if data is None:
         store = 'None'
     else:
         store = data
-    unitdata.kv().set(kvdata.KEY_META_CONFIG, store)
+    kvcache.kv().set(kvdata.KEY_META_CONFIG, store)
 
     # Fetch it right back into a QuasiConfig object.
     global cached_meta
@@ -0,0 +1,80 @@
+"""
+A StorPool Juju charm helper module: run deferred work when the hook exits.
+
+The callbacks are invoked in the order of their priority; a callback may
+register more of them (e.g. a status update that needs to be stored into
+the unit's database) and they will be invoked during the same run.
+"""
+import atexit
+
+from charmhelpers.core import hookenv
+
+PRIO_EARLY = 10
+PRIO_DEFAULT = 50
+PRIO_STORE = 80
+PRIO_LAST = 90
+PRIO_FINAL = 99
+
+callbacks = {}
+registered = False
+registered_fallback = False
+
+
+def register(name, callback, priority=PRIO_DEFAULT):
+    """
+    Arrange for the callback to be invoked once when the hook completes;
+    registering the same name again before that replaces the callback.
+    If the hook fails, the callbacks are still invoked when the Python
+    interpreter exits, but any errors they raise are ignored.
+    """
+    global registered
+    global registered_fallback
+    callbacks[name] = (priority, callback)
+    if not registered:
+        hookenv.atexit(run)
+        registered = True
+    if not registered_fallback:
+        atexit.register(run_fallback)
+        registered_fallback = True
+
+
+def unregister(name):
+    """
+    Forget about a callback if it has been registered.
+    """
+    callbacks.pop(name, None)
+
+
+def run():
+    """
+    Invoke all the registered callbacks, even the ones registered by
+    the callbacks themselves.
+    """
+    global registered
+    registered = False
+    while callbacks:
+        name = min(callbacks.keys(), key=lambda n: (callbacks[n][0], n))
+        (_, callback) = callbacks.pop(name)
+        callback()
+
+
+def run_fallback():
+    """
+    Invoke any callbacks left over if the hook did not complete successfully.
+    """
+    while callbacks:
+        name = min(callbacks.keys(), key=lambda n: (callbacks[n][0], n))
+        (_, callback) = callbacks.pop(name)
+        try:
+            callback()
+        except Exception:
+            pass
+
+
+def reset():
+    """
+    Forget about all the registered callbacks without invoking them.
+    """
+    global registered
+    callbacks.clear()
+    registered = False
@@ -0,0 +1,390 @@
+"""
+A StorPool Juju charm helper module: a write-back cache in front of
+the unit's key/value database for the keys defined in spcharms.kvdata.
+
+All the known keys (and all the keys starting with the known prefixes)
+are loaded with a single query the first time any of them is needed;
+afterwards the values are served from memory and the modified ones are
+only written back once, when the hook exits.
+All the spcharms modules access these keys through the kv() object.
+The keys that are written by other charms directly through
+unitdata.kv() (FOREIGN_KEYS) and any other keys not defined in
+spcharms.kvdata are not cached: they are read and written right away.
+
+As with the database itself, get() returns a new copy of the value each
+time and set() stores a copy of the value passed to it; a caller that
+modifies a value obtained through get() must pass it to set() for
+the change to be stored.  Callers that never modify the returned values
+may pass shared=True to get() and getrange() to avoid copying them.
+
+If the storpool_kv_stats charm configuration option is enabled, the number
+of reads and writes, the size of the data written, and the time spent
+accessing the database are recorded for each key (the keys starting with
+a known prefix are grouped together) and logged when the hook exits along
+with the size of the data currently stored for each key.
+"""
+import copy
+import json
+import time
+
+from charmhelpers.core import hookenv
+from charmhelpers.core import unitdata
+
+from spcharms import hookexit
+from spcharms import kvdata
+from spcharms import memo
+from spcharms import trace
+
+
+class Absent(object):
+    """
+    Mark a key that is not present in the database.
+    """
+    def __repr__(self):
+        return 'ABSENT'
+
+
+ABSENT = Absent()
+
+# The keys defined in spcharms.kvdata that are owned by other charms.
+FOREIGN_KEYS = (
+    kvdata.KEY_LXD_NAME,
+)
+
+cache = None
+
+
+def known_keys():
+    """
+    List the keys defined in the spcharms.kvdata module, except for
+    the ones owned by other charms.
+    """
+    return sorted([getattr(kvdata, name) for name in dir(kvdata)
+                   if name.startswith('KEY_') and
+                   getattr(kvdata, name) not in FOREIGN_KEYS])
+
+
+def known_prefixes():
+    """
+    List the key prefixes defined in the spcharms.kvdata module.
+    """
+    return sorted([getattr(kvdata, name) for name in dir(kvdata)
+                   if name.startswith('PREFIX_')])
+
+
+def stats_enabled():
+    """
+    Check whether the per-key statistics should be collected.
+    """
+    return bool(memo.hook_option('storpool_kv_stats', False))
+
+
+def stats_key(key, prefixes):
+    """
+    Group the keys starting with a known prefix together in the statistics.
+    """
+    for prefix in prefixes:
+        if key.startswith(prefix):
+            return prefix + '*'
+    return key
+
+
+def stored_sizes(db, keys, prefixes=()):
+    """
+    Get the size of the data stored in the database for the specified keys
+    and for the keys starting with the specified prefixes (grouped by
+    prefix); use a single query if this is a real unitdata.Storage object.
+    """
+    res = {}
+    if hasattr(db, 'cursor') and (keys or prefixes):
+        conds = ['key in ({qs})'.format(qs=','.join(['?'] * len(keys)))] + \
+            ['key like ?'] * len(prefixes)
+        db.cursor.execute('select key, length(data) from kv where {conds}'
+                          .format(conds=' or '.join(conds)),
+                          list(keys) + [prefix + '%' for prefix in prefixes])
+        sizes = db.cursor.fetchall()
+    else:
+        data = load_keys(db, keys, prefixes)
+        sizes = [(key, len(json.dumps(value)))
+                 for (key, value) in data.items() if value is not ABSENT]
+    for (key, size) in sizes:
+        skey = stats_key(key, prefixes)
+        res[skey] = res.get(skey, 0) + size
+    return res
+
+
+def load_keys(db, keys, prefixes=()):
+    """
+    Fetch the values of the specified keys and of all the keys starting
+    with the specified prefixes from the database; use a single query if
+    this is a real unitdata.Storage object.
+    """
+    res = dict([(key, ABSENT) for key in keys])
+    if hasattr(db, 'cursor') and (keys or prefixes):
+        conds = ['key in ({qs})'.format(qs=','.join(['?'] * len(keys)))] + \
+            ['key like ?'] * len(prefixes)
+        db.cursor.execute('select key, data from kv where {conds}'
+                          .format(conds=' or '.join(conds)),
+                          list(keys) + [prefix + '%' for prefix in prefixes])
+        for (key, data) in db.cursor.fetchall():
+            res[key] = json.loads(data)
+    else:
+        for key in keys:
+            res[key] = db.get(key, ABSENT)
+        for prefix in prefixes:
+            res.update(db.getrange(prefix))
+    return res
+
+
+class KVCache(object):
+    """
+    Cache the values of the spcharms keys stored in the unit's database,
+    write the modified ones back when the hook exits.
+    """
+    def __init__(self, db):
+        """
+        Initialize an empty cache in front of the specified database.
+        """
+        self.db = db
+        self.values = None
+        self.keys = None
+        self.prefixes = None
+        self.dirty = set()
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.key_stats = None
+
+    def enable_stats(self):
+        """
+        Start collecting per-key statistics, dump them when the hook exits.
+        """
+        if self.key_stats is None:
+            self.key_stats = {}
+            hookexit.register('kvcache.stats', self.dump_stats,
+                              hookexit.PRIO_LAST)
+
+    def record(self, key, reads=0, writes=0, size=0, spent=0):
+        """
+        Update the statistics for the specified key if enabled.
+        """
+        if self.key_stats is None:
+            return
+        skey = stats_key(key, known_prefixes())
+        st = self.key_stats.setdefault(skey, {
+            'reads': 0, 'writes': 0, 'bytes': 0, 'time': 0,
+        })
+        st['reads'] += reads
+        st['writes'] += writes
+        st['bytes'] += size
+        st['time'] += spent
+
+    def load(self):
+        """
+        Fetch all the known keys at once if not done yet.
+        """
+        if self.values is None:
+            self.keys = set(known_keys())
+            self.prefixes = known_prefixes()
+            start = time.monotonic()
+            with trace.span('kv', 'load') as sp:
+                self.values = load_keys(self.db, known_keys(), self.prefixes)
+                sp.set_result(len(self.values))
+            self.record('-load', reads=1, spent=time.monotonic() - start)
+
+    def cached(self, key):
+        """
+        Check whether the specified key is handled by the cache.
+        """
+        self.load()
+        return key in self.keys or \
+            bool([p for p in self.prefixes if key.startswith(p)])
+
+    def get(self, key, default=None, shared=False):
+        """
+        Get the value for the specified key with a fallback default;
+        if shared is true, return the cached object itself, which must
+        not be modified.
+        """
+        if not self.cached(key):
+            self.misses += 1
+            start = time.monotonic()
+            with trace.span('kv', 'get', key=key):
+                value = self.db.get(key, default)
+            self.record(key, reads=1, spent=time.monotonic() - start)
+            return value
+
+        self.hits += 1
+        self.record(key, reads=1)
+        value = self.values.get(key, ABSENT)
+        if value is ABSENT:
+            return default
+        return value if shared else copy.deepcopy(value)
+
+    def getrange(self, prefix, shared=False):
+        """
+        Get all the keys starting with the specified prefix as a dictionary;
+        if shared is true, the values are the cached objects themselves,
+        which must not be modified.
+        """
+        self.load()
+        self.record(prefix, reads=1)
+        if [p for p in self.prefixes if prefix.startswith(p)]:
+            self.hits += 1
+        else:
+            self.misses += 1
+            for (key, value) in self.db.getrange(prefix).items():
+                if key not in self.values:
+                    self.values[key] = value
+            self.prefixes.append(prefix)
+        return dict([(key, value if shared else copy.deepcopy(value))
+                     for (key, value) in self.values.items()
+                     if key.startswith(prefix) and value is not ABSENT])
+
+    def set(self, key, value):
+        """
+        Set the value for the specified key, write it out later.
+        """
+        if not self.cached(key):
+            self.db.set(key, value)
+            return value
+        self.values[key] = copy.deepcopy(value)
+        self.dirty.add(key)
+        hookexit.register('kvcache', flush, hookexit.PRIO_STORE)
+        return value
+
+    def unset(self, key):
+        """
+        Remove the specified key, write it out later.
+        """
+        if not self.cached(key):
+            self.db.unset(key)
+            return
+        self.values[key] = ABSENT
+        self.dirty.add(key)
+        hookexit.register('kvcache', flush, hookexit.PRIO_STORE)
+
+    def flush(self):
+        """
+        Write the modified values to the database.
+        """
+        if not self.dirty:
+            return
+        with trace.span('kv', 'flush', keys=len(self.dirty)):
+            self.write_dirty()
+        self.dirty = set()
+        self.flushes += 1
+
+    def write_dirty(self):
+        """
+        Store each of the modified values into the database.
+        """
+        for key in sorted(self.dirty):
+            value = self.values[key]
+            start = time.monotonic()
+            if value is ABSENT:
+                self.db.unset(key)
+            else:
+                self.db.set(key, value)
+            if self.key_stats is not None:
+                self.record(key, writes=1, spent=time.monotonic() - start,
+                            size=0 if value is ABSENT
+                            else len(json.dumps(value)))
+
+    def stats(self):
+        """
+        Report the cache usage counters.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'flushes': self.flushes,
+            'dirty': len(self.dirty),
+        }
+
+    def key_report(self):
+        """
+        Report the collected per-key statistics along with the size of
+        the data currently stored in the database for each key.
+        """
+        res = dict([(key, dict(st)) for (key, st) in
+                    (self.key_stats or {}).items()])
+        for (key, size) in stored_sizes(self.db, known_keys(),
+                                        known_prefixes()).items():
+            res.setdefault(key, {})['stored'] = size
+        return res
+
+    def dump_stats(self):
+        """
+        Log the per-key statistics.
+        """
+        hookenv.log('spcharms.kvcache key statistics: {report}'
+                    .format(report=json.dumps(self.key_report(),
+                                              sort_keys=True)),
+                    hookenv.DEBUG)
+
+
+def kv():
+    """
+    Get the cache in front of the unit's database.
+    """
+    global cache
+    db = unitdata.kv()
+    if cache is None or cache.db is not db:
+        cache = KVCache(db)
+        if stats_enabled():
+            cache.enable_stats()
+    return cache
+
+
+def shared_get(db, key, default=None):
+    """
+    Get a value from either a cache or a plain database object without
+    copying it if possible; the caller must not modify it.
+    """
+    if isinstance(db, KVCache):
+        return db.get(key, default, shared=True)
+    return db.get(key, default)
+
+
+def shared_getrange(db, prefix):
+    """
+    Get the keys starting with the specified prefix from either a cache or
+    a plain database object without copying the values if possible;
+    the caller must not modify them.
+    """
+    if isinstance(db, KVCache):
+        return db.getrange(prefix, shared=True)
+    return db.getrange(prefix)
+
+
+def flush():
+    """
+    Write the modified values to the unit's database now.
+    """
+    if cache is not None:
+        cache.flush()
+
+
+def reset():
+    """
+    Drop the cached values without writing them out.
+    """
+    global cache
+    cache = None
+    hookexit.unregister('kvcache')
+    hookexit.unregister('kvcache.stats')
+
+
+def stats():
+    """
+    Report the cache usage counters.
+    """
+    return kv().stats()
+
+
+def key_report():
+    """
+    Report the per-key statistics and stored data sizes.
+    """
+    return kv().key_report()
@@ -4,14 +4,28 @@ Constants for use with unitdata.kv().
 """
 
 KEY_OURID = 'storpool-config.our-id'
+KEY_CONFIG_CACHE = 'storpool-config.cache'
+KEY_CONFIG_SNAPSHOT = 'storpool-config.snapshot'
+KEY_CONFIG_DEFAULTS = 'storpool-config.defaults'
+KEY_CONFIG_GROUPS = 'storpool-config.groups'
 
 KEY_MACHINE_ID = 'storpool-helper.machine-id'
 KEY_PARENT_NODE_ID = 'storpool-helper.parent-node-id'
+KEY_ENVIRONMENT = 'storpool-helper.environment'
 KEY_SET_STATES = 'storpool-helper.set-states'
+KEY_SET_STATES_INDEX = 'storpool-helper.set-states-index'
 KEY_META_CONFIG = 'storpool-helper.meta-config'
+KEY_META_CONFIG_HASHES = 'storpool-helper.meta-config-hashes'
+KEY_METRICS = 'storpool-helper.metrics'
 
 KEY_LXD_NAME = 'storpool-openstack-integration.lxd-name'
 
 KEY_PRESENCE = 'storpool-service.state'
+KEY_PRESENCE_VERSION = 'storpool-service.version'
+KEY_PRESENCE_NOTIFIED = 'storpool-service.notified'
+KEY_PRESENCE_SENT = 'storpool-service.sent'
+KEY_PRESENCE_AGGREGATE = 'storpool-service.aggregate'
+PREFIX_PRESENCE_ROW = 'storpool-service.conv.'
 
 KEY_SPSTATUS = 'storpool-utils.persistent-status'
+KEY_SPSTATUS_HISTORY = 'storpool-utils.status-history'
@@ -0,0 +1,109 @@
+"""
+A StorPool Juju charm helper module: remember the results of the hook
+environment lookups and the charm metadata lookups that do not change
+during a single hook.
+
+The cached values are dropped when the hook exits; invalidate() may be
+used to drop them earlier, e.g. after changing the relations.
+For each function, the lookups served from the cache ("hits") and
+the calls passed on to charmhelpers ("misses") are counted.  Note that
+charmhelpers itself caches the results of config(), relation_ids(),
+charm_name(), and metadata() for the whole process, so a miss does not
+necessarily mean that a hook tool was actually run.
+"""
+import os
+
+from charmhelpers.core import hookenv
+
+from spcharms import hookexit
+from spcharms import trace
+
+cache = {}
+counters = {}
+
+
+def memoize(name, func, *args):
+    """
+    Invoke the function with the specified arguments unless its result
+    has already been cached during this hook.
+    """
+    key = (name,) + args
+    cnt = counters.setdefault(name, {'hits': 0, 'misses': 0})
+    if key in cache:
+        cnt['hits'] += 1
+        return cache[key]
+
+    cnt['misses'] += 1
+    with trace.span('hookenv', name, args=list(args)):
+        res = func(*args)
+    cache[key] = res
+    hookexit.register('memo', invalidate, hookexit.PRIO_LAST)
+    return res
+
+
+def invalidate(name=None):
+    """
+    Forget the cached results of the specified function or of all of them.
+    """
+    if name is None:
+        cache.clear()
+        return
+    for key in [key for key in cache.keys() if key[0] == name]:
+        del cache[key]
+
+
+def stats():
+    """
+    Report the number of cache hits and misses (calls passed on to
+    charmhelpers, not necessarily hook tool invocations) for each function.
+    """
+    return dict([(name, dict(cnt)) for (name, cnt) in counters.items()])
+
+
+def reset():
+    """
+    Forget the cached results and reset the counters.
+    """
+    invalidate()
+    counters.clear()
+    hookexit.unregister('memo')
+
+
+def charm_name():
+    """
+    Get the name of the charm.
+    """
+    return memoize('charm_name', hookenv.charm_name)
+
+
+def config():
+    """
+    Get the charm configuration.
+    """
+    return memoize('config', hookenv.config)
+
+
+def hook_option(name, default=None):
+    """
+    Get the value of a charm configuration option, but only when running
+    within a Juju hook; return the default otherwise, e.g. when imported
+    by the unit tests or the benchmarks.
+    """
+    if 'JUJU_UNIT_NAME' not in os.environ:
+        return default
+    cfg = config()
+    return default if cfg is None else cfg.get(name, default)
+
+
+def relation_ids(reltype):
+    """
+    Get the identifiers of the relations of the specified type.
+    """
+    return memoize('relation_ids', hookenv.relation_ids, reltype)
+
+
+def execution_environment():
+    """
+    Get the hook's execution environment.
+    """
+    return memoize('execution_environment', hookenv.execution_environment)
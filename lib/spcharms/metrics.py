@@ -0,0 +1,279 @@
+"""
+A StorPool Juju charm helper module: maintain counters, gauges and
+histograms about the charm's operation and export them for
+the node_exporter textfile collector.
+
+The values are kept in the unit's database between hooks.  If
+the storpool_metrics_dir charm configuration option specifies
+a directory, each hook stores the unit's metrics in a separate JSON file
+there when it exits, and then regenerates a single .prom file from
+the files of all the StorPool units on the node under an exclusive lock.
+Every series carries a "unit" label, so the co-located units do not
+overwrite each other's values.
+"""
+import fcntl
+import glob
+import json
+import os
+import time
+
+from charmhelpers.core import hookenv
+
+from spcharms import hookexit
+from spcharms import kvcache
+from spcharms import kvdata
+from spcharms import memo
+from spcharms import trace
+
+PROM_FILE = 'storpool-charms.prom'
+LOCK_FILE = 'storpool-charms.lock'
+UNIT_FILE_PATTERN = 'storpool-charms.unit.{unit}.json'
+
+DURATION_BUCKETS = [0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600]
+
+METRICS = {
+    'storpool_charm_hooks_total': (
+        'counter', 'The number of hooks run.'),
+    'storpool_charm_hook_duration_seconds': (
+        'histogram', 'The time spent running the hooks.'),
+    'storpool_charm_subprocesses_total': (
+        'counter', 'The number of external commands run.'),
+    'storpool_charm_packages_installed_total': (
+        'counter', 'The number of packages installed or upgraded.'),
+    'storpool_charm_packages_removed_total': (
+        'counter', 'The number of packages removed.'),
+    'storpool_charm_containers_synced_total': (
+        'counter', 'The number of times packages were copied into '
+                   'an LXD container.'),
+    'storpool_charm_files_copied_total': (
+        'counter', 'The number of files copied into LXD containers.'),
+    'storpool_charm_presence_nodes': (
+        'gauge', 'The number of nodes reported as present.'),
+}
+
+directory = None
+data = None
+
+
+def enabled():
+    """
+    Check whether the storpool_metrics_dir option asks for the metrics
+    to be exported; the answer is kept for the rest of the process.
+    """
+    global directory
+    if directory is None:
+        directory = memo.hook_option('storpool_metrics_dir', '') or ''
+        if directory:
+            hookexit.register('metrics', flush, hookexit.PRIO_DEFAULT)
+    return bool(directory)
+
+
+def enable(path):
+    """
+    Export the metrics to the specified directory even if
+    storpool_metrics_dir is not set, e.g. for the benchmarks.
+    """
+    global directory
+    directory = path
+    hookexit.register('metrics', flush, hookexit.PRIO_DEFAULT)
+
+
+def series(name, labels):
+    """
+    Build the name of a time series with the specified labels.
+    """
+    if not labels:
+        return name
+    return '{name}{{{labels}}}'.format(
+        name=name,
+        labels=','.join(['{k}="{v}"'.format(
+            k=key,
+            v=str(value).replace('\\', '\\\\').replace('"', '\\"')
+                        .replace('\n', '\\n'))
+            for (key, value) in sorted(labels.items())]))
+
+
+def get_data():
+    """
+    Fetch the current values of the metrics.
+    """
+    global data
+    if data is None:
+        data = kvcache.kv().get(kvdata.KEY_METRICS, None) or {
+            'counters': {},
+            'gauges': {},
+            'histograms': {},
+        }
+    return data
+
+
+def inc(name, value=1, **labels):
+    """
+    Increment a counter.
+    """
+    if not enabled():
+        return
+    counters = get_data()['counters'].setdefault(name, {})
+    key = series(name, labels)
+    counters[key] = counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    """
+    Set the value of a gauge.
+    """
+    if not enabled():
+        return
+    get_data()['gauges'].setdefault(name, {})[series(name, labels)] = value
+
+
+def observe(name, value, buckets=DURATION_BUCKETS, **labels):
+    """
+    Record a value in a histogram.
+    """
+    if not enabled():
+        return
+    hists = get_data()['histograms'].setdefault(name, {})
+    hist = hists.setdefault(json.dumps(labels, sort_keys=True), {
+        'labels': labels,
+        'buckets': list(buckets),
+        'counts': [0] * len(buckets),
+        'count': 0,
+        'sum': 0,
+    })
+    for (idx, limit) in enumerate(hist['buckets']):
+        if value <= limit:
+            hist['counts'][idx] += 1
+    hist['count'] += 1
+    hist['sum'] += value
+
+
+def format_number(value):
+    """
+    Format a metric value.
+    """
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(data, unit):
+    """
+    Render the metrics of a single unit in the Prometheus text format,
+    grouped by metric name.
+    """
+    res = {}
+    for (kind, values) in (('counter', data['counters']),
+                           ('gauge', data['gauges'])):
+        for (name, entries) in values.items():
+            lines = res.setdefault(name, [])
+            for (key, value) in sorted(entries.items()):
+                labels = 'unit="{unit}"'.format(unit=unit)
+                if key.endswith('}'):
+                    key = key[:-1] + ',' + labels + '}'
+                else:
+                    key = key + '{' + labels + '}'
+                lines.append('{key} {value}'
+                             .format(key=key, value=format_number(value)))
+
+    for (name, hists) in data['histograms'].items():
+        lines = res.setdefault(name, [])
+        for hkey in sorted(hists.keys()):
+            hist = hists[hkey]
+            labels = dict(hist['labels'], unit=unit)
+            for (limit, count) in zip(hist['buckets'], hist['counts']):
+                lines.append('{key} {count}'.format(
+                    key=series(name + '_bucket',
+                               dict(labels, le=format_number(limit))),
+                    count=count))
+            lines.append('{key} {count}'.format(
+                key=series(name + '_bucket', dict(labels, le='+Inf')),
+                count=hist['count']))
+            lines.append('{key} {value}'.format(
+                key=series(name + '_sum', labels),
+                value=format_number(hist['sum'])))
+            lines.append('{key} {count}'.format(
+                key=series(name + '_count', labels), count=hist['count']))
+    return res
+
+
+def merge(rendered):
+    """
+    Combine the rendered metrics of several units into a single
+    Prometheus text format document.
+    """
+    names = {}
+    for unit_lines in rendered:
+        for (name, lines) in unit_lines.items():
+            names.setdefault(name, []).extend(lines)
+    res = []
+    for name in sorted(names.keys()):
+        (kind, help_text) = METRICS.get(name, ('untyped', name))
+        res.append('# HELP {name} {help}'.format(name=name, help=help_text))
+        res.append('# TYPE {name} {kind}'.format(name=name, kind=kind))
+        res.extend(names[name])
+    return ''.join([line + '\n' for line in res])
+
+
+def write_atomically(path, contents):
+    """
+    Replace a file's contents so that readers never see a partial file.
+    """
+    tmp = '{path}.{pid}.tmp'.format(path=path, pid=os.getpid())
+    with open(tmp, mode='w') as f:
+        f.write(contents)
+    os.rename(tmp, path)
+
+
+def export(unit=None):
+    """
+    Store the metrics of the current unit and regenerate the .prom file
+    from the metrics of all the units on this node.
+    """
+    if unit is None:
+        unit = hookenv.local_unit()
+    os.makedirs(directory, mode=0o755, exist_ok=True)
+    with open(os.path.join(directory, LOCK_FILE), mode='a') as lockf:
+        fcntl.lockf(lockf, fcntl.LOCK_EX)
+        write_atomically(
+            os.path.join(directory, UNIT_FILE_PATTERN.format(
+                unit=unit.replace('/', '-'))),
+            json.dumps(render(get_data(), unit), sort_keys=True))
+
+        rendered = []
+        for fname in sorted(glob.glob(os.path.join(
+                directory, UNIT_FILE_PATTERN.format(unit='*')))):
+            try:
+                with open(fname, mode='r') as f:
+                    rendered.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        write_atomically(os.path.join(directory, PROM_FILE),
+                         merge(rendered))
+
+
+def flush():
+    """
+    Record the hook's duration and the external commands it ran, store
+    the metrics and export them.
+    """
+    if not enabled():
+        return
+    hook = hookenv.hook_name()
+    inc('storpool_charm_hooks_total', hook=hook)
+    observe('storpool_charm_hook_duration_seconds',
+            time.monotonic() - trace.process_start_mono, hook=hook)
+    for (command, count) in sorted(trace.exec_counts.items()):
+        inc('storpool_charm_subprocesses_total', count, command=command)
+    trace.exec_counts.clear()
+    kvcache.kv().set(kvdata.KEY_METRICS, get_data())
+    export()
+
+
+def reset():
+    """
+    Forget the cached values and re-read the configuration.
+    """
+    global directory
+    global data
+    directory = None
+    data = None
+    hookexit.unregister('metrics')
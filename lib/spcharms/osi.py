@@ -8,6 +8,8 @@ from spcharms import kvdata
 
 def lxd_cinder_name():
     """
-    Get the previously cached name of the local Cinder LXD container.
+    Get the previously cached name of the local Cinder LXD container;
+    the storpool-openstack-integration charm stores it directly in
+    the unit's database.
     """
     return unitdata.kv().get(kvdata.KEY_LXD_NAME, default=None)
@@ -8,7 +8,9 @@ import os
 import re
 import subprocess
 
-from charmhelpers.core import hookenv
+from spcharms import memo
+from spcharms import metrics
+from spcharms import trace
 
 
 class StorPoolRepoException(Exception):
@@ -35,7 +37,8 @@ def apt_pkg_policy(names):
     for pkg in names:
         pres = {}
         bad = False
-        pb = subprocess.check_output(['apt-cache', 'policy', '--', pkg])
+        pb = trace.run(subprocess.check_output,
+                       ['apt-cache', 'policy', '--', pkg])
         for line in pb.decode().split('\n'):
             for pol in re_policy:
                 m = re_policy[pol].match(line)
@@ -101,7 +104,7 @@ def apt_install(pkgs):
     Install the specified packages and return a list of all the packages that
     were installed or upgraded along with them.
     """
-    previous_b = subprocess.check_output([
+    previous_b = trace.run(subprocess.check_output, [
         'dpkg-query', '-W', '--showformat',
         '${Package}\t${Version}\t${Status}\n'
     ])
@@ -118,9 +121,9 @@ def apt_install(pkgs):
 
     cmd = ['apt-get', 'install', '-y', '--no-install-recommends', '--']
     cmd.extend(pkgs)
-    subprocess.check_call(cmd)
+    trace.run(subprocess.check_call, cmd)
 
-    current_b = subprocess.check_output([
+    current_b = trace.run(subprocess.check_output, [
         'dpkg-query', '-W', '--showformat',
         '${Package}\t${Version}\t${Status}\n'
     ])
@@ -142,6 +145,7 @@ def apt_install(pkgs):
     return newly_installed
 
 
+@trace.traced
 def install_packages(requested):
     """
     If any of the specified packages actually need to be installed, do that and
@@ -159,11 +163,13 @@ def install_packages(requested):
         return (err, None)
 
     try:
-        return (None, apt_install(to_install))
+        installed = apt_install(to_install)
     except Exception as e:
         return ('Could not install the "{names}" packages: {e}'
                 .format(names=sorted(to_install), e=e),
                 None)
+    metrics.inc('storpool_charm_packages_installed_total', len(installed))
+    return (None, installed)
 
 
 def charm_install_list_file():
@@ -189,12 +195,13 @@ def charm_install_list_file():
 # }
 
 
+@trace.traced
 def record_packages(layer_name, names, charm_name=None):
     """
     Record the list of packages installed by the current unit's layer.
     """
     if charm_name is None:
-        charm_name = hookenv.charm_name()
+        charm_name = memo.charm_name()
 
     if not os.path.isdir('/var/lib/storpool'):
         os.mkdir('/var/lib/storpool', mode=0o700)
@@ -235,6 +242,7 @@ def record_packages(layer_name, names, charm_name=None):
         listf.truncate()
 
 
+@trace.traced
 def unrecord_packages(layer_name, charm_name=None):
     """
     Remove the packages installed by the specified unit's layer from
@@ -242,7 +250,7 @@ def unrecord_packages(layer_name, charm_name=None):
     Uninstall those of them are not wanted by any other unit's layer.
     """
     if charm_name is None:
-        charm_name = hookenv.charm_name()
+        charm_name = memo.charm_name()
 
     try:
         with open(charm_install_list_file(), mode='r+t') as listf:
@@ -289,21 +297,24 @@ def unrecord_packages(layer_name, charm_name=None):
                 # Sigh... don't we just love special cases...
                 pkgs = set(['libwww-perl', 'liblwp-protocol-https-perl'])
                 if pkgs.issubset(try_remove):
-                    if subprocess.call(['dpkg', '-r', '--dry-run', '--'] +
-                                       list(pkgs),
-                                       stdout=subprocess.PIPE,
-                                       stderr=subprocess.PIPE) == 0:
-                        subprocess.call(['dpkg', '--purge', '--'] + list(pkgs))
+                    if trace.run(subprocess.call,
+                                 ['dpkg', '-r', '--dry-run', '--'] +
+                                 list(pkgs),
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE) == 0:
+                        trace.run(subprocess.call,
+                                  ['dpkg', '--purge', '--'] + list(pkgs))
                         removed_now = removed_now.union(pkgs)
                         changed = True
 
                 # Now go for them all
                 for pkg in try_remove:
-                    if subprocess.call(['dpkg', '-r', '--dry-run', '--', pkg],
-                                       stdout=subprocess.PIPE,
-                                       stderr=subprocess.PIPE) != 0:
+                    if trace.run(subprocess.call,
+                                 ['dpkg', '-r', '--dry-run', '--', pkg],
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE) != 0:
                         continue
-                    subprocess.call(['dpkg', '--purge', '--', pkg])
+                    trace.run(subprocess.call, ['dpkg', '--purge', '--', pkg])
                     removed_now.add(pkg)
                     changed = True
 
@@ -314,6 +325,7 @@ def unrecord_packages(layer_name, charm_name=None):
                     break
             data['packages']['remove'] = \
                 list(sorted(try_remove.difference(removed)))
+            metrics.inc('storpool_charm_packages_removed_total', len(removed))
 
             # Let's write it back again if needed
             if changed:
@@ -328,7 +340,8 @@ def list_package_files(name):
     """
     List the files installed by the specified package.
     """
-    files_b = subprocess.check_output(['dpkg', '-L', '--', name])
+    files_b = trace.run(subprocess.check_output,
+                        ['dpkg', '-L', '--', name])
     return sorted(filter(
         lambda s: len(s) > 0,
         files_b.decode().split('\n')
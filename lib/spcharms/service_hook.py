@@ -2,14 +2,52 @@
 A StorPool Juju charms helper module that keeps track of peer units of
 the same charm so that the state may be reported to other charms.
 """
+import base64
+import hashlib
 import json
+import time
+import zlib
 
 from charms import reactive
 from charms.reactive import helpers
 
-from charmhelpers.core import hookenv, unitdata
+from charmhelpers.core import hookenv
 
+from spcharms import hookexit
+from spcharms import kvcache
 from spcharms import kvdata
+from spcharms import memo
+from spcharms import metrics
+from spcharms import trace
+from spcharms import utils as sputils
+
+# The ways to encode our part of the presence state sent to the peers:
+# - "json": a JSON object mapping node names to values (the default; all
+#   versions of this module understand it)
+# - "compact": a JSON object with a sorted table of the node names,
+#   a bitmap of the ones present, and any non-boolean values separately
+# - "compact-zlib": the same, compressed
+# The compact encodings should only be used once all the units of
+# the charm run a version of this module that can decode them.
+ENCODING_JSON = 'json'
+ENCODING_COMPACT = 'compact'
+ENCODING_COMPACT_ZLIB = 'compact-zlib'
+
+# The key that marks an encoded payload; no node name starts with a dash.
+ENCODING_KEY = '-encoding'
+
+# Only update a conversation's last-seen timestamp this often if
+# the data has not changed.
+SEEN_GRANULARITY = 3600
+
+# The number of removed nodes that get_present_changes() can report.
+MAX_REMOVED = 1000
+
+# The prefix of the keys of the conversations of the charms.reactive
+# relation classes; the scope (e.g. a unit name) follows.
+CONVERSATION_PREFIX = 'reactive.conversations.'
+
+pending_broadcasts = {}
 
 
 def init_state():
@@ -19,32 +57,234 @@ def init_state():
     return {'-local': {}}
 
 
+def nodes_hash(nodes):
+    """
+    Compute a hash of a conversation's node map for change detection.
+    """
+    return hashlib.sha256(json.dumps(nodes, sort_keys=True).encode()) \
+        .hexdigest()
+
+
+def stored_rows(db):
+    """
+    Fetch the stored per-conversation rows as a dictionary keyed by
+    conversation; the rows must not be modified.
+    """
+    prefix = kvdata.PREFIX_PRESENCE_ROW
+    return dict([(key[len(prefix):], row) for (key, row) in
+                 kvcache.shared_getrange(db, prefix).items()])
+
+
+def get_rows(db):
+    """
+    Fetch the stored per-conversation rows as a dictionary keyed by
+    conversation.  Convert the state stored as a single value by
+    earlier versions if needed.
+    """
+    legacy = db.get(kvdata.KEY_PRESENCE, default=None)
+    if legacy is not None:
+        db.unset(kvdata.KEY_PRESENCE)
+        for (key, nodes) in legacy.items():
+            set_row(db, key, nodes)
+    return stored_rows(db)
+
+
+def merge_node(rows, name):
+    """
+    Compute the aggregate presence of a single node over all
+    the conversations: the value reported as present by the last one in
+    sorted order (or False if none) and the number of conversations that
+    report it as present.
+    Return None if no conversation mentions the node at all.
+    """
+    value = None
+    count = 0
+    for key in sorted(rows.keys()):
+        nodes = rows[key]['nodes']
+        if name not in nodes:
+            continue
+        if nodes[name]:
+            value = nodes[name]
+            count += 1
+        elif value is None:
+            value = False
+    if value is None:
+        return None
+    return (value, count)
+
+
+def build_aggregate(db):
+    """
+    Compute the aggregate presence of all the nodes from the stored rows:
+    the merged value, the number of conversations that report each node
+    as present, the number of conversations that mention it at all, and
+    (if not zero) the number of conversations that report it as present
+    with a value other than True.
+    """
+    version = db.get(kvdata.KEY_PRESENCE_VERSION, default=0)
+    rows = stored_rows(db)
+    agg = {'version': version, 'values': {}, 'counts': {}, 'mentions': {},
+           'special': {}, 'versions': {}, 'removed': {}}
+    for key in sorted(rows.keys()):
+        for (name, value) in rows[key]['nodes'].items():
+            agg['mentions'][name] = agg['mentions'].get(name, 0) + 1
+            if value:
+                agg['values'][name] = value
+                agg['counts'][name] = agg['counts'].get(name, 0) + 1
+                if value is not True:
+                    agg['special'][name] = agg['special'].get(name, 0) + 1
+            else:
+                agg['values'].setdefault(name, False)
+                agg['counts'].setdefault(name, 0)
+            agg['versions'][name] = version
+    return agg
+
+
+def get_aggregate(db):
+    """
+    Fetch the aggregate presence of all the nodes, build it if needed.
+    """
+    agg = db.get(kvdata.KEY_PRESENCE_AGGREGATE, default=None)
+    if agg is None:
+        get_rows(db)
+        agg = build_aggregate(db)
+        db.set(kvdata.KEY_PRESENCE_AGGREGATE, agg)
+    return agg
+
+
+def update_aggregate(db, version, old_nodes, new_nodes):
+    """
+    Update the aggregate presence of the nodes that a single
+    conversation's change affects.  The stored rows are only examined
+    to recompute the value of a node that is still reported as present
+    with a value other than True by any conversation, so that the result
+    is the same as the one of build_aggregate().
+    """
+    agg = db.get(kvdata.KEY_PRESENCE_AGGREGATE, default=None)
+    if agg is None:
+        db.set(kvdata.KEY_PRESENCE_AGGREGATE, build_aggregate(db))
+        return
+
+    names = [name for name in set(old_nodes.keys()).union(new_nodes.keys())
+             if name not in old_nodes or name not in new_nodes or
+             old_nodes[name] != new_nodes[name]]
+    if not names:
+        return
+    rows = None
+    for name in names:
+        (had, has) = (name in old_nodes, name in new_nodes)
+        (old, new) = (old_nodes.get(name), new_nodes.get(name))
+        mentions = agg['mentions'].get(name, 0) - int(had) + int(has)
+        if mentions == 0:
+            if name in agg['values']:
+                for field in ('values', 'counts', 'mentions', 'versions'):
+                    del agg[field][name]
+                agg['special'].pop(name, None)
+                agg['removed'][name] = version
+            continue
+
+        count = agg['counts'].get(name, 0) - int(had and bool(old)) + \
+            int(has and bool(new))
+        special = agg['special'].get(name, 0) - \
+            int(had and bool(old) and old is not True) + \
+            int(has and bool(new) and new is not True)
+        if special == 0:
+            value = count > 0
+        else:
+            if rows is None:
+                rows = stored_rows(db)
+            (value, count) = merge_node(rows, name)
+
+        agg['mentions'][name] = mentions
+        if special:
+            agg['special'][name] = special
+        else:
+            agg['special'].pop(name, None)
+        if name not in agg['values'] or \
+           (agg['values'][name], agg['counts'][name]) != (value, count):
+            agg['values'][name] = value
+            agg['counts'][name] = count
+            agg['versions'][name] = version
+            agg['removed'].pop(name, None)
+    agg['version'] = version
+    db.set(kvdata.KEY_PRESENCE_AGGREGATE, agg)
+
+
+def set_row(db, key, nodes):
+    """
+    Store the node map of a single conversation if it has changed; bump
+    the version of both the row and the whole presence state.
+    If it has not changed, only update the row's last-seen timestamp if
+    it is too old.
+    Return a boolean value indicating whether the node map was written.
+    """
+    row_key = kvdata.PREFIX_PRESENCE_ROW + key
+    row = db.get(row_key, default=None)
+    digest = nodes_hash(nodes)
+    now = int(time.time())
+    if row is not None and row['hash'] == digest:
+        if row.get('seen', 0) + SEEN_GRANULARITY <= now:
+            row['seen'] = now
+            db.set(row_key, row)
+        return False
+
+    version = db.get(kvdata.KEY_PRESENCE_VERSION, default=0) + 1
+    db.set(kvdata.KEY_PRESENCE_VERSION, version)
+    db.set(row_key, {'version': version, 'hash': digest, 'seen': now,
+                     'nodes': dict(nodes)})
+    update_aggregate(db, version, row['nodes'] if row is not None else {},
+                     nodes)
+    return True
+
+
+def del_row(db, key):
+    """
+    Remove a single conversation's row if it has been stored.
+    Return a boolean value indicating whether anything was removed.
+    """
+    row_key = kvdata.PREFIX_PRESENCE_ROW + key
+    row = db.get(row_key, default=None)
+    if row is None:
+        return False
+
+    version = db.get(kvdata.KEY_PRESENCE_VERSION, default=0) + 1
+    db.set(kvdata.KEY_PRESENCE_VERSION, version)
+    db.unset(row_key)
+    update_aggregate(db, version, row['nodes'], {})
+    return True
+
+
 def get_state(db=None):
     """
     Fetch the cached state or, if none, initialize it anew.
     """
     if db is None:
-        db = unitdata.kv()
-    state = db.get(kvdata.KEY_PRESENCE, default=None)
-    if state is None:
-        state = init_state()
-        changed = True
-    else:
-        changed = False
-    return (state, changed)
+        db = kvcache.kv()
+    rows = get_rows(db)
+    if not rows:
+        return (init_state(), True)
+
+    state = dict([(key, dict(row['nodes'])) for (key, row) in rows.items()])
+    if '-local' not in state:
+        state['-local'] = {}
+    return (state, False)
 
 
 def set_state(db, state):
     """
-    Cache the current presence state in the unit's persistent storage.
+    Cache the current presence state in the unit's persistent storage,
+    only writing out the conversations that have changed.
     """
-    db.set(kvdata.KEY_PRESENCE, state)
+    for key in set(get_rows(db).keys()).difference(state.keys()):
+        del_row(db, key)
+    for (key, nodes) in state.items():
+        set_row(db, key, nodes)
 
 
 def update_state(db, state, changed, key, name, value):
     """
     Update the state of a single node in the database and, if it has indeed
-    been changed, store it into the persistent storage.
+    been changed, store the conversation's row into the persistent storage.
     """
     if key not in state:
         state[key] = {}
@@ -54,84 +294,349 @@ def update_state(db, state, changed, key, name, value):
         changed = True
 
     if changed:
-        set_state(db, state)
+        set_row(db, key, state[key])
     return changed
 
 
-def add_present_node(name, value, rel_name, rdebug=lambda s: s):
+def encode_payload(nodes, encoding=ENCODING_JSON):
     """
-    Update a peer's state and send the full structure right back if needed.
+    Encode a node map for sending to the peers.
+    """
+    if encoding == ENCODING_JSON:
+        return json.dumps(nodes, sort_keys=True)
+    elif encoding not in (ENCODING_COMPACT, ENCODING_COMPACT_ZLIB):
+        raise ValueError('Unknown presence encoding "{enc}"'
+                         .format(enc=encoding))
+
+    names = sorted(nodes.keys())
+    bitmap = bytearray((len(names) + 7) // 8)
+    values = {}
+    for (idx, name) in enumerate(names):
+        value = nodes[name]
+        if value is True:
+            bitmap[idx // 8] |= 1 << (idx % 8)
+        elif value is not False:
+            values[str(idx)] = value
+    body = {
+        'names': names,
+        'present': base64.b64encode(bytes(bitmap)).decode(),
+        'values': values,
+    }
+    if encoding == ENCODING_COMPACT:
+        body[ENCODING_KEY] = 1
+        return json.dumps(body, sort_keys=True, separators=(',', ':'))
+
+    packed = zlib.compress(json.dumps(body, sort_keys=True,
+                                      separators=(',', ':')).encode())
+    return json.dumps({ENCODING_KEY: 2,
+                       'data': base64.b64encode(packed).decode()},
+                      sort_keys=True)
+
+
+def decode_payload(data):
     """
-    db = unitdata.kv()
+    Decode a node map received from a peer, either as a string or as
+    an already parsed JSON object, in any of the supported encodings.
+    """
+    if data is None:
+        return None
+    if not isinstance(data, dict):
+        data = json.loads(data)
+    version = data.get(ENCODING_KEY, None)
+    if version is None:
+        return data
+    elif version == 2:
+        data = json.loads(zlib.decompress(base64.b64decode(data['data']))
+                          .decode())
+    elif version != 1:
+        raise ValueError('Unsupported presence encoding version {v}'
+                         .format(v=version))
+
+    names = data['names']
+    bitmap = base64.b64decode(data['present'])
+    values = data['values']
+    res = {}
+    for (idx, name) in enumerate(names):
+        if str(idx) in values:
+            res[name] = values[str(idx)]
+        else:
+            res[name] = bool(bitmap[idx // 8] & (1 << (idx % 8)))
+    return res
+
+
+def no_rdebug(s, *args, **kwargs):
+    """
+    Ignore a diagnostic message if the caller did not supply a function
+    to log it.
+    """
+    pass
+
+
+def debug_logger(rdebug):
+    """
+    Wrap the caller-supplied one-argument diagnostic function so that it
+    may be invoked the same way as spcharms.utils.rdebug().
+    """
+    if rdebug is no_rdebug:
+        return no_rdebug
+
+    def log(s, *args, level='debug', **kwargs):
+        msg = sputils.rdebug_format(s, *args, level=level, **kwargs)
+        if msg is not None:
+            rdebug(msg)
+
+    return log
+
+
+def add_present_node(name, value, rel_name, rdebug=no_rdebug,
+                     encoding=ENCODING_JSON):
+    """
+    Update a peer's state and, if needed, send the full structure right back
+    when the hook exits.
+    """
+    db = kvcache.kv()
     (state, changed) = get_state(db)
     changed = update_state(db, state, changed, '-local', name, value)
     if changed:
-        rdebug('hm, let us then try to fetch the relation ids for {rel_name}'
-               .format(rel_name=rel_name))
-        rel_ids = hookenv.relation_ids(rel_name)
-        rdebug('rel_ids: {rel_ids}'.format(rel_ids=rel_ids))
+        broadcast(rel_name, rdebug=rdebug, encoding=encoding)
+
+
+def broadcast(rel_name, rdebug=no_rdebug, encoding=ENCODING_JSON):
+    """
+    Queue sending our part of the presence state to all the units on
+    the specified relation when the hook exits.
+    """
+    pending_broadcasts[rel_name] = (debug_logger(rdebug), encoding)
+    hookexit.register('service_hook.broadcast', flush_broadcasts,
+                      hookexit.PRIO_EARLY)
+
+
+def flush_broadcasts():
+    """
+    Send our part of the presence state to the relations queued by
+    broadcast(), skipping the ones that it has already been sent to.
+    """
+    db = kvcache.kv()
+    (state, _) = get_state(db)
+    sent = db.get(kvdata.KEY_PRESENCE_SENT, default={})
+    updated = False
+
+    for rel_name in sorted(pending_broadcasts.keys()):
+        (rdebug, encoding) = pending_broadcasts.pop(rel_name)
+        payload = encode_payload(state['-local'], encoding)
+        digest = hashlib.sha256(payload.encode()).hexdigest()
+        rdebug('hm, let us then try to fetch the relation ids for {rel_name}',
+               rel_name=rel_name)
+        rel_ids = memo.relation_ids(rel_name)
+        rdebug('rel_ids: {rel_ids}', rel_ids=rel_ids)
+        rel_sent = sent.get(rel_name, {})
+        new_sent = {}
         for rel_id in rel_ids:
-            rdebug('- trying for {rel_id}'.format(rel_id=rel_id))
-            hookenv.relation_set(rel_id,
-                                 storpool_service=json.dumps(state['-local']))
-            rdebug('  - looks like we managed it for {rel_id}'
-                   .format(rel_id=rel_id))
+            if rel_sent.get(rel_id) == digest:
+                rdebug('- already sent to {rel_id}', rel_id=rel_id)
+            else:
+                rdebug('- trying for {rel_id}', rel_id=rel_id)
+                with trace.span('relation', 'relation-set', rel_id=rel_id,
+                                size=len(payload)):
+                    hookenv.relation_set(rel_id, storpool_service=payload)
+                rdebug('  - looks like we managed it for {rel_id}',
+                       rel_id=rel_id)
+            new_sent[rel_id] = digest
+        if new_sent != rel_sent:
+            sent[rel_name] = new_sent
+            updated = True
         rdebug('that is it for the rel_ids')
 
+    if updated:
+        db.set(kvdata.KEY_PRESENCE_SENT, sent)
+
 
 def get_present_nodes():
     """
     Fetch the current state of the charm's units.
     """
-    (state, _) = get_state()
-    res = {}
-    for arr in state.values():
-        for (key, value) in arr.items():
-            res[key] = value or res.get(key, False)
+    db = kvcache.kv()
+    agg = kvcache.shared_get(db, kvdata.KEY_PRESENCE_AGGREGATE)
+    if agg is None:
+        agg = get_aggregate(db)
+    return dict(agg['values'])
+
+
+def get_present_changes(since):
+    """
+    Fetch the nodes whose aggregate presence has changed after
+    the specified version of the presence state; the ones that are
+    no longer reported at all have a value of None.
+    Return the current version and the changes as a tuple.
+    If gc_state() has forgotten about some of the nodes removed after
+    the specified version, all the nodes are reported instead, and
+    the removed ones may be missing.
+    """
+    agg = get_aggregate(kvcache.kv())
+    if since < agg.get('pruned', 0):
+        since = -1
+    changes = dict([(name, agg['values'][name])
+                    for (name, version) in agg['versions'].items()
+                    if version > since])
+    changes.update([(name, None)
+                    for (name, version) in agg['removed'].items()
+                    if version > since])
+    return (agg['version'], changes)
+
+
+def conversation_key(namespace, scope):
+    """
+    Build the key that charms.reactive stores a conversation under.
+    """
+    return '{prefix}{namespace}.{scope}'.format(prefix=CONVERSATION_PREFIX,
+                                                namespace=namespace,
+                                                scope=scope)
+
+
+def on_relation(key, rel_name):
+    """
+    Check whether a conversation belongs to the specified relation:
+    the global-scope ones are namespaced by the relation name, the unit-
+    and service-scope ones by the relation id.
+    """
+    if not key.startswith(CONVERSATION_PREFIX):
+        return False
+    namespace = key[len(CONVERSATION_PREFIX):].split('.', 1)[0]
+    return namespace == rel_name or namespace.startswith(rel_name + ':')
+
+
+def live_conversations(rel_name):
+    """
+    Get the keys of the conversations that may currently exist on
+    the specified relation.
+    """
+    keys = set([conversation_key(rel_name, 'global')])
+    for rel_id in memo.relation_ids(rel_name):
+        with trace.span('relation', 'related-units', rel_id=rel_id):
+            units = hookenv.related_units(rel_id)
+        for unit in units:
+            keys.add(conversation_key(rel_id, unit))
+            keys.add(conversation_key(rel_id, unit.split('/', 1)[0]))
+    return keys
+
+
+def gc_state(rel_name=None, ttl=None, rdebug=no_rdebug):
+    """
+    Remove the conversations that are no longer active: if a relation name
+    is specified, the ones on that relation that have no matching relation
+    or related unit, and, if a TTL is specified (or configured as
+    storpool_presence_ttl), the ones that have not been seen for that many
+    seconds, unless they are still present on the specified relation.
+    Also limit the number of removed nodes remembered.
+    Return the number of entries removed and the size of their data.
+    """
+    rdebug = debug_logger(rdebug)
+    db = kvcache.kv()
+    if ttl is None:
+        config = memo.config()
+        ttl = config.get('storpool_presence_ttl', 0) \
+            if config is not None else 0
+    now = int(time.time())
+    rows = get_rows(db)
+
+    live = live_conversations(rel_name) if rel_name is not None else set()
+
+    stale = []
+    for (key, row) in rows.items():
+        if key == '-local':
+            continue
+        if rel_name is not None and on_relation(key, rel_name):
+            if key in live:
+                continue
+            rdebug('- conversation {key} is gone', key=key)
+            stale.append(key)
+        elif ttl and row.get('seen', now) + ttl < now:
+            rdebug('- conversation {key} has not been seen for too long',
+                   key=key)
+            stale.append(key)
+
+    res = {'entries': 0, 'bytes': 0}
+    for key in stale:
+        res['entries'] += 1
+        res['bytes'] += len(json.dumps(rows[key]))
+        del_row(db, key)
+
+    agg = get_aggregate(db)
+    if len(agg['removed']) > MAX_REMOVED:
+        removed = sorted(agg['removed'].items(), key=lambda item: item[1])
+        dropped = removed[:len(removed) - MAX_REMOVED]
+        for (name, version) in dropped:
+            del agg['removed'][name]
+        agg['pruned'] = max([version for (_, version) in dropped])
+        res['entries'] += len(dropped)
+        res['bytes'] += len(json.dumps(dict(dropped)))
+        db.set(kvdata.KEY_PRESENCE_AGGREGATE, agg)
+
+    rdebug('- removed {entries} entries, {size} bytes',
+           entries=res['entries'], size=res['bytes'])
     return res
 
 
-def handle(hk, attaching, data, rdebug=lambda s: s):
+@trace.traced
+def handle(hk, attaching, data, rdebug=no_rdebug):
     """
     Handle a state change of the internal hook; update our state if needed.
+    The data may be in any of the encodings supported by decode_payload().
     """
-    rdebug('service_hook.handle for a {t} hook {name}, attaching {attaching}, '
-           'data keys {ks}'
+    rdebug = debug_logger(rdebug)
+    data = decode_payload(data)
+    rdebug(lambda: 'service_hook.handle for a {t} hook {name}, '
+           'attaching {attaching}, data keys {ks}'
            .format(t=type(hk).__name__,
                    name=hk.relation_name,
                    attaching=attaching,
                    ks=sorted(data.keys()) if data is not None else None))
-    db = unitdata.kv()
+    db = kvcache.kv()
     (state, changed) = get_state(db)
-    rdebug('- current state: {state}'.format(state=state))
-    rdebug('- changed even at the start: {changed}'.format(changed=changed))
+    rdebug('- current state: {state}', state=state, level='trace')
+    rdebug('- changed even at the start: {changed}', changed=changed)
 
     key = hk.conversation().key
-    rdebug('- conversation key: {key}'.format(key=key))
+    rdebug('- conversation key: {key}', key=key)
     if attaching:
         rdebug('- attaching: adding new hosts as reported')
+        nodes = dict(state.get(key, {}))
         for (name, value) in data.items():
-            rdebug('  - processing name "{name}" value "{value}"'
-                   .format(name=name, value=value))
-            if update_state(db, state, changed, key, name, value):
+            rdebug('  - processing name "{name}" value "{value}"',
+                   name=name, value=value, level='trace')
+            if nodes.get(name, '') != value:
+                nodes[name] = value
+                changed = True
+        if key in state or nodes:
+            state[key] = nodes
+            if set_row(db, key, nodes):
                 changed = True
-            rdebug('    - changed: {changed}'.format(changed=changed))
+        rdebug('    - changed: {changed}', changed=changed)
     else:
         if key in state:
             rdebug('- detaching: the conversation has been recorded, '
                    'removing it')
             del state[key]
             changed = True
-            set_state(db, state)
+            del_row(db, key)
         else:
             rdebug('- detaching, but we had no idea we were having '
                    'this conversation, so nah')
 
     if changed:
-        rdebug('- updated state: {state}'.format(state=state))
+        rdebug('- updated state: {state}', state=state, level='trace')
 
-    if changed or helpers.data_changed(kvdata.KEY_PRESENCE, state) or \
+    # Has anything changed since the last time we notified the handlers,
+    # possibly in another hook?
+    version = db.get(kvdata.KEY_PRESENCE_VERSION, default=0)
+    notified = db.get(kvdata.KEY_PRESENCE_NOTIFIED, default=None)
+    if changed or version != notified or \
        not helpers.is_state('storpool-service.changed'):
         rdebug('- something changed, notifying whomever should care')
         reactive.set_state('storpool-service.change')
+        db.set(kvdata.KEY_PRESENCE_NOTIFIED, version)
+    if metrics.enabled():
+        metrics.set_gauge('storpool_charm_presence_nodes',
+                          len(get_aggregate(db)['values']),
+                          relation=hk.relation_name)
     return changed
@@ -5,8 +5,9 @@ signals e.g. a hook firing.
 """
 
 from charms import reactive
-from charmhelpers.core import unitdata
+from charms.reactive import helpers
 
+from spcharms import kvcache
 from spcharms import kvdata
 from spcharms import utils as sputils
 
@@ -15,14 +16,64 @@ def get_registered():
     """
     Fetch the big table of states to set and reset.
     """
-    return unitdata.kv().get(kvdata.KEY_SET_STATES, {})
+    return kvcache.kv().get(kvdata.KEY_SET_STATES, {})
 
 
 def set_registered(data):
     """
-    Store the big table of states to set and reset.
+    Store the big table of states to set and reset along with
+    the per-event index built from it.
     """
-    unitdata.kv().set(kvdata.KEY_SET_STATES, data)
+    kv = kvcache.kv()
+    kv.set(kvdata.KEY_SET_STATES, data)
+    kv.set(kvdata.KEY_SET_STATES_INDEX, build_index(data))
+
+
+def build_index(data):
+    """
+    Combine the states that all the registered layers want set and unset
+    for each event.  The layers are processed in the order of their names,
+    so that the last one wins if they disagree about a state; within
+    a single layer's definition, unsetting a state wins over setting it.
+    """
+    index = {}
+    if not isinstance(data, dict):
+        return index
+    for layer in sorted(data.keys()):
+        states = data[layer]
+        if not isinstance(states, dict):
+            continue
+        for (event, actions) in states.items():
+            entry = index.setdefault(event, {'states': {}, 'errors': []})
+            entry['errors'].extend(sorted([key for key in actions.keys()
+                                           if key not in ('set', 'unset')]))
+            for state in actions.get('set', []):
+                entry['states'][state] = True
+            for state in actions.get('unset', []):
+                entry['states'][state] = False
+
+    return dict([
+        (event, {
+            'set': sorted([state for (state, value) in
+                           entry['states'].items() if value]),
+            'unset': sorted([state for (state, value) in
+                             entry['states'].items() if not value]),
+            'errors': entry['errors'],
+        })
+        for (event, entry) in index.items()])
+
+
+def get_index():
+    """
+    Fetch the per-event index of states to set and reset; build it if
+    the table was stored by an earlier version of this module.
+    """
+    kv = kvcache.kv()
+    index = kv.get(kvdata.KEY_SET_STATES_INDEX, None)
+    if index is None:
+        index = build_index(get_registered())
+        kv.set(kvdata.KEY_SET_STATES_INDEX, index)
+    return index
 
 
 def register(layer, states):
@@ -62,13 +113,42 @@ def handle_single(data):
             return
 
 
+def apply_states(set_states, unset_states):
+    """
+    Set and unset the specified states.
+    """
+    for state in set_states:
+        reactive.set_state(state)
+    for state in unset_states:
+        reactive.remove_state(state)
+
+
 def handle_event(event):
     """
     Set or reset states for all the registered layers that
     handle the specified event.
     """
-    for (_, states) in get_registered().items():
-        data = states.get(event, None)
-        if data is None:
+    handle_events([event])
+
+
+def handle_events(events):
+    """
+    Set or reset states for all the registered layers that handle
+    the specified events as if they had been processed in order, but
+    only change the states that end up different from their current value.
+    """
+    index = get_index()
+    final = {}
+    for event in events:
+        entry = index.get(event, None)
+        if entry is None:
             continue
-        handle_single(data)
+        for key in entry['errors']:
+            sputils.err('Invalid states array key: "{key}"'.format(key=key))
+        final.update([(state, True) for state in entry['set']])
+        final.update([(state, False) for state in entry['unset']])
+
+    apply_states(sorted([state for (state, value) in final.items()
+                         if value and not helpers.is_state(state)]),
+                 sorted([state for (state, value) in final.items()
+                         if not value and helpers.is_state(state)]))
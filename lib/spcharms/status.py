@@ -1,17 +1,64 @@
 """
 A StorPool Juju charm helper module: persistent unit status message.
+
+The unit status is not published right away; the last one requested
+during the hook is sent to Juju when the hook exits or when flush() is
+invoked, and only if it differs from the one that the unit currently
+has, whoever set that.  If something else sets the unit's status
+directly after the first one was queued, the queued one is dropped.
+All the requested changes are also recorded in a bounded history along
+with their wall-clock and monotonic timestamps, so that the time spent
+in each status may be examined later.
 """
 
-from charmhelpers.core import hookenv, unitdata
+import json
+import time
+
+from charmhelpers.core import hookenv
 
+from spcharms import hookexit
+from spcharms import kvcache
 from spcharms import kvdata
 
+HISTORY_SIZE = 200
+
+pending = None
+
+
+def publish(status, msg, recorded=None):
+    """
+    Queue the unit's status to be published when the hook exits;
+    record it in the history, possibly as a different status (e.g. "error").
+    """
+    global pending
+    record(recorded if recorded is not None else status, msg)
+    seen = list(hookenv.status_get()) if pending is None else pending[2]
+    pending = (status, msg, seen)
+    hookexit.register('status', flush, hookexit.PRIO_EARLY)
+
+
+def flush():
+    """
+    Publish the queued unit status now unless the unit already has
+    the same status and message, or unless the unit's status has been
+    changed directly since the first one was queued.
+    """
+    global pending
+    if pending is None:
+        return
+    (status, msg, seen) = pending
+    pending = None
+    current = list(hookenv.status_get())
+    if current == [status, msg] or current != seen:
+        return
+    hookenv.status_set(status, msg)
+
 
 def get():
     """
     Get the persistent status as a (status, message) tuple or None.
     """
-    st = unitdata.kv().get(kvdata.KEY_SPSTATUS, default=None)
+    st = kvcache.kv().get(kvdata.KEY_SPSTATUS, default=None)
     if st is None:
         return None
     return st.split(':', 1)
@@ -25,15 +72,16 @@ def set(status, msg):
     error (see the `reset_unless_error()` function below); the unit status
     itself is set to "maintenance" instead.
     """
-    hookenv.status_set(status if status != 'error' else 'maintenance', msg)
-    unitdata.kv().set(kvdata.KEY_SPSTATUS, status + ':' + msg)
+    publish(status if status != 'error' else 'maintenance', msg,
+            recorded=status)
+    kvcache.kv().set(kvdata.KEY_SPSTATUS, status + ':' + msg)
 
 
 def reset():
     """
     Remove a persistent status.
     """
-    unitdata.kv().unset(kvdata.KEY_SPSTATUS)
+    kvcache.kv().unset(kvdata.KEY_SPSTATUS)
 
 
 def reset_unless_error():
@@ -43,7 +91,7 @@ def reset_unless_error():
     st = get()
     if st is None or st[0] != 'error':
         reset()
-        hookenv.status_set('maintenance', '')
+        publish('maintenance', '')
 
 
 def npset(status, message):
@@ -51,7 +99,7 @@ def npset(status, message):
     Set the unit's status if no persistent status has been set.
     """
     if not get():
-        hookenv.status_set(status, message)
+        publish(status, message)
 
 
 def set_status_reset_handler(name):
@@ -59,7 +107,7 @@ def set_status_reset_handler(name):
     Store the specified layer name as the layer that is allowed to reset
     the status even if a persistent one has been set.
     """
-    unitdata.kv().set(kvdata.KEY_SPSTATUS, name)
+    kvcache.kv().set(kvdata.KEY_SPSTATUS, name)
 
 
 def reset_if_allowed(name):
@@ -67,6 +115,89 @@ def reset_if_allowed(name):
     Reset the persistent status if the layer with the specified name has
     previously been set as the one that is allowed to.
     """
-    stored = unitdata.kv().get(kvdata.KEY_SPSTATUS, '')
+    stored = kvcache.kv().get(kvdata.KEY_SPSTATUS, '')
     if name == stored:
         reset()
+
+
+def record(status, msg):
+    """
+    Add a status transition to the history unless it is the same as
+    the last one; only keep the most recent HISTORY_SIZE entries.
+    """
+    kv = kvcache.kv()
+    hist = kv.get(kvdata.KEY_SPSTATUS_HISTORY, [])
+    if hist and hist[-1][:2] == [status, msg]:
+        return
+    hist.append([status, msg, time.time(), time.monotonic()])
+    kv.set(kvdata.KEY_SPSTATUS_HISTORY, hist[-HISTORY_SIZE:])
+
+
+def history():
+    """
+    Get the recorded status transitions as a list of
+    (status, message, wall-clock time, monotonic time) tuples.
+    """
+    return [tuple(entry) for entry in
+            kvcache.kv().get(kvdata.KEY_SPSTATUS_HISTORY, [])]
+
+
+def durations(now=None):
+    """
+    Get the recorded status transitions along with the number of seconds
+    spent in each of them, up to the next one or to the current time.
+    The monotonic timestamps are used unless the node has been rebooted
+    in the meantime.
+    """
+    if now is None:
+        now = (time.time(), time.monotonic())
+    hist = history()
+    res = []
+    for (idx, (status, msg, wall, mono)) in enumerate(hist):
+        (next_wall, next_mono) = hist[idx + 1][2:] \
+            if idx + 1 < len(hist) else now
+        spent = next_mono - mono if next_mono >= mono and \
+            abs((next_wall - wall) - (next_mono - mono)) < 60 \
+            else next_wall - wall
+        res.append((status, msg, wall, max(spent, 0)))
+    return res
+
+
+def time_in_status(now=None, by_message=False):
+    """
+    Sum up the number of seconds spent in each status or, if requested,
+    in each (status, message) combination.
+    """
+    res = {}
+    for (status, msg, _, spent) in durations(now):
+        key = (status, msg) if by_message else status
+        res[key] = res.get(key, 0) + spent
+    return res
+
+
+def export(path=None, now=None):
+    """
+    Summarize the recorded status history and the time spent in each
+    status and message as a JSON document; write it to the specified
+    file if a path is supplied.
+    """
+    if now is None:
+        now = (time.time(), time.monotonic())
+    data = {
+        'unit': hookenv.local_unit(),
+        'history': [
+            {'status': status, 'message': msg, 'time': wall, 'spent': spent}
+            for (status, msg, wall, spent) in durations(now)
+        ],
+        'status': time_in_status(now),
+        'message': [
+            {'status': status, 'message': msg, 'spent': spent}
+            for ((status, msg), spent) in
+            sorted(time_in_status(now, by_message=True).items())
+        ],
+    }
+    res = json.dumps(data, sort_keys=True)
+    if path is not None:
+        with open(path, mode='w') as f:
+            print(res, file=f)
+    return res
@@ -0,0 +1,202 @@
+"""
+A StorPool Juju charm helper module: record the time spent in
+the external commands, the unit database accesses, the relation
+operations, and the top-level helper functions during a hook.
+
+If the storpool_trace_dir charm configuration option specifies
+a directory, each hook writes a compact JSON trace file there when it
+exits.  Otherwise span() returns a shared no-op object, so the cost of
+the instrumentation is a single check of a module-level variable.
+The external commands are counted even if tracing is disabled.
+"""
+import functools
+import json
+import os
+import time
+
+from charmhelpers.core import hookenv
+
+from spcharms import hookexit
+
+FORMAT_VERSION = 1
+
+directory = None
+spans = []
+stack = []
+exec_counts = {}
+process_start = time.time()
+process_start_mono = time.monotonic()
+
+
+class NullSpan(object):
+    """
+    A span that records nothing when tracing is disabled.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def set_result(self, result):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span(object):
+    """
+    Record the start time, the duration, the attributes, and the result
+    of a single operation.
+    """
+    def __init__(self, kind, name, attrs):
+        """
+        Prepare to record an operation of the specified kind.
+        """
+        self.data = {'kind': kind, 'name': name}
+        if attrs:
+            self.data['attrs'] = attrs
+
+    def __enter__(self):
+        if stack:
+            self.data['parent'] = stack[-1]
+        self.data['id'] = len(spans)
+        spans.append(self.data)
+        stack.append(self.data['id'])
+        self.start = time.monotonic()
+        self.data['start'] = round(self.start - process_start_mono, 6)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.data['dur'] = round(time.monotonic() - self.start, 6)
+        if exc_type is not None:
+            self.data['error'] = '{tp}: {e}' \
+                .format(tp=exc_type.__name__, e=exc_value)
+        stack.pop()
+        return False
+
+    def set_result(self, result):
+        """
+        Record the result of the operation.
+        """
+        self.data['result'] = result
+
+
+def enabled():
+    """
+    Check whether the storpool_trace_dir option asks for a trace file;
+    the configuration lookup itself is not traced.
+    """
+    # spcharms.memo records its lookups through this module.
+    from spcharms import memo
+
+    global directory
+    if directory is None:
+        directory = ''
+        directory = memo.hook_option('storpool_trace_dir', '') or ''
+        if directory:
+            hookexit.register('trace', write, hookexit.PRIO_FINAL)
+    return bool(directory)
+
+
+def enable(path):
+    """
+    Write a trace file to the specified directory when the hook exits,
+    whatever storpool_trace_dir says.
+    """
+    global directory
+    directory = path
+    hookexit.register('trace', write, hookexit.PRIO_FINAL)
+
+
+def span(kind, name, **attrs):
+    """
+    Start recording an operation; use the result as a context manager.
+    """
+    if directory == '' or (directory is None and not enabled()):
+        return NULL_SPAN
+    return Span(kind, name, attrs)
+
+
+def traced(func):
+    """
+    Record each invocation of a top-level helper function.
+    """
+    name = '{mod}.{name}'.format(mod=func.__module__, name=func.__name__)
+
+    @functools.wraps(func)
+    def inner(*args, **kwargs):
+        with span('helper', name):
+            return func(*args, **kwargs)
+
+    return inner
+
+
+def exec_span(argv):
+    """
+    Count an invocation of an external command and start recording it.
+    """
+    name = os.path.basename(argv[0])
+    exec_counts[name] = exec_counts.get(name, 0) + 1
+    return span('exec', name, argv=argv)
+
+
+def run(func, cmd, **kwargs):
+    """
+    Invoke one of the subprocess module's functions for a command,
+    record the command line and the exit code or the size of the output.
+    """
+    argv = cmd.split() if isinstance(cmd, str) else cmd
+    with exec_span(argv) as sp:
+        res = func(cmd, **kwargs)
+        sp.set_result(len(res) if isinstance(res, (bytes, str)) else res)
+        return res
+
+
+def trace_file_name():
+    """
+    Build the name of the trace file for the current hook.
+    """
+    return os.path.join(
+        directory,
+        'trace-{unit}-{hook}-{tm}-{pid}.json'.format(
+            unit=(os.environ.get('JUJU_UNIT_NAME') or 'unknown')
+            .replace('/', '-'),
+            hook=hookenv.hook_name(),
+            tm=time.strftime('%Y%m%d%H%M%S', time.gmtime(process_start)),
+            pid=os.getpid()))
+
+
+def write():
+    """
+    Write the recorded spans to the trace directory.
+    """
+    if not directory:
+        return
+    data = {
+        'format': FORMAT_VERSION,
+        'unit': os.environ.get('JUJU_UNIT_NAME'),
+        'hook': hookenv.hook_name(),
+        'start': process_start,
+        'dur': round(time.monotonic() - process_start_mono, 6),
+        'spans': spans,
+    }
+    os.makedirs(directory, mode=0o755, exist_ok=True)
+    fname = trace_file_name()
+    with open(fname + '.tmp', mode='w') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.rename(fname + '.tmp', fname)
+    del spans[:]
+
+
+def reset():
+    """
+    Drop the recorded spans and re-read the configuration.
+    """
+    global directory
+    directory = None
+    del spans[:]
+    del stack[:]
+    exec_counts.clear()
+    hookexit.unregister('trace')
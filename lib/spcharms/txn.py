@@ -6,16 +6,17 @@ import json
 import os
 import subprocess
 
-from charmhelpers.core import hookenv
-
+from spcharms import memo
+from spcharms import metrics
 from spcharms import repo as sprepo
+from spcharms import trace
 
 
 def module_name():
     """
     Use the charm name as a base for the module name passed to txn-install.
     """
-    return 'charm-' + hookenv.charm_name()
+    return 'charm-' + memo.charm_name()
 
 
 def install(*args, exact=False, prefix=''):
@@ -26,14 +27,14 @@ def install(*args, exact=False, prefix=''):
            'txn', 'install-exact' if exact else 'install']
     cmd.extend(args)
     cmd[-1] = prefix + cmd[-1]
-    subprocess.check_call(cmd)
+    trace.run(subprocess.check_call, cmd)
 
 
 def list_modules():
     """
     Get the list of modules that have recorded changes through txn-install.
     """
-    modules = subprocess.getoutput('txn list-modules')
+    modules = trace.run(subprocess.getoutput, 'txn list-modules')
     if modules is None:
         return []
     else:
@@ -45,7 +46,7 @@ def rollback_if_needed():
     Run `txn-install rollback` if necessary.
     """
     if module_name() in list_modules():
-        subprocess.call(['txn', 'rollback', module_name()])
+        trace.run(subprocess.call, ['txn', 'rollback', module_name()])
 
 
 class Txn(object):
@@ -82,7 +83,7 @@ class LXD(object):
         Check whether the charm configuration specifies that LXD containers
         should be examined at all.
         """
-        config = hookenv.config()
+        config = memo.config()
         if config is None:
             return False
         handle_lxc = config.get('handle_lxc', False)
@@ -95,7 +96,8 @@ class LXD(object):
         """
         if not klass.handle_lxc():
             return []
-        lxc_b = subprocess.check_output(['lxc', 'list', '--format=json'])
+        lxc_b = trace.run(subprocess.check_output,
+                          ['lxc', 'list', '--format=json'])
         lst = json.loads(lxc_b.decode())
         return map(lambda c: c['name'], lst)
 
@@ -126,9 +128,11 @@ class LXD(object):
         """
         if self.name != '':
             cmd = ['lxc', 'exec', self.name, '--'] + cmd
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        output = p.communicate()[0].decode()
-        res = p.returncode
+        with trace.exec_span(cmd) as sp:
+            p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+            output = p.communicate()[0].decode()
+            res = p.returncode
+            sp.set_result(res)
         return {
                 'res': res,
                 'out': output,
@@ -141,12 +145,16 @@ class LXD(object):
         """
         if self.prefix == '':
             return
+        copied = 0
         for pkgname in pkgnames:
             for f in sprepo.list_package_files(pkgname):
                 if os.path.isfile(f):
                     self.txn.install_exact(f, f)
+                    copied += 1
                 elif os.path.isdir(f):
                     os.makedirs(self.prefix + f, mode=0o755, exist_ok=True)
+        metrics.inc('storpool_charm_files_copied_total', copied)
+        metrics.inc('storpool_charm_containers_synced_total')
 
     def get_package_tree(self, pkgname):
         """
@@ -164,7 +172,8 @@ class LXD(object):
             lambda s: s[:-4] if s.endswith(':any') else s,
             map(
                 lambda s: s.strip(' ').split(' ', 1)[0],
-                subprocess.check_output(
+                trace.run(
+                    subprocess.check_output,
                     ['dpkg-query', '-W', '-f', '${Depends}', '--', pkgname]
                 ).decode().split(',')
             )
@@ -174,6 +183,7 @@ class LXD(object):
             res.extend(self.get_package_tree(dep))
         return res
 
+    @trace.traced
     def copy_package_trees(self, *pkgnames):
         """
         Copy all the files from the specified packages and their dependencies
@@ -2,41 +2,237 @@
 A StorPool Juju charm helper module: miscellaneous utility functions.
 """
 import os
-import platform
 import subprocess
 import time
 
-from charmhelpers.core import hookenv, unitdata
+from charmhelpers.core import hookenv
 
+from spcharms import cgroups as spcgroups
 from spcharms import config as spconfig
+from spcharms import hookexit
+from spcharms import kvcache
 from spcharms import kvdata
+from spcharms import memo
 from spcharms import status as spstatus
+from spcharms import trace
 
-rdebug_node = platform.node()
+RDEBUG_LEVELS = ('off', 'debug', 'trace')
+RDEBUG_BATCH_SIZE = 32768
 
+LOG_BUFFER_SIZE = 65536
+LOG_BACKUPS = 3
 
-def rdebug(s, prefix='storpool'):
+BOOT_ID_FILE = '/proc/sys/kernel/random/boot_id'
+
+rdebug_node = None
+rdebug_level = None
+rdebug_pending = []
+rdebug_writer = None
+environment = None
+
+
+class LogWriter(object):
+    """
+    Append lines to a local log file, keep it open and buffer the data
+    written to it, rotate it when it grows too large.
+    """
+    def __init__(self, path, max_size=0, backups=LOG_BACKUPS,
+                 buffer_size=LOG_BUFFER_SIZE):
+        """
+        Prepare to write to the specified file; if a maximum size is
+        specified, keep that many old copies of the file around.
+        """
+        self.path = path
+        self.max_size = max_size
+        self.backups = backups
+        self.buffer_size = buffer_size
+        self.file = None
+        self.lines = []
+        self.buffered = 0
+        self.ts_second = None
+        self.ts_string = None
+
+    def timestamp(self):
+        """
+        Format the current time, at most once per second.
+        """
+        now = int(time.time())
+        if now != self.ts_second:
+            self.ts_second = now
+            self.ts_string = time.ctime(now)
+        return self.ts_string
+
+    def write(self, data):
+        """
+        Queue a timestamped line, write the queued ones out if there are
+        too many of them.
+        """
+        line = '{tm} {data}\n'.format(tm=self.timestamp(), data=data)
+        self.lines.append(line)
+        self.buffered += len(line)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+        else:
+            hookexit.register('utils.log-file', self.flush,
+                              hookexit.PRIO_LAST)
+
+    def flush(self):
+        """
+        Write the queued lines to the file, rotate it if needed.
+        """
+        if not self.lines:
+            return
+        if self.file is None:
+            self.file = open(self.path, mode='a')
+        self.file.write(''.join(self.lines))
+        self.file.flush()
+        self.lines = []
+        self.buffered = 0
+        if self.max_size > 0 and self.file.tell() >= self.max_size:
+            self.rotate()
+
+    def rotate(self):
+        """
+        Rename the file and its older copies, start a new one.
+        """
+        self.close()
+        for idx in range(self.backups - 1, 0, -1):
+            older = '{path}.{idx}'.format(path=self.path, idx=idx)
+            if os.path.exists(older):
+                os.rename(older, '{path}.{idx}'.format(path=self.path,
+                                                       idx=idx + 1))
+        if self.backups > 0:
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.unlink(self.path)
+
+    def close(self):
+        """
+        Write out any queued lines and close the file.
+        """
+        if self.lines:
+            self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def log_writer():
+    """
+    Get the writer for the storpool_charm_log_file configured for
+    the charm, or None if no local log file should be written.
+    The configuration is only examined once per process.
+    """
+    global rdebug_writer
+    if rdebug_writer is None:
+        config = memo.config()
+        def_fname = '/dev/null'
+        fname = def_fname if config is None \
+            else config.get('storpool_charm_log_file', def_fname)
+        if fname == def_fname:
+            rdebug_writer = False
+        else:
+            rdebug_writer = LogWriter(
+                fname, max_size=config.get('storpool_charm_log_max_size', 0))
+    return rdebug_writer or None
+
+
+def rdebug_enabled(level='debug'):
+    """
+    Check whether diagnostic messages of the specified level should be
+    logged according to the storpool_charm_debug_level configuration
+    setting; the result is only determined once per process, and
+    the configuration is only examined when running within a Juju hook.
+    """
+    global rdebug_level
+    if rdebug_level is None:
+        name = memo.hook_option('storpool_charm_debug_level', 'debug')
+        rdebug_level = RDEBUG_LEVELS.index(name) \
+            if name in RDEBUG_LEVELS else RDEBUG_LEVELS.index('debug')
+    return RDEBUG_LEVELS.index(level) <= rdebug_level
+
+
+def rdebug_format(s, *args, level='debug', **kwargs):
+    """
+    Build a diagnostic message from a format string and its arguments or
+    from a function returning it; return None without building it if
+    the specified level of diagnostics is not enabled.
+    """
+    if not rdebug_enabled(level):
+        return None
+    if callable(s):
+        return s()
+    elif args or kwargs:
+        return s.format(*args, **kwargs)
+    return s
+
+
+def rdebug(s, *args, prefix='storpool', level='debug', **kwargs):
     """
     Log a diagnostic message through the charms model logger and also,
     if explicitly requested in the charm configuration, to a local file.
+    The message may be a format string with its arguments or a function
+    returning the message; either way, it is only constructed if
+    the specified level of diagnostics is enabled.
+    The messages are sent to the model logger in batches when
+    the hook exits.
     """
     global rdebug_node
+    s = rdebug_format(s, *args, level=level, **kwargs)
+    if s is None:
+        return
+    if rdebug_node is None:
+        rdebug_node = spconfig.get_hostname()
     data = '[[{hostname}:{prefix}]] {s}'.format(hostname=rdebug_node,
                                                 prefix=prefix,
                                                 s=s)
-    hookenv.log(data, hookenv.DEBUG)
+    rdebug_pending.append(data)
+    hookexit.register('utils.rdebug', rdebug_flush, hookexit.PRIO_LAST)
 
-    config = hookenv.config()
-    def_fname = '/dev/null'
-    fname = def_fname if config is None \
-        else config.get('storpool_charm_log_file', def_fname)
-    if fname != def_fname:
-        with open(fname, 'a') as f:
-            data_ts = '{tm} {data}'.format(tm=time.ctime(), data=data)
-            print(data_ts, file=f)
+    writer = log_writer()
+    if writer is not None:
+        writer.write(data)
 
 
-def check_in_lxc():
+def rdebug_flush():
+    """
+    Send the queued diagnostic messages to the charms model logger,
+    as few of them at a time as possible.
+    """
+    batch = []
+    size = 0
+    while rdebug_pending:
+        data = rdebug_pending.pop(0)
+        if batch and size + len(data) > RDEBUG_BATCH_SIZE:
+            hookenv.log('\n'.join(batch), hookenv.DEBUG)
+            batch = []
+            size = 0
+        batch.append(data)
+        size += len(data) + 1
+    if batch:
+        hookenv.log('\n'.join(batch), hookenv.DEBUG)
+
+
+def rdebug_reset():
+    """
+    Drop any queued diagnostic messages, close the local log file, and
+    re-read the hostname and the configured level and log file settings.
+    """
+    global rdebug_node
+    global rdebug_level
+    global rdebug_writer
+    rdebug_node = None
+    rdebug_level = None
+    del rdebug_pending[:]
+    hookexit.unregister('utils.rdebug')
+    if rdebug_writer:
+        rdebug_writer.lines = []
+        rdebug_writer.close()
+    rdebug_writer = None
+    hookexit.unregister('utils.log-file')
+
+
+def detect_lxc():
     """
     Check whether we are currently running within an LXC/LXD container.
     """
@@ -49,6 +245,13 @@ def check_in_lxc():
         return False
 
 
+def check_in_lxc():
+    """
+    Check whether we are currently running within an LXC/LXD container.
+    """
+    return get_environment()['in_lxc']
+
+
 def err(msg):
     """
     Log an error message and set the unit's status.
@@ -62,7 +265,7 @@ def bypassed(name):
     Check whether the administrator has explicitly specified that
     the installation should proceed despite some detected problems.
     """
-    return name in hookenv.config().get('bypassed_checks', '').split(',')
+    return name in memo.config().get('bypassed_checks', '').split(',')
 
 
 def check_cgroups(service):
@@ -71,7 +274,7 @@ def check_cgroups(service):
     and, if it is, whether the cgroups defined for the specified service are
     set up on this node.
     """
-    rdebug('Checking the cgroup config for {svc}'.format(svc=service))
+    rdebug('Checking the cgroup config for {svc}', svc=service)
     if bypassed('use_cgroups'):
         hookenv.log('The "use_cgroups" bypass is meant '
                     'FOR DEVELOPMENT ONLY!  DO NOT run a StorPool cluster in '
@@ -90,48 +293,105 @@ def check_cgroups(service):
     if cgstr is None:
         err('No {var} in the StorPool configuration'.format(var=var))
         return False
-    rdebug('About to examine the "{cg}" string for valid cgroups'
-           .format(cg=cgstr))
-    for cgdef in filter(lambda s: s != '-g', cgstr.strip().split()):
-        rdebug('- parsing {d}'.format(d=cgdef))
-        comp = cgdef.split(':')
-        if len(comp) != 2:
-            err('Unexpected component in {var}: {comp}'
-                .format(var=var, comp=cgdef))
-            return False
-        path = '/sys/fs/cgroup/{tp}/{p}'.format(tp=comp[0], p=comp[1])
-        rdebug('  - checking for {path}'.format(path=path))
-        if not os.path.isdir(path):
-            err('No {comp} group for the {svc}'
-                .format(comp=cgdef, svc=service))
-            return False
-
-    rdebug('- the cgroups for {svc} are set up'.format(svc=service))
+    rdebug('About to examine the "{cg}" string for valid cgroups', cg=cgstr)
+    res = spcgroups.check_all(cfg).get(service.lower())
+    if res is not None:
+        err(res)
+        return False
+
+    rdebug('- the cgroups for {svc} are set up', svc=service)
     return True
 
 
-def get_machine_id():
+def get_boot_id():
+    """
+    Get the identifier of the current boot of the node, or None if
+    it cannot be determined.
+    """
+    try:
+        with open(BOOT_ID_FILE, mode='r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def detect_machine_id():
     """
     Get the Juju node ID from the environment; may return "None" if
     the environment settings are not as expected.
     """
-    kv = unitdata.kv()
-    val = kv.get(kvdata.KEY_MACHINE_ID, None)
-    if val is None:
-        env = hookenv.execution_environment()
-        if 'env' not in env:
-            rdebug('No "env" in the execution environment: {env}'
-                   .format(env=env))
-            val = ''
-        elif 'JUJU_MACHINE_ID' not in env['env']:
-            rdebug('No JUJU_MACHINE_ID in the environment: {env}'
-                   .format(env=env['env']))
-            val = ''
-        else:
-            val = env['env']['JUJU_MACHINE_ID']
-        kv.set(kvdata.KEY_MACHINE_ID, val)
+    env = memo.execution_environment()
+    if 'env' not in env:
+        rdebug('No "env" in the execution environment: {env}', env=env)
+        return None
+    elif 'JUJU_MACHINE_ID' not in env['env']:
+        rdebug('No JUJU_MACHINE_ID in the environment: {env}',
+               env=env['env'])
+        return None
+    return env['env']['JUJU_MACHINE_ID']
 
-    return None if val == '' else val
+
+def detect_parent_node(sp_node):
+    """
+    Figure out the Juju node ID of the bare metal node that
+    the specified node is or runs on; return None if it cannot be parsed.
+    """
+    if sp_node is None:
+        return None
+    parts = sp_node.split('/')
+    if len(parts) == 1:
+        return sp_node
+    elif len(parts) == 3 and parts[1] in ('lxd', 'kvm'):
+        return parts[0]
+    return None
+
+
+def get_environment():
+    """
+    Get the facts about the node that we are running on: the Juju node ID,
+    the ID of the bare metal node, and whether we are running in
+    a container.  They are only determined once per boot of the node
+    and stored in the unit's database.
+    """
+    global environment
+    if environment is not None:
+        return environment
+
+    kv = kvcache.kv()
+    boot_id = get_boot_id()
+    stored = kv.get(kvdata.KEY_ENVIRONMENT, None)
+    if boot_id is not None and stored is not None and \
+       stored.get('boot_id') == boot_id:
+        environment = stored
+        return environment
+
+    machine_id = detect_machine_id()
+    environment = {
+        'boot_id': boot_id,
+        'machine_id': machine_id,
+        'parent_node': detect_parent_node(machine_id),
+        'in_lxc': detect_lxc(),
+    }
+    kv.set(kvdata.KEY_ENVIRONMENT, environment)
+    kv.unset(kvdata.KEY_MACHINE_ID)
+    kv.unset(kvdata.KEY_PARENT_NODE_ID)
+    return environment
+
+
+def drop_environment():
+    """
+    Forget about the facts about the node determined in this process.
+    """
+    global environment
+    environment = None
+
+
+def get_machine_id():
+    """
+    Get the Juju node ID from the environment; may return "None" if
+    the environment settings are not as expected.
+    """
+    return get_environment()['machine_id']
 
 
 def get_parent_node():
@@ -139,22 +399,11 @@ def get_parent_node():
     Figure out the Juju node ID of the bare metal node that
     we are running on or above.
     """
-    kv = unitdata.kv()
-    val = kv.get(kvdata.KEY_PARENT_NODE_ID, None)
-    if val is None:
-        sp_node = get_machine_id()
-        parts = sp_node.split('/')
-        if len(parts) == 1:
-            val = sp_node
-        elif len(parts) == 3 and parts[1] in ('lxd', 'kvm'):
-            val = parts[0]
-        else:
-            err('Could not parse the Juju node name "{node}"'
-                .format(node=sp_node))
-            val = ''
-        kv.set(kvdata.KEY_PARENT_NODE_ID, val)
-
-    return None if val == '' else val
+    env = get_environment()
+    if env['parent_node'] is None and env['machine_id'] is not None:
+        err('Could not parse the Juju node name "{node}"'
+            .format(node=env['machine_id']))
+    return env['parent_node']
 
 
 def exec(cmd):
@@ -162,7 +411,9 @@ def exec(cmd):
     Run an external command and return both its exit code and
     its output (to the standard output stream only).
     """
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    output = p.communicate()[0].decode()
-    res = p.returncode
+    with trace.exec_span(cmd) as sp:
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        output = p.communicate()[0].decode()
+        res = p.returncode
+        sp.set_result(res)
     return {'res': res, 'out': output}
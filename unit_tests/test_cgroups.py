@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+
+"""
+A set of unit tests for the spcharms.cgroups cgroup validation module.
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+import mock
+
+from charmhelpers.core import unitdata
+
+lib_path = os.path.realpath('lib')
+if lib_path not in sys.path:
+    sys.path.insert(0, lib_path)
+
+from spcharms import cgroups as testee
+from spcharms import hookexit
+from spcharms import kvcache
+
+
+MOUNTINFO = '''
+24 1 8:1 / / rw,relatime - ext4 /dev/sda1 rw
+32 24 0:28 / {base} rw,relatime - tmpfs tmpfs rw,mode=755
+33 32 0:29 / {base}/cpu,cpuacct rw,relatime - cgroup cgroup rw,cpu,cpuacct
+35 32 0:31 / {base}/cpuset rw,relatime - cgroup cgroup rw,cpuset
+41 32 0:37 / {base}/systemd rw,relatime - cgroup cgroup rw,name=systemd
+42 32 0:38 / {base}/unified rw,relatime - cgroup2 cgroup2 rw
+'''
+
+
+class TestCGroups(unittest.TestCase):
+    def setUp(self):
+        """
+        Use a fresh in-memory database and a fake cgroup tree for each test.
+        """
+        super(TestCGroups, self).setUp()
+        self.db = unitdata.Storage(':memory:')
+        kvcache.reset()
+        hookexit.reset()
+        testee.drop_cache()
+        self.tempd = tempfile.TemporaryDirectory(prefix='test-cgroups.')
+        self.base = os.path.join(self.tempd.name, 'cg root')
+        for path in ('cpu,cpuacct/storpool.slice/beacon',
+                     'cpuset/storpool.slice/beacon',
+                     'cpuset/storpool.slice/block',
+                     'unified/storpool.slice/block'):
+            os.makedirs(os.path.join(self.base, path))
+        with open(os.path.join(self.base, 'unified', 'cgroup.controllers'),
+                  mode='w') as f:
+            print('cpuset cpu io memory pids', file=f)
+        self.mountinfo = MOUNTINFO.format(
+            base=self.base.replace(' ', '\\040'))
+
+    def tearDown(self):
+        self.tempd.cleanup()
+        super(TestCGroups, self).tearDown()
+
+    def test_parse_mountinfo(self):
+        """
+        Find the v1 and v2 cgroup hierarchies.
+        """
+        mounts = testee.parse_mountinfo(self.mountinfo)
+        self.assertEqual({
+            'cpu': self.base + '/cpu,cpuacct',
+            'cpuacct': self.base + '/cpu,cpuacct',
+            'cpuset': self.base + '/cpuset',
+            'name=systemd': self.base + '/systemd',
+        }, mounts['v1'])
+        self.assertEqual([self.base + '/unified'], mounts['v2'])
+
+    @mock.patch('charmhelpers.core.hookenv.atexit')
+    def test_check_all(self, atexit):
+        """
+        Check all the services at once, only reuse the successful results
+        within the same process.
+        """
+        cfg = {
+            'SP_USE_CGROUPS': '1',
+            'SP_BEACON_CGROUPS': '-g cpuset:storpool.slice/beacon '
+                                 '-g cpuacct:storpool.slice/beacon',
+            'SP_BLOCK_CGROUPS': '-g cpuset:storpool.slice/block '
+                                '-g memory:storpool.slice/block',
+        }
+        with mock.patch('charmhelpers.core.unitdata.kv',
+                        return_value=self.db), \
+                mock.patch('spcharms.cgroups.read_mountinfo',
+                           return_value=self.mountinfo) as read_mountinfo, \
+                mock.patch('os.path.isdir',
+                           wraps=os.path.isdir) as isdir:
+            self.assertEqual({'beacon': None, 'block': None},
+                             testee.check_all(cfg))
+            self.assertEqual(4, isdir.call_count)
+            read_mountinfo.assert_called_once_with()
+            self.assertEqual({'beacon': None, 'block': None},
+                             testee.check_all(cfg))
+            self.assertEqual(4, isdir.call_count)
+            hookexit.run()
+            self.assertIsNone(self.db.get('storpool-helper.cgroups'))
+
+            # The next hook checks the cgroups again, e.g. after a reboot.
+            kvcache.reset()
+            testee.drop_cache()
+            os.rmdir(os.path.join(self.base, 'cpuset/storpool.slice/block'))
+            self.assertEqual({
+                'beacon': None,
+                'block': 'No cpuset:storpool.slice/block group for the block',
+            }, testee.check_all(cfg))
+            self.assertEqual(7, isdir.call_count)
+            os.mkdir(os.path.join(self.base, 'cpuset/storpool.slice/block'))
+
+            # A changed configuration is checked again; failures are
+            # not cached.
+            cfg['SP_MGMT_CGROUPS'] = '-g cpuset:storpool.slice/mgmt'
+            cfg['SP_SERVER_CGROUPS'] = 'cpuset'
+            res = {
+                'beacon': None,
+                'block': None,
+                'mgmt': 'No cpuset:storpool.slice/mgmt group for the mgmt',
+                'server': 'Unexpected component in SP_SERVER_CGROUPS: '
+                          'cpuset',
+            }
+            self.assertEqual(res, testee.check_all(cfg))
+            self.assertEqual(res, testee.check_all(cfg))
@@ -6,17 +6,90 @@ parses the output of the storpool_confshow command.
 """
 
 import os
+import shutil
 import sys
+import tempfile
 import unittest
 
 import mock
 import six
 
+from charmhelpers.core import unitdata
+
 lib_path = os.path.realpath('lib')
 if lib_path not in sys.path:
     sys.path.insert(0, lib_path)
 
+
+class MockDB(object):
+    """
+    A simple replacement for unitdata.kv's get() and set() methods,
+    along with some helper methods for testing.
+    """
+    def __init__(self, **data):
+        """
+        Initialize a dictionary-like object with the specified key/value pairs.
+        """
+        self.data = dict(data)
+
+    def get(self, name, default=None):
+        """
+        Get the value for the specified key with a fallback default.
+        """
+        return self.data.get(name, default)
+
+    def set(self, name, value):
+        """
+        Set the value for the specified key.
+        """
+        self.data[name] = value
+
+    def unset(self, name):
+        """
+        Remove the specified key if it is present.
+        """
+        self.data.pop(name, None)
+
+    def getrange(self, prefix):
+        """
+        Get all the keys starting with the specified prefix.
+        """
+        return dict([(key, value) for (key, value) in self.data.items()
+                     if key.startswith(prefix)])
+
+    def r_get_all(self):
+        """
+        For testing purposes: return a shallow copy of the whole dictinary.
+        """
+        return dict(self.data)
+
+    def r_set_all(self, data):
+        """
+        For testing purposes: set the stored data to a shallow copy of
+        the supplied dictionary.
+        """
+        self.data = dict(data)
+
+    def r_clear(self):
+        """
+        For testing purposes: remove all key/value pairs.
+        """
+        self.data = {}
+
+
+# Make sure all consumers of unitdata.kv() get our version.
+if 'MockDB' in type(unitdata.kv()).__name__:
+    r_kv = unitdata.kv()
+else:
+    r_kv = MockDB()
+    unitdata.kv = lambda: r_kv
+
+
 from spcharms import config as spconfig
+from spcharms import hookexit
+from spcharms import kvcache
+from spcharms import kvdata
+from spcharms import memo
 
 
 test_config = {
@@ -29,6 +102,43 @@ test_config_string = ''.join(map(lambda i: '{var}={val}\n'.format(var=i[0],
                                  six.iteritems(test_config)))
 test_config_bytes = six.b(test_config_string)
 
+test_config_files = {
+    'storpool.conf': """
+# The main StorPool configuration file
+SP_CLUSTER_NAME=Test cluster
+SP_USE_CGROUPS = false
+
+[node1]
+SP_OURID=1
+SP_USE_CGROUPS=true
+
+[node2]
+SP_OURID=2
+""",
+    'storpool.conf.d/cgroups.conf': """
+SP_MGMT_CGROUPS=-g cpuset:storpool.slice/mgmt
+[node2.example.com]
+SP_USE_CGROUPS=yes
+""",
+    'storpool.conf.d/ignored.conf.bak': """
+SP_OURID=42
+""",
+}
+
+test_config_node1 = {
+    'SP_CLUSTER_NAME': 'Test cluster',
+    'SP_USE_CGROUPS': 'true',
+    'SP_OURID': '1',
+    'SP_MGMT_CGROUPS': '-g cpuset:storpool.slice/mgmt',
+}
+
+test_config_node2 = {
+    'SP_CLUSTER_NAME': 'Test cluster',
+    'SP_USE_CGROUPS': 'yes',
+    'SP_OURID': '2',
+    'SP_MGMT_CGROUPS': '-g cpuset:storpool.slice/mgmt',
+}
+
 test_other_config = {
     'something': 'else',
     'but': 'really',
@@ -42,6 +152,34 @@ class TestConfig(unittest.TestCase):
         """
         super(TestConfig, self).setUp()
         spconfig.cached_config = None
+        spconfig.cached_fingerprint = None
+        spconfig.cached_index = None
+        spconfig.cached_meta = None
+        spconfig.config_changes = None
+        r_kv.r_clear()
+        kvcache.reset()
+        hookexit.reset()
+        memo.reset()
+
+    def write_config_files(self, files):
+        """
+        Create a temporary directory with the specified configuration files
+        and point the spconfig module at it.
+        """
+        tempd = tempfile.mkdtemp(prefix='test-spconfig.')
+        self.addCleanup(shutil.rmtree, tempd)
+        os.mkdir(os.path.join(tempd, 'storpool.conf.d'))
+        for (fname, contents) in files.items():
+            with open(os.path.join(tempd, fname), mode='w') as f:
+                f.write(contents)
+
+        for (name, fname) in (('CONFIG_FILE', 'storpool.conf'),
+                              ('CONFIG_DIR', 'storpool.conf.d')):
+            patcher = mock.patch.object(spconfig, name,
+                                        new=os.path.join(tempd, fname))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return tempd
 
     @mock.patch('subprocess.check_output')
     def do_test_get_dict(self, get_dict, check_output):
@@ -77,6 +215,8 @@ class TestConfig(unittest.TestCase):
 
         # Right, now let's see if it will call storpool_confshow again
         spconfig.cached_config = None
+        r_kv.r_clear()
+        kvcache.reset()
         res = get_dict()
         self.assertEqual(check_output.call_count, 2)
         check_output.assert_called_with(['/usr/sbin/storpool_confshow'])
@@ -113,5 +253,294 @@ class TestConfig(unittest.TestCase):
         self.assertEqual(spconfig.cached_config, test_config)
 
         # Right, let's go
+        r_kv.set(kvdata.KEY_CONFIG_CACHE, {'config': test_config})
+        kvcache.reset()
         spconfig.drop_cache()
         self.assertIsNone(spconfig.cached_config)
+        kvcache.flush()
+        self.assertEqual({}, r_kv.r_get_all())
+
+    @mock.patch('subprocess.check_output')
+    def test_get_dict_stored(self, check_output):
+        """
+        Make sure get_dict() reuses the configuration stored by
+        a previous hook until the configuration files change.
+        """
+        tempd = self.write_config_files({'storpool.conf': 'SP_OURID=1\n'})
+        check_output.return_value = test_config_bytes
+
+        res = spconfig.get_dict()
+        self.assertEqual(res, {'SP_OURID': '1'})
+        kvcache.flush()
+        stored = r_kv.get(kvdata.KEY_CONFIG_CACHE)
+        self.assertEqual(stored['config'], res)
+        self.assertEqual(stored['fingerprint'], spconfig.get_fingerprint())
+
+        # A new hook: nothing in memory, but the files are the same.
+        spconfig.cached_config = None
+        kvcache.reset()
+        with mock.patch('spcharms.config.read_entries') as read_entries:
+            res = spconfig.get_dict()
+            read_entries.assert_not_called()
+        self.assertEqual(res, {'SP_OURID': '1'})
+
+        # Now change the files.
+        spconfig.cached_config = None
+        with open(os.path.join(tempd, 'storpool.conf'), mode='a') as f:
+            f.write('SP_OURID=2\n')
+        res = spconfig.get_dict()
+        self.assertEqual(res, {'SP_OURID': '2'})
+        kvcache.flush()
+        self.assertEqual(r_kv.get(kvdata.KEY_CONFIG_CACHE)['config'], res)
+        check_output.assert_not_called()
+
+    @mock.patch('platform.node')
+    @mock.patch('subprocess.check_output')
+    def test_parse_files(self, check_output, node):
+        """
+        Parse the configuration files directly, applying the [hostname]
+        section overrides.
+        """
+        tempd = self.write_config_files(test_config_files)
+
+        node.return_value = 'node1'
+        res = spconfig.get_cached_dict()
+        self.assertEqual(res, test_config_node1)
+        check_output.assert_not_called()
+
+        # The short hostname is used for matching the sections, too.
+        spconfig.drop_cache()
+        node.return_value = 'node2.example.com'
+        res = spconfig.get_cached_dict()
+        self.assertEqual(res, test_config_node2)
+        check_output.assert_not_called()
+
+        # No changes, nothing should be reread.
+        with mock.patch('spcharms.config.read_entries') as read_entries:
+            res = spconfig.get_cached_dict()
+            read_entries.assert_not_called()
+            self.assertEqual(res, test_config_node2)
+
+        # A new file should invalidate the cache.
+        with open(os.path.join(tempd, 'storpool.conf.d', 'zzz.conf'),
+                  mode='w') as f:
+            f.write('SP_OURID=3\n')
+        res = spconfig.get_cached_dict()
+        self.assertEqual(res, dict(test_config_node2, SP_OURID='3'))
+        check_output.assert_not_called()
+
+    @mock.patch('subprocess.check_output')
+    def test_parse_files_fallback(self, check_output):
+        """
+        Fall back to running storpool_confshow if the files cannot be read.
+        """
+        self.write_config_files(test_config_files)
+        check_output.return_value = test_config_bytes
+
+        with mock.patch('spcharms.config.read_entries') as read_entries:
+            read_entries.side_effect = PermissionError('cannot read')
+            res = spconfig.get_cached_dict()
+            read_entries.assert_called_once()
+        check_output.assert_called_once_with(['/usr/sbin/storpool_confshow'])
+        self.assertEqual(res, test_config)
+
+    @mock.patch('platform.node', return_value='node1')
+    @mock.patch('subprocess.check_output')
+    def test_parse_files_defaults(self, check_output, node):
+        """
+        Merge the built-in defaults reported by storpool_confshow into
+        the parsed configuration, run it again only when needed.
+        """
+        tempd = self.write_config_files(test_config_files)
+        confshow = os.path.join(tempd, 'storpool_confshow')
+        with open(confshow, mode='w') as f:
+            f.write('#!/bin/sh\n')
+        check_output.return_value = six.b(''.join([
+            '{var}={val}\n'.format(var=var, val=val) for (var, val) in
+            sorted(dict(test_config_node1, SP_RDMA_IFACE='',
+                        SP_CACHE_SIZE='4096').items())
+        ]))
+        defaults = {'SP_RDMA_IFACE': '', 'SP_CACHE_SIZE': '4096'}
+
+        with mock.patch.object(spconfig, 'CONFSHOW', new=confshow):
+            res = spconfig.get_cached_dict()
+            self.assertEqual(res, dict(test_config_node1, **defaults))
+            check_output.assert_called_once_with([confshow])
+            kvcache.flush()
+            self.assertEqual(r_kv.get(kvdata.KEY_CONFIG_DEFAULTS)['defaults'],
+                             defaults)
+
+            # Dropping the cache does not run storpool_confshow again...
+            for _ in range(3):
+                spconfig.drop_cache()
+                res = spconfig.get_dict()
+                self.assertEqual(res, dict(test_config_node1, **defaults))
+            self.assertEqual(check_output.call_count, 1)
+
+            # ...neither does changing the files...
+            with open(os.path.join(tempd, 'storpool.conf.d', 'zzz.conf'),
+                      mode='w') as f:
+                f.write('SP_CACHE_SIZE=8192\n')
+            res = spconfig.get_cached_dict()
+            self.assertEqual(res, dict(test_config_node1, SP_RDMA_IFACE='',
+                                       SP_CACHE_SIZE='8192'))
+            self.assertEqual(check_output.call_count, 1)
+
+            # ...unless a variable whose default is not known is removed.
+            with open(os.path.join(tempd, 'storpool.conf'), mode='w') as f:
+                f.write('SP_OURID=1\n')
+            check_output.return_value = six.b('SP_OURID=1\n'
+                                              'SP_CLUSTER_NAME=\n'
+                                              'SP_CACHE_SIZE=8192\n')
+            res = spconfig.get_cached_dict()
+            self.assertEqual(check_output.call_count, 2)
+            self.assertEqual(res, {
+                'SP_OURID': '1',
+                'SP_CLUSTER_NAME': '',
+                'SP_MGMT_CGROUPS': '-g cpuset:storpool.slice/mgmt',
+                'SP_CACHE_SIZE': '8192',
+            })
+
+    @mock.patch('subprocess.check_output')
+    def test_cluster_index(self, check_output):
+        """
+        Build the configuration index for all the hosts in the cluster.
+        """
+        self.write_config_files(test_config_files)
+
+        idx = spconfig.get_cluster_index()
+        self.assertEqual(sorted(idx['hosts'].keys()),
+                         ['node1', 'node2', 'node2.example.com'])
+        self.assertEqual(idx['hosts']['node1'], test_config_node1)
+        self.assertEqual(idx['hosts']['node2.example.com'],
+                         test_config_node2)
+        self.assertEqual(idx['ids'], {'1': 'node1', '2': 'node2'})
+        self.assertEqual(spconfig.get_host_by_id(1), 'node1')
+        self.assertIsNone(spconfig.get_host_by_id(3))
+
+        # Modifying the results does not affect the cached index.
+        idx['hosts']['node1']['SP_OURID'] = '5'
+        idx['ids']['5'] = 'node1'
+        spconfig.get_host_config('node2')['SP_OURID'] = '6'
+        self.assertEqual(spconfig.get_host_config('node1'), test_config_node1)
+        self.assertEqual(spconfig.get_host_config('node2')['SP_OURID'], '2')
+        self.assertIsNone(spconfig.get_host_by_id(5))
+
+        # Hosts with no sections of their own only get the global settings,
+        # and the files are not parsed again for them.
+        with mock.patch('spcharms.config.read_entries') as read_entries:
+            self.assertEqual(spconfig.get_host_config('node3'), {
+                'SP_CLUSTER_NAME': 'Test cluster',
+                'SP_USE_CGROUPS': 'false',
+                'SP_MGMT_CGROUPS': '-g cpuset:storpool.slice/mgmt',
+            })
+            self.assertEqual(spconfig.get_host_config('node1'),
+                             test_config_node1)
+            read_entries.assert_not_called()
+        check_output.assert_not_called()
+
+    @mock.patch('subprocess.check_output')
+    def test_cluster_index_fallback(self, check_output):
+        """
+        Run storpool_confshow for each host if the files cannot be read.
+        """
+        self.write_config_files(test_config_files)
+        check_output.return_value = six.b('SP_OURID=5\n')
+
+        with mock.patch('spcharms.config.read_entries') as read_entries:
+            read_entries.side_effect = PermissionError('cannot read')
+            idx = spconfig.get_cluster_index(['node5'])
+        check_output.assert_called_once_with(
+            ['/usr/sbin/storpool_confshow', '-n', 'node5'])
+        self.assertEqual(idx, {
+            'hosts': {'node5': {'SP_OURID': '5'}},
+            'ids': {'5': 'node5'},
+        })
+
+        self.assertEqual(spconfig.get_host_config('node5'),
+                         {'SP_OURID': '5'})
+        check_output.assert_called_once()
+
+    @mock.patch('charmhelpers.core.hookenv.atexit')
+    @mock.patch('charms.reactive.set_state')
+    def test_meta_config_changed(self, set_state, atexit):
+        """
+        Make sure the meta-config object only reports the keys that have
+        actually changed since the previous hook.
+        """
+        first = {'a': 1, 'b': 'two', 'c': [3]}
+        spconfig.set_meta_config(first)
+        set_state.assert_called_once_with('storpool-helper.config-set')
+        cfg = spconfig.m()
+        self.assertEqual(cfg['b'], 'two')
+        self.assertEqual(spconfig.changed_keys(), set(['a', 'b', 'c']))
+        self.assertTrue(cfg.changed('a'))
+
+        # The end of the first hook...
+        spconfig.save_meta_hashes()
+
+        # The next hook does not change anything.
+        spconfig.cached_meta = None
+        cfg = spconfig.m()
+        self.assertEqual(spconfig.changed_keys(), set())
+        spconfig.set_meta_config(dict(first))
+        cfg = spconfig.m()
+        self.assertFalse(cfg.changed('a'))
+        self.assertEqual(spconfig.changed_keys(), set())
+        spconfig.save_meta_hashes()
+
+        # The next one changes a value and removes another one;
+        # setting the config twice does not lose the changes.
+        spconfig.cached_meta = None
+        spconfig.set_meta_config({'a': 1, 'b': 'three'})
+        spconfig.set_meta_config({'a': 1, 'b': 'three'})
+        cfg = spconfig.m()
+        self.assertFalse(cfg.changed('a'))
+        self.assertTrue(cfg.changed('b'))
+        self.assertTrue(cfg.changed('c'))
+        self.assertEqual(spconfig.changed_keys(), set(['b', 'c']))
+
+    def test_config_changes(self):
+        """
+        Make sure the changes in the StorPool configuration are reported
+        through the reactive states for the relevant groups only.
+        """
+        tempd = self.write_config_files(test_config_files)
+        states = set()
+
+        with mock.patch('charms.reactive.set_state', new=states.add), \
+                mock.patch('platform.node', return_value='node1'):
+            spconfig.register_group('ourid', ['SP_OURID'])
+            self.assertEqual(spconfig.check_config_changes(),
+                             set(test_config_node1.keys()))
+            self.assertEqual(states, set([
+                'storpool-config.changed',
+                'storpool-config.changed.cgroups',
+                'storpool-config.changed.ourid',
+            ]))
+            kvcache.flush()
+            self.assertEqual(r_kv.get(kvdata.KEY_CONFIG_SNAPSHOT),
+                             test_config_node1)
+
+            # The next hook: nothing changed.
+            states.clear()
+            spconfig.config_changes = None
+            self.assertEqual(spconfig.changed_config_keys(), set())
+            self.assertEqual(states, set())
+
+            # And now the cluster name and the ID change.
+            spconfig.config_changes = None
+            with open(os.path.join(tempd, 'storpool.conf.d', 'new.conf'),
+                      mode='w') as f:
+                f.write('SP_OURID=11\nSP_CLUSTER_NAME=Another one\n')
+            self.assertEqual(spconfig.check_config_changes(),
+                             set(['SP_OURID', 'SP_CLUSTER_NAME']))
+            self.assertEqual(spconfig.changed_config_keys(),
+                             set(['SP_OURID', 'SP_CLUSTER_NAME']))
+            self.assertEqual(states, set([
+                'storpool-config.changed',
+                'storpool-config.changed.ourid',
+            ]))
+
+            spconfig.unregister_group('ourid')
+            self.assertNotIn('ourid', spconfig.get_groups())
@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+
+"""
+A set of unit tests for the spcharms.kvcache write-back cache in front of
+the unit's key/value database.
+"""
+
+import os
+import sys
+import unittest
+
+import mock
+
+from charmhelpers.core import unitdata
+
+lib_path = os.path.realpath('lib')
+if lib_path not in sys.path:
+    sys.path.insert(0, lib_path)
+
+from spcharms import hookexit
+from spcharms import kvcache
+from spcharms import kvdata
+from spcharms import memo
+
+
+class TestKVCache(unittest.TestCase):
+    def setUp(self):
+        """
+        Use a fresh in-memory database for each test.
+        """
+        super(TestKVCache, self).setUp()
+        self.db = unitdata.Storage(':memory:')
+        kvcache.reset()
+        hookexit.reset()
+        memo.reset()
+
+    def test_write_back(self):
+        """
+        Load all the known keys at once, only write them out on flush.
+        """
+        self.db.set(kvdata.KEY_OURID, '13')
+        self.db.set(kvdata.KEY_SPSTATUS, 'error:something')
+        self.db.set('something.else', 'other')
+        cache = kvcache.KVCache(self.db)
+
+        with mock.patch.object(self.db, 'get') as db_get:
+            self.assertEqual(cache.get(kvdata.KEY_OURID), '13')
+            self.assertEqual(cache.get(kvdata.KEY_SPSTATUS),
+                             'error:something')
+            self.assertIsNone(cache.get(kvdata.KEY_MACHINE_ID))
+            self.assertEqual(cache.get(kvdata.KEY_SET_STATES, {}), {})
+            db_get.assert_not_called()
+        self.assertEqual(cache.stats(),
+                         {'hits': 4, 'misses': 0, 'flushes': 0, 'dirty': 0})
+
+        # Unknown and foreign keys are not cached at all.
+        self.assertEqual(cache.get('something.else'), 'other')
+        self.db.set('something.else', 'changed')
+        self.assertEqual(cache.get('something.else'), 'changed')
+        self.assertEqual(cache.stats()['misses'], 2)
+        self.assertIsNone(cache.get(kvdata.KEY_LXD_NAME))
+        self.db.set(kvdata.KEY_LXD_NAME, 'cinder-lxd')
+        self.assertEqual(cache.get(kvdata.KEY_LXD_NAME), 'cinder-lxd')
+        cache.set('something.else', 'written')
+        self.assertEqual(self.db.get('something.else'), 'written')
+        cache.unset('something.else')
+        self.assertIsNone(self.db.get('something.else'))
+        self.assertEqual(cache.stats()['misses'], 4)
+        self.assertEqual(cache.stats()['dirty'], 0)
+
+        with mock.patch('charmhelpers.core.hookenv.atexit') as atexit:
+            cache.set(kvdata.KEY_OURID, '42')
+            cache.unset(kvdata.KEY_SPSTATUS)
+            atexit.assert_called_once_with(hookexit.run)
+        self.assertEqual(cache.get(kvdata.KEY_OURID), '42')
+        self.assertIsNone(cache.get(kvdata.KEY_SPSTATUS))
+        self.assertEqual(self.db.get(kvdata.KEY_OURID), '13')
+        self.assertEqual(self.db.get(kvdata.KEY_SPSTATUS), 'error:something')
+
+        cache.flush()
+        self.assertEqual(self.db.get(kvdata.KEY_OURID), '42')
+        self.assertIsNone(self.db.get(kvdata.KEY_SPSTATUS))
+        self.assertEqual(cache.stats(),
+                         {'hits': 6, 'misses': 4, 'flushes': 1, 'dirty': 0})
+
+        # Nothing to write, nothing to count.
+        cache.flush()
+        self.assertEqual(cache.stats()['flushes'], 1)
+
+    def test_copies(self):
+        """
+        Make sure the callers cannot modify the cached values behind
+        the cache's back.
+        """
+        cache = kvcache.KVCache(self.db)
+        with mock.patch('charmhelpers.core.hookenv.atexit'):
+            data = {'hosts': {'a': 1}}
+            cache.set(kvdata.KEY_CONFIG_SNAPSHOT, data)
+            data['hosts']['b'] = 2
+            got = cache.get(kvdata.KEY_CONFIG_SNAPSHOT)
+            self.assertEqual({'hosts': {'a': 1}}, got)
+            got['hosts']['c'] = 3
+            self.assertEqual({'hosts': {'a': 1}},
+                             cache.get(kvdata.KEY_CONFIG_SNAPSHOT))
+            cache.flush()
+        self.assertEqual({'hosts': {'a': 1}},
+                         self.db.get(kvdata.KEY_CONFIG_SNAPSHOT))
+
+    def test_hook_exit(self):
+        """
+        Make sure the module-level cache is flushed when the hook exits.
+        """
+        with mock.patch('charmhelpers.core.unitdata.kv',
+                        return_value=self.db), \
+                mock.patch('charmhelpers.core.hookenv.atexit'):
+            kvcache.kv().set(kvdata.KEY_MACHINE_ID, '3/lxd/4')
+            self.assertIs(kvcache.kv(), kvcache.cache)
+            self.assertIsNone(self.db.get(kvdata.KEY_MACHINE_ID))
+
+            hookexit.run()
+            self.assertEqual(self.db.get(kvdata.KEY_MACHINE_ID), '3/lxd/4')
+            self.assertEqual(kvcache.stats()['flushes'], 1)
+
+    @mock.patch('charmhelpers.core.hookenv.atexit')
+    @mock.patch('charmhelpers.core.hookenv.log')
+    @mock.patch('charmhelpers.core.hookenv.config',
+                return_value={'storpool_kv_stats': True})
+    def test_key_stats(self, config, log, atexit):
+        """
+        Collect per-key statistics if enabled, dump them at hook exit.
+        """
+        self.db.set(kvdata.KEY_SET_STATES, {'a': {}})
+        self.db.set(kvdata.PREFIX_PRESENCE_ROW + 'one', [1])
+        self.db.set(kvdata.PREFIX_PRESENCE_ROW + 'two', [2, 3])
+        with mock.patch('charmhelpers.core.unitdata.kv',
+                        return_value=self.db), \
+                mock.patch.dict('os.environ', JUJU_UNIT_NAME='a/0'):
+            db = kvcache.kv()
+            self.assertEqual({'a': {}}, db.get(kvdata.KEY_SET_STATES))
+            db.get(kvdata.KEY_SET_STATES)
+            db.set(kvdata.KEY_OURID, '13')
+            self.assertEqual(2, len(db.getrange(kvdata.PREFIX_PRESENCE_ROW)))
+            db.set(kvdata.PREFIX_PRESENCE_ROW + 'three', [4, 5, 6])
+            hookexit.run()
+
+        rows = kvdata.PREFIX_PRESENCE_ROW + '*'
+        report = kvcache.cache.key_report()
+        self.assertEqual(2, report[kvdata.KEY_SET_STATES]['reads'])
+        self.assertEqual(0, report[kvdata.KEY_SET_STATES]['writes'])
+        self.assertEqual(len('{"a": {}}'),
+                         report[kvdata.KEY_SET_STATES]['stored'])
+        self.assertEqual(1, report[kvdata.KEY_OURID]['writes'])
+        self.assertEqual(len('"13"'), report[kvdata.KEY_OURID]['bytes'])
+        self.assertEqual(1, report[rows]['reads'])
+        self.assertEqual(1, report[rows]['writes'])
+        self.assertEqual(len('[4, 5, 6]'), report[rows]['bytes'])
+        self.assertEqual(len('[1][2, 3][4, 5, 6]'), report[rows]['stored'])
+        self.assertEqual(1, report['-load']['reads'])
+
+        log.assert_called_once()
+        self.assertIn('spcharms.kvcache key statistics', log.call_args[0][0])
+
+        # Nothing is collected unless running within a hook.
+        kvcache.reset()
+        with mock.patch('charmhelpers.core.unitdata.kv',
+                        return_value=self.db), \
+                mock.patch.dict('os.environ', clear=True):
+            kvcache.kv().get(kvdata.KEY_SET_STATES)
+            self.assertNotIn('reads',
+                             kvcache.key_report()[kvdata.KEY_SET_STATES])
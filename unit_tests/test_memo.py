@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+
+"""
+A set of unit tests for the spcharms.memo per-hook cache of hook
+environment lookups.
+"""
+
+import os
+import sys
+import unittest
+
+import mock
+
+lib_path = os.path.realpath('lib')
+if lib_path not in sys.path:
+    sys.path.insert(0, lib_path)
+
+from spcharms import hookexit
+from spcharms import memo as testee
+
+
+class TestMemo(unittest.TestCase):
+    def setUp(self):
+        """
+        Start with an empty cache.
+        """
+        super(TestMemo, self).setUp()
+        hookexit.reset()
+        testee.reset()
+
+    @mock.patch('charmhelpers.core.hookenv.atexit')
+    @mock.patch('charmhelpers.core.hookenv.relation_ids')
+    @mock.patch('charmhelpers.core.hookenv.config',
+                return_value={'handle_lxc': True})
+    @mock.patch('charmhelpers.core.hookenv.charm_name',
+                return_value='storpool-block')
+    def test_memo(self, charm_name, config, relation_ids, atexit):
+        """
+        Invoke each lookup once per hook and set of arguments.
+        """
+        relation_ids.side_effect = lambda rel: [rel + ':1']
+        for _ in range(5):
+            self.assertEqual('storpool-block', testee.charm_name())
+            self.assertEqual({'handle_lxc': True}, testee.config())
+            self.assertEqual(['a:1'], testee.relation_ids('a'))
+            self.assertEqual(['b:1'], testee.relation_ids('b'))
+        charm_name.assert_called_once_with()
+        config.assert_called_once_with()
+        self.assertEqual([mock.call('a'), mock.call('b')],
+                         relation_ids.call_args_list)
+        self.assertEqual({
+            'charm_name': {'hits': 4, 'misses': 1},
+            'config': {'hits': 4, 'misses': 1},
+            'relation_ids': {'hits': 8, 'misses': 2},
+        }, testee.stats())
+
+        testee.invalidate('relation_ids')
+        testee.relation_ids('a')
+        testee.charm_name()
+        self.assertEqual(3, relation_ids.call_count)
+        self.assertEqual(1, charm_name.call_count)
+
+        # Nothing survives the end of the hook.
+        hookexit.run()
+        testee.charm_name()
+        testee.relation_ids('a')
+        self.assertEqual(2, charm_name.call_count)
+        self.assertEqual(4, relation_ids.call_count)
+
+    @mock.patch('charmhelpers.core.hookenv.atexit')
+    @mock.patch('charmhelpers.core.hookenv.config',
+                return_value={'storpool_kv_stats': True})
+    def test_hook_option(self, config, atexit):
+        """
+        Only look at the charm configuration when running within a hook.
+        """
+        with mock.patch.dict('os.environ', clear=True):
+            self.assertFalse(testee.hook_option('storpool_kv_stats', False))
+            self.assertEqual('x', testee.hook_option('missing', 'x'))
+            config.assert_not_called()
+
+        with mock.patch.dict('os.environ', JUJU_UNIT_NAME='storpool-block/0'):
+            self.assertTrue(testee.hook_option('storpool_kv_stats', False))
+            self.assertEqual('x', testee.hook_option('missing', 'x'))
+            config.assert_called_once_with()
@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+
+"""
+A set of unit tests for the spcharms.metrics Prometheus exporter.
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+import mock
+
+from charmhelpers.core import unitdata
+
+lib_path = os.path.realpath('lib')
+if lib_path not in sys.path:
+    sys.path.insert(0, lib_path)
+
+from spcharms import hookexit
+from spcharms import kvcache
+from spcharms import kvdata
+from spcharms import memo
+from spcharms import metrics as testee
+from spcharms import trace
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        """
+        Use a fresh in-memory database for each test.
+        """
+        super(TestMetrics, self).setUp()
+        self.db = unitdata.Storage(':memory:')
+        kvcache.reset()
+        hookexit.reset()
+        memo.reset()
+        trace.reset()
+        testee.reset()
+
+    def test_disabled(self):
+        """
+        Do not record anything outside of a hook.
+        """
+        with mock.patch.dict('os.environ', clear=True):
+            testee.inc('storpool_charm_packages_installed_total', 3)
+            self.assertFalse(testee.enabled())
+        self.assertIsNone(testee.data)
+
+    @mock.patch('charmhelpers.core.hookenv.atexit')
+    @mock.patch('charmhelpers.core.hookenv.hook_name',
+                return_value='install')
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_export(self, config, hook_name, atexit):
+        """
+        Store the metrics, merge the files of several units.
+        """
+        other_db = unitdata.Storage(':memory:')
+        with tempfile.TemporaryDirectory(prefix='test-metrics.') as tempd:
+            config.return_value = {'storpool_metrics_dir': tempd}
+            for (unit, db) in (('storpool-block/0', self.db),
+                               ('storpool-candleholder/1', other_db)):
+                with mock.patch.dict('os.environ', JUJU_UNIT_NAME=unit), \
+                        mock.patch('charmhelpers.core.hookenv.local_unit',
+                                   return_value=unit), \
+                        mock.patch('charmhelpers.core.unitdata.kv',
+                                   return_value=db):
+                    kvcache.reset()
+                    memo.reset()
+                    trace.reset()
+                    testee.reset()
+                    testee.inc('storpool_charm_packages_installed_total', 3)
+                    testee.inc('storpool_charm_packages_installed_total', 2)
+                    testee.set_gauge('storpool_charm_presence_nodes', 4,
+                                     relation='storpool-presence')
+                    testee.observe('storpool_charm_hook_duration_seconds',
+                                   7, hook='config-changed')
+                    trace.run(lambda cmd: 0, ['/usr/bin/dpkg', '-L'])
+                    hookexit.run()
+
+            self.assertEqual(
+                ['storpool-charms.lock',
+                 'storpool-charms.prom',
+                 'storpool-charms.unit.storpool-block-0.json',
+                 'storpool-charms.unit.storpool-candleholder-1.json'],
+                sorted(os.listdir(tempd)))
+            with open(os.path.join(tempd, testee.PROM_FILE),
+                      mode='r') as f:
+                lines = f.read().split('\n')
+
+        for unit in ('storpool-block/0', 'storpool-candleholder/1'):
+            for line in (
+                'storpool_charm_packages_installed_total'
+                '{{unit="{unit}"}} 5',
+                'storpool_charm_presence_nodes'
+                '{{relation="storpool-presence",unit="{unit}"}} 4',
+                'storpool_charm_hooks_total'
+                '{{hook="install",unit="{unit}"}} 1',
+                'storpool_charm_subprocesses_total'
+                '{{command="dpkg",unit="{unit}"}} 1',
+                'storpool_charm_hook_duration_seconds_bucket'
+                '{{hook="config-changed",le="5",unit="{unit}"}} 0',
+                'storpool_charm_hook_duration_seconds_bucket'
+                '{{hook="config-changed",le="10",unit="{unit}"}} 1',
+                'storpool_charm_hook_duration_seconds_count'
+                '{{hook="config-changed",unit="{unit}"}} 1',
+                'storpool_charm_hook_duration_seconds_sum'
+                '{{hook="config-changed",unit="{unit}"}} 7',
+            ):
+                self.assertIn(line.format(unit=unit), lines)
+        self.assertEqual(1, lines.count(
+            '# TYPE storpool_charm_packages_installed_total counter'))
+        self.assertEqual(1, lines.count(
+            '# TYPE storpool_charm_hook_duration_seconds histogram'))
+
+        # The values persist across hooks.
+        stored = self.db.get(kvdata.KEY_METRICS)
+        self.assertEqual(5, stored['counters'][
+            'storpool_charm_packages_installed_total'][
+            'storpool_charm_packages_installed_total'])
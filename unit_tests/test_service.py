@@ -11,6 +11,8 @@ import unittest
 import copy
 import json
 import mock
+import random
+import time
 
 from charmhelpers.core import unitdata
 
@@ -82,6 +84,19 @@ class MockDB(object):
         """
         self.data[name] = value
 
+    def unset(self, name):
+        """
+        Remove the specified key if it is present.
+        """
+        self.data.pop(name, None)
+
+    def getrange(self, prefix):
+        """
+        Get all the keys starting with the specified prefix.
+        """
+        return dict([(key, value) for (key, value) in self.data.items()
+                     if key.startswith(prefix)])
+
     def r_get_all(self):
         """
         For testing purposes: return a shallow copy of the whole dictinary.
@@ -110,8 +125,12 @@ else:
     unitdata.kv = lambda: r_kv
 
 
+from spcharms import hookexit
+from spcharms import kvcache
 from spcharms import kvdata
+from spcharms import memo
 from spcharms import service_hook as testee
+from spcharms import utils as sputils
 
 SP_NODE = '42'
 
@@ -131,6 +150,18 @@ class TestStorPoolService(unittest.TestCase):
         super(TestStorPoolService, self).setUp()
         r_state.r_clear_states()
         r_kv.r_clear()
+        kvcache.reset()
+        hookexit.reset()
+        memo.reset()
+        testee.pending_broadcasts.clear()
+
+    def r_rows(self):
+        """
+        Fetch the per-conversation node maps stored in the database.
+        """
+        prefix = kvdata.PREFIX_PRESENCE_ROW
+        return dict([(key[len(prefix):], row['nodes'])
+                     for (key, row) in r_kv.getrange(prefix).items()])
 
     def fail_on_err(self, msg):
         self.fail('sputils.err() invoked: {msg}'.format(msg=msg))
@@ -165,6 +196,7 @@ class TestStorPoolService(unittest.TestCase):
         self.assertTrue(ch_t)
 
         r_kv.set(kvdata.KEY_PRESENCE, state_b)
+        kvcache.reset()
         (state_b_r, ch_f) = testee.get_state()
         self.assertEqual(state_b_r, state_b)
         self.assertFalse(ch_f)
@@ -198,20 +230,20 @@ class TestStorPoolService(unittest.TestCase):
 
         ch = testee.update_state(r_kv, test, True, 'a', 'aa', False)
         self.assertEqual(test, st_false)
-        self.assertEqual(r_kv.r_get_all(), {kvdata.KEY_PRESENCE: test})
+        self.assertEqual(self.r_rows(), {'a': test['a']})
         self.assertTrue(ch)
         r_kv.r_clear()
 
         ch = testee.update_state(r_kv, test, False, 'a', 'aa', True)
         self.assertNotEqual(test, st_false)
         self.assertNotEqual(test, st_all)
-        self.assertEqual(r_kv.r_get_all(), {kvdata.KEY_PRESENCE: test})
+        self.assertEqual(self.r_rows(), {'a': test['a']})
         self.assertTrue(ch)
         r_kv.r_clear()
 
         ch = testee.update_state(r_kv, test, False, 'b', 'ba', True)
         self.assertEqual(test, st_all)
-        self.assertEqual(r_kv.r_get_all(), {kvdata.KEY_PRESENCE: test})
+        self.assertEqual(self.r_rows(), {'b': test['b']})
         self.assertTrue(ch)
         r_kv.r_clear()
 
@@ -220,14 +252,14 @@ class TestStorPoolService(unittest.TestCase):
         ch = testee.update_state(r_kv, test, False, 'b', 'ba', False)
         self.assertNotEqual(test, st_a)
         self.assertNotEqual(test, st_false)
-        self.assertEqual(r_kv.r_get_all(), {kvdata.KEY_PRESENCE: test})
+        self.assertEqual(self.r_rows(), {'b': test['b']})
         self.assertTrue(ch)
         r_kv.r_clear()
 
         ch = testee.update_state(r_kv, test, False, 'b', 'bb', True)
         self.assertNotEqual(test, st_a)
         self.assertNotEqual(test, st_false)
-        self.assertEqual(r_kv.r_get_all(), {kvdata.KEY_PRESENCE: test})
+        self.assertEqual(self.r_rows(), {'b': test['b']})
         self.assertTrue(ch)
         r_kv.r_clear()
 
@@ -239,7 +271,7 @@ class TestStorPoolService(unittest.TestCase):
 
         ch = testee.update_state(r_kv, test, False, 'a', 'aa', False)
         self.assertEqual(test, st_false)
-        self.assertEqual(r_kv.r_get_all(), {kvdata.KEY_PRESENCE: test})
+        self.assertEqual(self.r_rows(), {'a': test['a']})
         self.assertTrue(ch)
         r_kv.r_clear()
 
@@ -262,17 +294,17 @@ class TestStorPoolService(unittest.TestCase):
         # the information about our node, too.
         node_name = 'new-node'
         testee.add_present_node(node_name, '13', 'peer-relation')
+        self.assertEqual(rel_data_received, [])
+        hookexit.run()
 
         # Now let's see if it has filled in the database...
         self.assertEqual({
-            kvdata.KEY_PRESENCE: {
-                '-local': {
-                    node_name: '13',
-                },
+            '-local': {
+                node_name: '13',
             },
-        }, r_kv.r_get_all())
+        }, self.r_rows())
 
-        jdata = json.dumps(r_kv.get(kvdata.KEY_PRESENCE)['-local'])
+        jdata = json.dumps(self.r_rows()['-local'])
         self.assertEqual(rel_data_received,
                          list(map(lambda rid: [rid, jdata], rels)))
 
@@ -285,15 +317,314 @@ class TestStorPoolService(unittest.TestCase):
         rel_data_received = []
         another_name = 'newer-node'
         testee.add_present_node(another_name, '32', 'peer-relation')
+        hookexit.run()
         self.assertEqual({
-            kvdata.KEY_PRESENCE: {
-                '-local': {
-                    node_name: '13',
-                    another_name: '32',
-                },
+            '-local': {
+                node_name: '13',
+                another_name: '32',
             },
-        }, r_kv.r_get_all())
+        }, self.r_rows())
 
-        jdata = json.dumps(r_kv.get(kvdata.KEY_PRESENCE)['-local'])
+        jdata = json.dumps(self.r_rows()['-local'])
         self.assertEqual(rel_data_received,
                          list(map(lambda rid: [rid, jdata], rels)))
+
+    @mock.patch('charmhelpers.core.hookenv.relation_set')
+    @mock.patch('charmhelpers.core.hookenv.relation_ids')
+    def test_add_present_node_coalesce(self, rel_ids, rel_set):
+        """
+        Make sure add_present_node() only sends the data once per hook and
+        only to the relations that do not have it yet.
+        """
+        rel_ids.return_value = ['peer-rel/1']
+
+        testee.add_present_node('a', True, 'peer-relation')
+        testee.add_present_node('b', True, 'peer-relation')
+        testee.add_present_node('c', False, 'peer-relation')
+        hookexit.run()
+        rel_ids.assert_called_once_with('peer-relation')
+        rel_set.assert_called_once_with(
+            'peer-rel/1',
+            storpool_service=json.dumps({'a': True, 'b': True, 'c': False},
+                                        sort_keys=True))
+
+        # Changing the data back and forth within a hook...
+        rel_set.reset_mock()
+        rel_ids.return_value = ['peer-rel/1', 'peer-rel/2']
+        testee.add_present_node('c', True, 'peer-relation')
+        testee.add_present_node('c', False, 'peer-relation')
+        hookexit.run()
+        rel_set.assert_called_once_with(
+            'peer-rel/2',
+            storpool_service=json.dumps({'a': True, 'b': True, 'c': False},
+                                        sort_keys=True))
+
+        # No changes at all, nothing to do.
+        rel_ids.reset_mock()
+        rel_set.reset_mock()
+        testee.add_present_node('c', False, 'peer-relation')
+        hookexit.run()
+        rel_ids.assert_not_called()
+        rel_set.assert_not_called()
+
+    @mock_reactive_states
+    def test_handle(self):
+        """
+        Test handle() storing each conversation's data as a separate row.
+        """
+        hk = mock.Mock(relation_name='peer-relation')
+        hk.conversation.return_value.key = 'conv-1'
+
+        # Nothing at all before; the state must be new.
+        self.assertTrue(testee.handle(hk, True, {'a': True, 'b': False}))
+        self.assertTrue(r_state.is_state('storpool-service.change'))
+        self.assertEqual(testee.get_present_nodes(), {'a': True, 'b': False})
+
+        hk.conversation.return_value.key = 'conv-2'
+        self.assertTrue(testee.handle(hk, True, {'b': True}))
+        kvcache.flush()
+        self.assertEqual(self.r_rows(), {
+            'conv-1': {'a': True, 'b': False},
+            'conv-2': {'b': True},
+        })
+        self.assertEqual(testee.get_present_nodes(), {'a': True, 'b': True})
+
+        # The same data once more; nothing should be written.
+        r_state.r_set_states(['storpool-service.changed'])
+        version = r_kv.get(kvdata.KEY_PRESENCE_VERSION)
+        row = r_kv.get(kvdata.PREFIX_PRESENCE_ROW + 'conv-2')
+        self.assertFalse(testee.handle(hk, True, {'b': True}))
+        self.assertFalse(r_state.is_state('storpool-service.change'))
+        kvcache.flush()
+        self.assertEqual(r_kv.get(kvdata.KEY_PRESENCE_VERSION), version)
+        self.assertIs(r_kv.get(kvdata.PREFIX_PRESENCE_ROW + 'conv-2'), row)
+
+        # Several changes in one conversation, a single version bump.
+        self.assertTrue(testee.handle(hk, True, {'b': False, 'c': True}))
+        self.assertTrue(r_state.is_state('storpool-service.change'))
+        kvcache.flush()
+        self.assertEqual(r_kv.get(kvdata.KEY_PRESENCE_VERSION), version + 1)
+        self.assertEqual(
+            r_kv.get(kvdata.PREFIX_PRESENCE_ROW + 'conv-2')['version'],
+            version + 1)
+
+        # And the conversation goes away.
+        self.assertTrue(testee.handle(hk, False, None))
+        kvcache.flush()
+        self.assertEqual(self.r_rows(), {'conv-1': {'a': True, 'b': False}})
+        self.assertEqual(testee.get_present_nodes(), {'a': True, 'b': False})
+
+    @mock_reactive_states
+    @mock.patch('charmhelpers.core.hookenv.relation_set')
+    @mock.patch('charmhelpers.core.hookenv.relation_ids',
+                return_value=['peer-rel/1'])
+    def test_rdebug_callback(self, rel_ids, rel_set):
+        """
+        Make sure a one-argument diagnostic function receives formatted
+        messages and no trace-level ones unless requested.
+        """
+        messages = []
+
+        def rdebug(s):
+            messages.append(s)
+
+        sputils.rdebug_reset()
+        hk = mock.Mock(relation_name='peer-relation')
+        hk.conversation.return_value.key = 'conv-1'
+        testee.handle(hk, True, {'a': True}, rdebug=rdebug)
+        testee.add_present_node('b', True, 'peer-relation', rdebug=rdebug)
+        hookexit.run()
+
+        self.assertTrue(messages)
+        self.assertEqual([], [s for s in messages if not isinstance(s, str)])
+        self.assertIn('- conversation key: conv-1', messages)
+        self.assertIn("rel_ids: ['peer-rel/1']", messages)
+        self.assertEqual([], [s for s in messages if 'state:' in s])
+
+        # Ask for the trace-level messages, too.
+        del messages[:]
+        sputils.rdebug_reset()
+        with mock.patch.object(sputils, 'rdebug_level',
+                               new=sputils.RDEBUG_LEVELS.index('trace')):
+            testee.handle(hk, True, {'a': False}, rdebug=rdebug)
+        self.assertNotEqual([], [s for s in messages if 'state:' in s])
+        sputils.rdebug_reset()
+
+    def test_aggregate_random(self):
+        """
+        Make sure the incrementally updated aggregate presence is always
+        the same as the one built from scratch, whatever the values.
+        """
+        fields = ('values', 'counts', 'mentions', 'special')
+        rnd = random.Random(42)
+        for _ in range(100):
+            r_kv.r_clear()
+            kvcache.reset()
+            db = kvcache.kv()
+            testee.get_aggregate(db)
+            for _ in range(30):
+                key = 'conv-{idx}'.format(idx=rnd.randrange(4))
+                if rnd.random() < 0.2:
+                    testee.del_row(db, key)
+                else:
+                    testee.set_row(db, key, dict([
+                        (name, rnd.choice([True, False, '13', '32']))
+                        for name in rnd.sample('abcd', rnd.randrange(4))]))
+                agg = db.get(kvdata.KEY_PRESENCE_AGGREGATE)
+                built = testee.build_aggregate(db)
+                self.assertEqual(dict([(f, built[f]) for f in fields]),
+                                 dict([(f, agg[f]) for f in fields]))
+
+    @mock_reactive_states
+    def test_present_changes(self):
+        """
+        Test the incrementally maintained aggregate presence view.
+        """
+        hk = mock.Mock(relation_name='peer-relation')
+        hk.conversation.return_value.key = 'conv-1'
+        testee.handle(hk, True, {'a': True, 'b': False})
+        hk.conversation.return_value.key = 'conv-2'
+        testee.handle(hk, True, {'b': '3', 'c': True})
+
+        (version, changes) = testee.get_present_changes(0)
+        self.assertEqual(changes, {'a': True, 'b': '3', 'c': True})
+        self.assertEqual(changes, testee.get_present_nodes())
+        agg = kvcache.kv().get(kvdata.KEY_PRESENCE_AGGREGATE)
+        self.assertEqual(agg['counts'], {'a': 1, 'b': 1, 'c': 1})
+
+        # Nothing changed since then.
+        self.assertEqual(testee.get_present_changes(version), (version, {}))
+
+        # Only "b" is affected by the first conversation going away.
+        hk.conversation.return_value.key = 'conv-1'
+        testee.handle(hk, True, {'a': True, 'b': True})
+        agg = kvcache.kv().get(kvdata.KEY_PRESENCE_AGGREGATE)
+        self.assertEqual(agg['counts'], {'a': 1, 'b': 2, 'c': 1})
+        testee.handle(hk, False, None)
+        (new_version, changes) = testee.get_present_changes(version)
+        self.assertGreater(new_version, version)
+        self.assertEqual(changes, {'a': None, 'b': '3'})
+        self.assertEqual(testee.get_present_nodes(), {'b': '3', 'c': True})
+
+        # The aggregate is rebuilt from the rows if it is lost.
+        kvcache.kv().unset(kvdata.KEY_PRESENCE_AGGREGATE)
+        self.assertEqual(testee.get_present_nodes(), {'b': '3', 'c': True})
+
+    def test_payload_encoding(self):
+        """
+        Make sure all the presence payload encodings may be decoded.
+        """
+        nodes = dict([('storpool-node-{idx}'.format(idx=idx), idx % 3 != 0)
+                      for idx in range(100)])
+        nodes['special'] = '13'
+
+        legacy = testee.encode_payload(nodes)
+        self.assertEqual(json.loads(legacy), nodes)
+        self.assertEqual(testee.decode_payload(legacy), nodes)
+        self.assertEqual(testee.decode_payload(json.loads(legacy)), nodes)
+
+        for encoding in (testee.ENCODING_COMPACT,
+                         testee.ENCODING_COMPACT_ZLIB):
+            encoded = testee.encode_payload(nodes, encoding)
+            self.assertLess(len(encoded), len(legacy))
+            self.assertEqual(testee.decode_payload(encoded), nodes)
+            self.assertEqual(testee.decode_payload(json.loads(encoded)),
+                             nodes)
+
+        self.assertEqual(testee.decode_payload(
+            testee.encode_payload({}, testee.ENCODING_COMPACT)), {})
+        self.assertIsNone(testee.decode_payload(None))
+        self.assertRaises(ValueError, testee.encode_payload, nodes, 'weird')
+        self.assertRaises(ValueError, testee.decode_payload,
+                          {testee.ENCODING_KEY: 42})
+
+    @mock_reactive_states
+    def test_handle_compact(self):
+        """
+        Make sure handle() accepts both the old and the new encodings.
+        """
+        hk = mock.Mock(relation_name='peer-relation')
+        hk.conversation.return_value.key = 'conv-1'
+        testee.handle(hk, True, {'a': True, 'b': False})
+        hk.conversation.return_value.key = 'conv-2'
+        testee.handle(hk, True, json.loads(testee.encode_payload(
+            {'c': True, 'd': '5'}, testee.ENCODING_COMPACT_ZLIB)))
+        self.assertEqual(testee.get_present_nodes(),
+                         {'a': True, 'b': False, 'c': True, 'd': '5'})
+
+    @mock_reactive_states
+    @mock.patch('charmhelpers.core.hookenv.related_units')
+    @mock.patch('charmhelpers.core.hookenv.relation_ids')
+    def test_gc_state(self, rel_ids, rel_units):
+        """
+        Make sure gc_state() removes the conversations that are gone or
+        have not been seen for too long.
+        """
+        prefix = 'reactive.conversations.peer-relation:4.'
+        hk = mock.Mock(relation_name='peer-relation')
+        for (key, nodes) in (
+            (prefix + 'peer/1', {'a': True}),
+            (prefix + 'peer/2', {'b': True}),
+            ('reactive.conversations.peer-relation:3.peer/3', {'c': True}),
+            (prefix + 'peer', {'c': True}),
+            ('reactive.conversations.other.global', {'d': True}),
+        ):
+            hk.conversation.return_value.key = key
+            testee.handle(hk, True, nodes)
+        testee.add_present_node('e', True, 'peer-relation')
+        hookexit.reset()
+
+        rel_ids.return_value = ['peer-relation:4']
+        rel_units.return_value = ['peer/1', 'peer/3']
+        # The departed peer/2 unit and the whole departed relation go away,
+        # the service-scope conversation keeps c present.
+        res = testee.gc_state('peer-relation', ttl=0)
+        rel_units.assert_called_once_with('peer-relation:4')
+        self.assertEqual(res['entries'], 2)
+        self.assertGreater(res['bytes'], 0)
+        self.assertEqual(sorted(testee.get_present_nodes().keys()),
+                         ['a', 'c', 'd', 'e'])
+
+        # Now pretend a day has passed; the conversations that are still
+        # present on the relation are kept regardless of the TTL.
+        later = time.time() + 86400
+        with mock.patch('time.time', return_value=later):
+            res = testee.gc_state('peer-relation', ttl=3600)
+        self.assertEqual(res['entries'], 1)
+        self.assertEqual(sorted(testee.get_present_nodes().keys()),
+                         ['a', 'c', 'e'])
+
+        # Without the relation data, only our own data remains.
+        with mock.patch('time.time', return_value=later):
+            res = testee.gc_state(ttl=3600)
+        self.assertEqual(res['entries'], 2)
+        self.assertEqual(testee.get_present_nodes(), {'e': True})
+
+        # Only a limited number of removed nodes is remembered.
+        (version, changes) = testee.get_present_changes(0)
+        self.assertEqual(changes, {'a': None, 'b': None, 'c': None,
+                                   'd': None, 'e': True})
+        with mock.patch.object(testee, 'MAX_REMOVED', new=2):
+            res = testee.gc_state(ttl=0)
+        self.assertEqual(res['entries'], 2)
+        (new_version, changes) = testee.get_present_changes(0)
+        self.assertEqual(new_version, version)
+        self.assertEqual(changes.pop('e'), True)
+        self.assertEqual(len(changes), 2)
+        self.assertEqual(set(changes.values()), set([None]))
+        self.assertNotIn('b', changes)
+
+    def test_legacy_state(self):
+        """
+        Make sure the state stored by earlier versions is converted.
+        """
+        r_kv.set(kvdata.KEY_PRESENCE, {
+            '-local': {'a': True},
+            'conv-1': {'b': '3'},
+        })
+        (state, changed) = testee.get_state()
+        self.assertFalse(changed)
+        self.assertEqual(state, {'-local': {'a': True}, 'conv-1': {'b': '3'}})
+        kvcache.flush()
+        self.assertIsNone(r_kv.get(kvdata.KEY_PRESENCE))
+        self.assertEqual(self.r_rows(), state)
@@ -83,6 +83,19 @@ class MockDB(object):
         """
         self.data[name] = value
 
+    def unset(self, name):
+        """
+        Remove the specified key if it is present.
+        """
+        self.data.pop(name, None)
+
+    def getrange(self, prefix):
+        """
+        Get all the keys starting with the specified prefix.
+        """
+        return dict([(key, value) for (key, value) in self.data.items()
+                     if key.startswith(prefix)])
+
     def r_get_all(self):
         """
         For testing purposes: return a shallow copy of the whole dictinary.
@@ -111,6 +124,8 @@ else:
     unitdata.kv = lambda: r_kv
 
 
+from spcharms import hookexit
+from spcharms import kvcache
 from spcharms import states as testee
 
 
@@ -122,6 +137,8 @@ class TestStates(unittest.TestCase):
         super(TestStates, self).setUp()
         r_state.r_set_states(set())
         r_kv.r_clear()
+        kvcache.reset()
+        hookexit.reset()
 
     @mock_reactive_states
     def test_get_set(self):
@@ -132,7 +149,11 @@ class TestStates(unittest.TestCase):
         for v in (None, 'a', 1, ['a', 1], {'a': ['a', 1]}):
             testee.set_registered(v)
             self.assertEqual(v, testee.get_registered())
-            self.assertEqual({kvdata.KEY_SET_STATES: v}, r_kv.r_get_all())
+            kvcache.flush()
+            self.assertEqual({
+                kvdata.KEY_SET_STATES: v,
+                kvdata.KEY_SET_STATES_INDEX: testee.build_index(v),
+            }, r_kv.r_get_all())
             self.assertEqual(set(), r_state.r_get_states())
 
     def test_register_unregister(self):
@@ -230,6 +251,7 @@ class TestStates(unittest.TestCase):
                 'unset': states['f-up-unset'],
             },
         })
+        kvcache.flush()
         self.assertEqual(['first'],
                          sorted(r_kv.get(kvdata.KEY_SET_STATES).keys()))
         self.assertEqual(set(), r_state.r_get_states())
@@ -245,6 +267,7 @@ class TestStates(unittest.TestCase):
                 'unset': states['s-start-unset'],
             },
         })
+        kvcache.flush()
         self.assertEqual(['first', 'second'],
                          sorted(r_kv.get(kvdata.KEY_SET_STATES).keys()))
         self.assertEqual(set(), r_state.r_get_states())
@@ -262,3 +285,98 @@ class TestStates(unittest.TestCase):
         testee.handle_event('config-changed')
         self.assertEqual(states['f-conf-set'].union(states['s-conf-set']),
                          r_state.r_get_states())
+
+    @mock_reactive_states
+    def test_index(self):
+        """
+        Test the resolution of conflicts between and within layers.
+        """
+        testee.register('a', {
+            'start': {
+                'set': ['a.start', 'both', 'common'],
+                'unset': ['a.stop', 'both'],
+            },
+            'stop': {
+                'set': ['a.stop'],
+            },
+        })
+        testee.register('b', {
+            'start': {
+                'set': ['b.start', 'a.stop'],
+                'unset': ['common'],
+            },
+        })
+        self.assertEqual({
+            'start': {
+                'set': ['a.start', 'a.stop', 'b.start'],
+                'unset': ['both', 'common'],
+                'errors': [],
+            },
+            'stop': {
+                'set': ['a.stop'],
+                'unset': [],
+                'errors': [],
+            },
+        }, testee.get_index())
+
+        r_state.r_set_states(['both', 'common', 'other'])
+        testee.handle_event('start')
+        self.assertEqual(set(['a.start', 'a.stop', 'b.start', 'other']),
+                         r_state.r_get_states())
+
+        # An index stored by an earlier version is rebuilt.
+        kvcache.flush()
+        r_kv.set(kvdata.KEY_SET_STATES_INDEX, None)
+        kvcache.reset()
+        r_state.r_set_states([])
+        testee.handle_event('stop')
+        self.assertEqual(set(['a.stop']), r_state.r_get_states())
+        kvcache.flush()
+        self.assertEqual(['start', 'stop'],
+                         sorted(r_kv.get(kvdata.KEY_SET_STATES_INDEX).keys()))
+
+        # Invalid keys are reported, the valid ones are still applied.
+        testee.register('c', {'stop': {'set': ['c.stop'], 'toggle': ['x']}})
+        with mock.patch('spcharms.utils.err') as err:
+            testee.handle_event('stop')
+            err.assert_called_once_with('Invalid states array key: "toggle"')
+        self.assertEqual(set(['a.stop', 'c.stop']), r_state.r_get_states())
+
+    @mock_reactive_states
+    def test_handle_events_batch(self):
+        """
+        Apply only the net result of several events.
+        """
+        testee.register('a', {
+            'config-changed': {
+                'set': ['a.configure'],
+                'unset': ['a.configured'],
+            },
+            'upgrade-charm': {
+                'set': ['a.configured', 'a.upgrade'],
+                'unset': ['a.installed'],
+            },
+        })
+        testee.register('b', {
+            'config-changed': {
+                'set': ['a.installed', 'b.configure'],
+            },
+        })
+
+        r_state.r_set_states(['a.configured', 'a.installed', 'other'])
+        with mock.patch('charms.reactive.set_state',
+                        wraps=r_state.set_state) as set_state, \
+                mock.patch('charms.reactive.remove_state',
+                           wraps=r_state.remove_state) as remove_state:
+            testee.handle_events(['config-changed', 'upgrade-charm',
+                                  'no-such-event'])
+            self.assertEqual(
+                [mock.call('a.configure'), mock.call('a.upgrade'),
+                 mock.call('b.configure')],
+                set_state.call_args_list)
+            self.assertEqual([mock.call('a.installed')],
+                             remove_state.call_args_list)
+
+        self.assertEqual(set(['a.configure', 'a.configured', 'a.upgrade',
+                              'b.configure', 'other']),
+                         r_state.r_get_states())
@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+
+"""
+A set of unit tests for the spcharms.status persistent unit status module.
+"""
+
+import json
+import os
+import sys
+import unittest
+
+import mock
+
+from charmhelpers.core import unitdata
+
+lib_path = os.path.realpath('lib')
+if lib_path not in sys.path:
+    sys.path.insert(0, lib_path)
+
+from spcharms import hookexit
+from spcharms import kvcache
+from spcharms import status as testee
+
+
+class TestStatus(unittest.TestCase):
+    def setUp(self):
+        """
+        Use a fresh in-memory database for each test.
+        """
+        super(TestStatus, self).setUp()
+        self.db = unitdata.Storage(':memory:')
+        kvcache.reset()
+        hookexit.reset()
+        testee.pending = None
+
+    @mock.patch('charmhelpers.core.hookenv.atexit')
+    @mock.patch('charmhelpers.core.hookenv.status_get')
+    @mock.patch('charmhelpers.core.hookenv.status_set')
+    def test_publish(self, status_set, status_get, atexit):
+        """
+        Publish only the last status set during the hook, and only
+        if the unit does not have it already.
+        """
+        current = ['unknown', '']
+        status_get.side_effect = lambda: tuple(current)
+        status_set.side_effect = lambda status, msg: \
+            current.__setitem__(slice(None), [status, msg])
+        with mock.patch('charmhelpers.core.unitdata.kv',
+                        return_value=self.db):
+            for idx in range(10):
+                testee.npset('maintenance', 'step {idx}'.format(idx=idx))
+            status_set.assert_not_called()
+            hookexit.run()
+            status_set.assert_called_once_with('maintenance', 'step 9')
+            self.assertEqual(2, status_get.call_count)
+
+            # The same status in the next hook is not published again.
+            kvcache.reset()
+            testee.npset('maintenance', 'step 9')
+            hookexit.run()
+            self.assertEqual(1, status_set.call_count)
+
+            # ...unless something else has changed it in the meantime.
+            current[:] = ['blocked', 'set by another layer']
+            kvcache.reset()
+            testee.npset('maintenance', 'step 9')
+            hookexit.run()
+            self.assertEqual(2, status_set.call_count)
+            self.assertEqual(['maintenance', 'step 9'], current)
+
+            # A persistent error is published right away on flush and
+            # it is not overridden by npset().
+            testee.set('error', 'something went wrong')
+            testee.npset('active', 'all fine')
+            testee.flush()
+            status_set.assert_called_with('maintenance',
+                                          'something went wrong')
+            testee.reset_unless_error()
+            hookexit.run()
+            self.assertEqual(3, status_set.call_count)
+            self.assertEqual(['error', 'something went wrong'],
+                             testee.get())
+
+            testee.reset()
+            testee.npset('active', 'all fine')
+            hookexit.run()
+            status_set.assert_called_with('active', 'all fine')
+            self.assertEqual(4, status_set.call_count)
+
+            # A status set directly after the queued one is not overridden.
+            testee.npset('maintenance', 'installing')
+            current[:] = ['active', 'ready']
+            hookexit.run()
+            self.assertEqual(4, status_set.call_count)
+            self.assertEqual(['active', 'ready'], current)
+
+            # ...but one set directly before it is.
+            current[:] = ['blocked', 'waiting']
+            testee.npset('maintenance', 'installing')
+            hookexit.run()
+            status_set.assert_called_with('maintenance', 'installing')
+            self.assertEqual(5, status_set.call_count)
+
+    @mock.patch('charmhelpers.core.hookenv.local_unit',
+                return_value='storpool-block/0')
+    @mock.patch('charmhelpers.core.hookenv.atexit')
+    @mock.patch('charmhelpers.core.hookenv.status_get',
+                return_value=('unknown', ''))
+    @mock.patch('charmhelpers.core.hookenv.status_set')
+    def test_history(self, status_set, status_get, atexit, local_unit):
+        """
+        Record the status transitions, report the time spent in each one.
+        """
+        clock = {'wall': 1000.0, 'mono': 50.0}
+
+        def advance(seconds):
+            clock['wall'] += seconds
+            clock['mono'] += seconds
+
+        with mock.patch('charmhelpers.core.unitdata.kv',
+                        return_value=self.db), \
+                mock.patch('time.time', new=lambda: clock['wall']), \
+                mock.patch('time.monotonic', new=lambda: clock['mono']):
+            testee.npset('maintenance', 'installing packages')
+            advance(30)
+            testee.npset('maintenance', 'installing packages')
+            advance(30)
+            testee.set('error', 'no cgroups')
+            advance(5)
+            testee.reset()
+            testee.npset('maintenance', 'checking cgroups')
+            advance(10)
+            testee.npset('active', 'ready')
+            advance(1)
+
+            self.assertEqual([
+                ('maintenance', 'installing packages', 1000.0, 50.0),
+                ('error', 'no cgroups', 1060.0, 110.0),
+                ('maintenance', 'checking cgroups', 1065.0, 115.0),
+                ('active', 'ready', 1075.0, 125.0),
+            ], testee.history())
+            self.assertEqual({'maintenance': 70.0, 'error': 5.0,
+                              'active': 1.0},
+                             testee.time_in_status())
+
+            data = json.loads(testee.export())
+            self.assertEqual('storpool-block/0', data['unit'])
+            self.assertEqual({'maintenance': 70.0, 'error': 5.0,
+                              'active': 1.0}, data['status'])
+            self.assertEqual([60.0, 5.0, 10.0, 1.0],
+                             [entry['spent'] for entry in data['history']])
+            self.assertEqual([
+                {'status': 'active', 'message': 'ready', 'spent': 1.0},
+                {'status': 'error', 'message': 'no cgroups', 'spent': 5.0},
+                {'status': 'maintenance', 'message': 'checking cgroups',
+                 'spent': 10.0},
+                {'status': 'maintenance',
+                 'message': 'installing packages', 'spent': 60.0},
+            ], data['message'])
+
+            # Only the most recent transitions are kept.
+            for idx in range(testee.HISTORY_SIZE + 10):
+                testee.npset('maintenance', 'step {idx}'.format(idx=idx))
+            hist = testee.history()
+            self.assertEqual(testee.HISTORY_SIZE, len(hist))
+            self.assertEqual('step {idx}'.format(idx=testee.HISTORY_SIZE + 9),
+                             hist[-1][1])
@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+
+"""
+A set of unit tests for the spcharms.trace hook tracing module.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import mock
+
+lib_path = os.path.realpath('lib')
+if lib_path not in sys.path:
+    sys.path.insert(0, lib_path)
+
+from spcharms import hookexit
+from spcharms import memo
+from spcharms import trace as testee
+
+
+@testee.traced
+def helper(cmd):
+    """
+    Run a command from within a traced helper.
+    """
+    return testee.run(subprocess.check_output, cmd)
+
+
+class TestTrace(unittest.TestCase):
+    def setUp(self):
+        """
+        Start with no recorded spans.
+        """
+        super(TestTrace, self).setUp()
+        hookexit.reset()
+        memo.reset()
+        testee.reset()
+
+    def test_disabled(self):
+        """
+        Record nothing outside of a hook unless explicitly enabled.
+        """
+        with mock.patch.dict('os.environ', clear=True):
+            self.assertIs(testee.NULL_SPAN, testee.span('exec', 'true'))
+            self.assertEqual(b'x\n', helper(['echo', 'x']))
+        self.assertEqual([], testee.spans)
+
+    @mock.patch('charmhelpers.core.hookenv.atexit')
+    @mock.patch('charmhelpers.core.hookenv.hook_name',
+                return_value='config-changed')
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_trace(self, config, hook_name, atexit):
+        """
+        Record nested spans, write them out when the hook exits.
+        """
+        with tempfile.TemporaryDirectory(prefix='test-trace.') as tempd, \
+                mock.patch.dict('os.environ', JUJU_UNIT_NAME='sp/0'):
+            config.return_value = {'storpool_trace_dir': tempd}
+            self.assertEqual(b'x\n', helper(['echo', 'x']))
+            with self.assertRaises(subprocess.CalledProcessError):
+                helper(['false'])
+            with testee.span('relation', 'relation-set', rel_id='a:1') as sp:
+                sp.set_result('ok')
+            self.assertEqual([], os.listdir(tempd))
+
+            hookexit.run()
+            files = os.listdir(tempd)
+            self.assertEqual(1, len(files))
+            self.assertTrue(files[0].startswith('trace-sp-0-config-changed-'))
+            with open(os.path.join(tempd, files[0]), mode='r') as f:
+                data = json.load(f)
+
+        self.assertEqual('sp/0', data['unit'])
+        self.assertEqual('config-changed', data['hook'])
+        spans = data['spans']
+        name = helper.__module__ + '.helper'
+        self.assertEqual(
+            [('helper', name, None),
+             ('exec', 'echo', 0),
+             ('helper', name, None),
+             ('exec', 'false', 2),
+             ('relation', 'relation-set', None)],
+            [(s['kind'], s['name'], s.get('parent')) for s in spans])
+        self.assertEqual(['echo', 'x'], spans[1]['attrs']['argv'])
+        self.assertEqual(2, spans[1]['result'])
+        self.assertIn('CalledProcessError', spans[3]['error'])
+        self.assertIn('CalledProcessError', spans[2]['error'])
+        self.assertEqual('ok', spans[4]['result'])
+        self.assertTrue(all([s['dur'] >= 0 for s in spans]))
@@ -0,0 +1,238 @@
+#!/usr/bin/python3
+
+"""
+A set of unit tests for the spcharms.utils miscellaneous helper functions.
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+import mock
+
+from charmhelpers.core import unitdata
+
+lib_path = os.path.realpath('lib')
+if lib_path not in sys.path:
+    sys.path.insert(0, lib_path)
+
+from spcharms import hookexit
+from spcharms import kvcache
+from spcharms import kvdata
+from spcharms import memo
+from spcharms import utils as testee
+
+
+class TestRDebug(unittest.TestCase):
+    def setUp(self):
+        """
+        Start with no queued messages and no cached debug level.
+        """
+        super(TestRDebug, self).setUp()
+        hookexit.reset()
+        memo.reset()
+        testee.rdebug_reset()
+
+    @mock.patch('platform.node', return_value='node1')
+    @mock.patch('charmhelpers.core.hookenv.atexit')
+    @mock.patch('charmhelpers.core.hookenv.log')
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_rdebug(self, config, log, atexit, node):
+        """
+        Format the messages lazily, send them out in a single batch.
+        """
+        config.return_value = {'storpool_charm_debug_level': 'debug'}
+        expensive = mock.Mock(return_value='a computed message')
+
+        testee.rdebug('a simple message')
+        testee.rdebug('a {0} message with {n} args', 'formatted', n=2)
+        testee.rdebug(expensive)
+        testee.rdebug(expensive, level='trace')
+        testee.rdebug('{unbalanced', prefix='something')
+        testee.rdebug('{really} {unbalanced', level='trace')
+        log.assert_not_called()
+        expensive.assert_called_once_with()
+        atexit.assert_called_once_with(hookexit.run)
+
+        hookexit.run()
+        self.assertEqual(log.call_count, 1)
+        lines = log.call_args[0][0].split('\n')
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(lines[0], '[[node1:storpool]] a simple message')
+        node.assert_called_once_with()
+        self.assertTrue(lines[1].endswith(
+            ':storpool]] a formatted message with 2 args'))
+        self.assertTrue(lines[2].endswith(':storpool]] a computed message'))
+        self.assertTrue(lines[3].endswith(':something]] {unbalanced'))
+
+        # Nothing more to send.
+        hookexit.run()
+        self.assertEqual(log.call_count, 1)
+
+    @mock.patch.dict('os.environ', JUJU_UNIT_NAME='storpool-block/0')
+    @mock.patch('charmhelpers.core.hookenv.atexit')
+    @mock.patch('charmhelpers.core.hookenv.log')
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_rdebug_levels(self, config, log, atexit):
+        """
+        Honor the configured level, split large batches.
+        """
+        config.return_value = {'storpool_charm_debug_level': 'off'}
+        expensive = mock.Mock(return_value='a computed message')
+        testee.rdebug(expensive)
+        hookexit.run()
+        expensive.assert_not_called()
+        log.assert_not_called()
+
+        testee.rdebug_reset()
+        memo.invalidate('config')
+        config.return_value = {'storpool_charm_debug_level': 'trace'}
+        line = 'x' * 1000
+        count = 2 * testee.RDEBUG_BATCH_SIZE // len(line)
+        for _ in range(count):
+            testee.rdebug(line, level='trace')
+        hookexit.run()
+        self.assertEqual(log.call_count, 3)
+        self.assertEqual(sum([len(c[0][0].split('\n'))
+                              for c in log.call_args_list]), count)
+
+    @mock.patch.dict('os.environ', JUJU_UNIT_NAME='storpool-block/0')
+    @mock.patch('charmhelpers.core.hookenv.config',
+                return_value={'storpool_charm_debug_level': 'debug'})
+    def test_rdebug_format(self, config):
+        """
+        Build the messages only for the enabled levels.
+        """
+        expensive = mock.Mock(return_value='a computed message')
+        self.assertEqual('{plain}', testee.rdebug_format('{plain}'))
+        self.assertEqual('a 1 b', testee.rdebug_format('a {0} {x}', 1, x='b'))
+        self.assertEqual('a computed message',
+                         testee.rdebug_format(expensive))
+        self.assertIsNone(testee.rdebug_format(expensive, level='trace'))
+        self.assertIsNone(testee.rdebug_format('{0}', 1, level='trace'))
+        expensive.assert_called_once_with()
+
+    @mock.patch('charmhelpers.core.hookenv.atexit')
+    @mock.patch('charmhelpers.core.hookenv.log')
+    @mock.patch('charmhelpers.core.hookenv.config')
+    def test_log_file(self, config, log, atexit):
+        """
+        Buffer the lines written to the local log file, rotate it.
+        """
+        with tempfile.TemporaryDirectory(prefix='test-utils.') as tempd:
+            fname = os.path.join(tempd, 'charm.log')
+            config.return_value = {
+                'storpool_charm_log_file': fname,
+                'storpool_charm_log_max_size': 2000,
+            }
+            testee.rdebug('first')
+            testee.rdebug('second')
+            writer = testee.log_writer()
+            self.assertIsNotNone(writer)
+            self.assertIs(writer, testee.log_writer())
+            self.assertFalse(os.path.exists(fname))
+
+            hookexit.run()
+            with open(fname, mode='r') as f:
+                lines = f.readlines()
+            self.assertEqual(len(lines), 2)
+            self.assertTrue(lines[0].endswith(':storpool]] first\n'))
+            self.assertTrue(lines[1].endswith(':storpool]] second\n'))
+
+            # Fill up the buffer, make sure the file is rotated.
+            writer.buffer_size = 1000
+            for idx in range(300):
+                testee.rdebug('line {idx}', idx=idx)
+            self.assertTrue(os.path.exists(fname + '.1'))
+            hookexit.run()
+            total = 0
+            for suffix in ('', '.1', '.2', '.3'):
+                if os.path.exists(fname + suffix):
+                    with open(fname + suffix, mode='r') as f:
+                        total += len(f.readlines())
+            self.assertFalse(os.path.exists(fname + '.4'))
+            self.assertTrue(os.path.exists(fname + '.3'))
+            self.assertGreater(total, 100)
+            self.assertLess(total, 302)
+            testee.rdebug_reset()
+
+        # No log file, no writer.
+        memo.invalidate('config')
+        config.return_value = {'storpool_charm_log_file': '/dev/null'}
+        self.assertIsNone(testee.log_writer())
+
+
+class TestEnvironment(unittest.TestCase):
+    def setUp(self):
+        """
+        Use a fresh in-memory database for each test.
+        """
+        super(TestEnvironment, self).setUp()
+        self.db = unitdata.Storage(':memory:')
+        kvcache.reset()
+        hookexit.reset()
+        memo.reset()
+        testee.drop_environment()
+
+    @mock.patch('charmhelpers.core.hookenv.atexit')
+    @mock.patch('spcharms.utils.detect_lxc', return_value=True)
+    @mock.patch('charmhelpers.core.hookenv.execution_environment',
+                return_value={'env': {'JUJU_MACHINE_ID': '3/lxd/4'}})
+    def test_environment(self, exec_env, detect_lxc, atexit):
+        """
+        Determine the facts about the node once per boot.
+        """
+        self.db.set(kvdata.KEY_MACHINE_ID, '1')
+        with mock.patch('charmhelpers.core.unitdata.kv',
+                        return_value=self.db), \
+                mock.patch('spcharms.utils.get_boot_id',
+                           return_value='boot-1'):
+            self.assertEqual('3/lxd/4', testee.get_machine_id())
+            self.assertEqual('3', testee.get_parent_node())
+            self.assertTrue(testee.check_in_lxc())
+            exec_env.assert_called_once_with()
+            detect_lxc.assert_called_once_with()
+            hookexit.run()
+            self.assertEqual('boot-1',
+                             self.db.get(kvdata.KEY_ENVIRONMENT)['boot_id'])
+            self.assertIsNone(self.db.get(kvdata.KEY_MACHINE_ID))
+
+            # The next hook during the same boot reuses the stored facts.
+            kvcache.reset()
+            testee.drop_environment()
+            self.assertEqual('3', testee.get_parent_node())
+            self.assertEqual(1, exec_env.call_count)
+
+        # After a reboot, the facts are determined anew.
+        exec_env.return_value = {'env': {'JUJU_MACHINE_ID': '7'}}
+        kvcache.reset()
+        testee.drop_environment()
+        with mock.patch('charmhelpers.core.unitdata.kv',
+                        return_value=self.db), \
+                mock.patch('spcharms.utils.get_boot_id',
+                           return_value='boot-2'):
+            self.assertEqual('7', testee.get_parent_node())
+            self.assertEqual(2, exec_env.call_count)
+
+    @mock.patch('charmhelpers.core.hookenv.atexit')
+    @mock.patch('spcharms.utils.err')
+    @mock.patch('spcharms.utils.detect_lxc', return_value=False)
+    @mock.patch('charmhelpers.core.hookenv.execution_environment',
+                return_value={'env': {'JUJU_MACHINE_ID': '3/weird'}})
+    def test_environment_unparseable(self, exec_env, detect_lxc, err,
+                                     atexit):
+        """
+        Only report an unparseable node name when the parent node is needed.
+        """
+        with mock.patch('charmhelpers.core.unitdata.kv',
+                        return_value=self.db), \
+                mock.patch('spcharms.utils.get_boot_id',
+                           return_value='boot-1'):
+            self.assertFalse(testee.check_in_lxc())
+            self.assertEqual('3/weird', testee.get_machine_id())
+            err.assert_not_called()
+
+            self.assertIsNone(testee.get_parent_node())
+            err.assert_called_once_with(
+                'Could not parse the Juju node name "3/weird"')